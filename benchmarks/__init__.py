@@ -0,0 +1,4 @@
+"""
+Benchmarks of the read and write paths of encrypted models. Run them against a local
+PostgreSQL database with pgcrypto with ``python -m benchmarks``, see ``--help``.
+"""
@@ -0,0 +1,51 @@
+"""
+The models the benchmarks run on. They are created on the fly, for every number of
+encrypted fields, and their tables are created directly through the schema editor.
+"""
+from django.db import connection, models
+
+from pgrowcrypt.models import EncryptedModel, EncryptedTextField
+
+_models = {}
+
+
+def get_models(field_count, format='pgp'):
+    """
+    Return a ``Group`` and a ``Record`` model with ``field_count`` encrypted fields
+    ``f0``, ``f1``, ... Every record belongs to a group.
+    """
+    if (field_count, format) not in _models:
+        suffix = '{}{}'.format(field_count, format.capitalize())
+        attrs = {
+            '__module__': __name__,
+            'Meta': type('Meta', (), {'app_label': 'benchmarks'}),
+        }
+        group = type('Group{}'.format(suffix), (EncryptedModel,), dict(attrs, name=EncryptedTextField(format=format)))
+        record_attrs = dict(attrs, group=models.ForeignKey(group, null=True, on_delete=models.CASCADE,
+                                                           related_name='records'))
+        for i in range(field_count):
+            record_attrs['f{}'.format(i)] = EncryptedTextField(format=format)
+        record = type('Record{}'.format(suffix), (EncryptedModel,), record_attrs)
+        _models[field_count, format] = group, record
+    return _models[field_count, format]
+
+
+def create_tables(*model_classes):
+    with connection.schema_editor() as editor:
+        for model in model_classes:
+            editor.create_model(model)
+
+
+def drop_tables(*model_classes):
+    with connection.schema_editor() as editor:
+        for model in reversed(model_classes):
+            editor.delete_model(model)
+
+
+def truncate_tables(*model_classes):
+    with connection.cursor() as cursor:
+        # Deferred foreign key checks of earlier inserts in the same transaction block a TRUNCATE
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        cursor.execute('TRUNCATE {} RESTART IDENTITY CASCADE'.format(
+            ', '.join(connection.ops.quote_name(m._meta.db_table) for m in model_classes)
+        ))
@@ -0,0 +1,259 @@
+"""
+Every benchmark runs one operation on a table of ``rows`` records with ``fields``
+encrypted fields of ``size`` characters each. With the ``table`` layout, all records
+share one key, with the ``row`` layout every record has a key of its own. Queries that
+decrypt many records at once only make sense with a single key, so the ``filter``,
+``iterator``, ``records``, ``export`` and ``prefetch`` operations are skipped for the ``row``
+layout.
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+KEY = 'benchmark key'
+GROUP_SIZE = 10
+
+
+class NullFile(io.RawIOBase):
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return len(b)
+
+
+class Benchmark:
+
+    def __init__(self, operation, rows, fields, size, layout, engine='database', format='pgp'):
+        from .models import get_models
+
+        self.operation = operation
+        self.rows = rows
+        self.fields = fields
+        self.size = size
+        self.layout = layout
+        self.engine = engine
+        self.format = format
+        self.Group, self.Record = get_models(fields, format)
+
+    @property
+    def name(self):
+        return '{}-{}rows-{}fields-{}chars-{}-{}-{}'.format(
+            self.operation, self.rows, self.fields, self.size, self.layout, self.engine, self.format
+        )
+
+    def key(self, i):
+        return KEY if self.layout == 'table' else '{} {}'.format(KEY, i)
+
+    def value(self, i, field):
+        return '{:0{}d}'.format(i * self.fields + field, self.size)[-self.size:]
+
+    def values(self, i):
+        return {'f{}'.format(f): self.value(i, f) for f in range(self.fields)}
+
+    def records(self, groups=None):
+        return [
+            self.Record(_key=self.key(i), group=groups[i // GROUP_SIZE] if groups else None, **self.values(i))
+            for i in range(self.rows)
+        ]
+
+    def populate(self):
+        groups = None
+        if self.operation == 'prefetch':
+            groups = self.Group.objects.bulk_create([
+                self.Group(name='Group {}'.format(i), _key=self.key(i))
+                for i in range((self.rows + GROUP_SIZE - 1) // GROUP_SIZE)
+            ])
+        self.Record.objects.bulk_create(self.records(groups))
+        self.pks = list(self.Record._base_manager.order_by('pk').values_list('pk', flat=True))
+
+    def setup(self):
+        from .models import truncate_tables
+
+        truncate_tables(self.Group, self.Record)
+        if self.operation not in ('create', 'bulk_create'):
+            self.populate()
+
+    def run_create(self):
+        for i in range(self.rows):
+            self.Record.objects.create(_key=self.key(i), **self.values(i))
+
+    def run_bulk_create(self):
+        self.Record.objects.bulk_create(self.records())
+
+    def run_get(self):
+        for i, pk in enumerate(self.pks):
+            assert self.Record.objects.with_key(self.key(i)).get(pk=pk).f0
+
+    def run_filter(self):
+        needle = self.value(self.rows // 2, 0)
+        assert len(self.Record.objects.with_key(KEY).filter(f0=needle)) == 1
+
+    def run_iterator(self):
+        assert sum(1 for r in self.Record.objects.with_key(KEY).iterator()) == self.rows
+
+    def run_records(self):
+        assert sum(1 for r in self.Record.objects.with_key(KEY).records().iterator()) == self.rows
+
+    def run_export(self):
+        from pgrowcrypt.export import export_rows
+
+        assert export_rows(self.Record.objects.with_key(KEY), NullFile()) == self.rows
+
+    def run_update(self):
+        if self.layout == 'table':
+            self.Record.objects.with_key(KEY).update(**self.values(0))
+            return
+        for i, pk in enumerate(self.pks):
+            self.Record.objects.with_key(self.key(i)).filter(pk=pk).update(**self.values(0))
+
+    def run_prefetch(self):
+        groups = self.Group.objects.with_key(KEY).prefetch_related('records')
+        assert sum(len(g.name) + sum(len(r.f0) for r in g.records.all()) for g in groups)
+
+    def measure(self, repeat):
+        from django.test.utils import override_settings
+
+        timings = []
+        with override_settings(PGROWCRYPT_ENGINE=self.engine):
+            for i in range(repeat):
+                self.setup()
+                start = time.perf_counter()
+                getattr(self, 'run_{}'.format(self.operation))()
+                timings.append(time.perf_counter() - start)
+        return {
+            'name': self.name,
+            'operation': self.operation,
+            'rows': self.rows,
+            'fields': self.fields,
+            'size': self.size,
+            'layout': self.layout,
+            'engine': self.engine,
+            'format': self.format,
+            'seconds': statistics.median(timings),
+            'min_seconds': min(timings),
+            'rows_per_second': self.rows / statistics.median(timings),
+        }
+
+
+OPERATIONS = ('create', 'bulk_create', 'get', 'filter', 'iterator', 'records', 'export', 'update', 'prefetch')
+SINGLE_KEY_OPERATIONS = ('filter', 'iterator', 'records', 'export', 'prefetch')
+
+
+def get_benchmarks(operations=OPERATIONS, rows=(1000,), fields=(1,), sizes=(32,), layouts=('table', 'row'),
+                   engines=('database',), formats=('pgp',)):
+    for operation, r, f, size, layout, engine, format in itertools.product(
+            operations, rows, fields, sizes, layouts, engines, formats):
+        if layout == 'row' and operation in SINGLE_KEY_OPERATIONS:
+            continue
+        yield Benchmark(operation, r, f, size, layout, engine, format)
+
+
+def run_benchmarks(benchmarks, repeat=3, out=None):
+    """
+    Run all benchmarks, ``repeat`` times each, on the default database and return a
+    list of results. The tables of the benchmark models are created and dropped here.
+    """
+    from .models import create_tables, drop_tables
+
+    benchmarks = list(benchmarks)
+    tables = list({(b.fields, b.format): (b.Group, b.Record) for b in benchmarks}.values())
+    create_tables(*itertools.chain.from_iterable(tables))
+    try:
+        results = []
+        for b in benchmarks:
+            results.append(b.measure(repeat))
+            if out:
+                out.write('{name:<60} {seconds:>10.4f}s {rows_per_second:>12.1f} rows/s\n'.format(**results[-1]))
+        return results
+    finally:
+        drop_tables(*itertools.chain.from_iterable(tables))
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compare ``results`` with the results of an earlier run and return a list of
+    ``(name, baseline seconds, seconds, ratio)`` for every benchmark that has become
+    slower by more than ``tolerance``.
+    """
+    previous = {r['name']: r for r in baseline}
+    regressions = []
+    for r in results:
+        if r['name'] in previous:
+            ratio = r['seconds'] / previous[r['name']]['seconds']
+            if ratio > 1 + tolerance:
+                regressions.append((r['name'], previous[r['name']]['seconds'], r['seconds'], ratio))
+    return regressions
+
+
+def environment():
+    from django import get_version
+    from django.db import connection
+
+    return {
+        'python': platform.python_version(),
+        'django': get_version(),
+        'postgresql': connection.pg_version,
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+
+def _list(type_):
+    return lambda value: [type_(v) for v in value.split(',')]
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__)
+    parser.add_argument('--operations', type=_list(str), default=list(OPERATIONS))
+    parser.add_argument('--rows', type=_list(int), default=[1000])
+    parser.add_argument('--fields', type=_list(int), default=[1, 4])
+    parser.add_argument('--sizes', type=_list(int), default=[32, 1024])
+    parser.add_argument('--layouts', type=_list(str), default=['table', 'row'])
+    parser.add_argument('--engines', type=_list(str), default=['database'])
+    parser.add_argument('--formats', type=_list(str), default=['pgp'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', help='Compare the results with this JSON file of an earlier run.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Report benchmarks that are slower than the baseline by more than this fraction.')
+    return parser
+
+
+def main(argv=None):
+    options = get_parser().parse_args(argv)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+
+    import django
+    from django.db import connection
+
+    django.setup()
+    test_db = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        results = run_benchmarks(get_benchmarks(
+            options.operations, options.rows, options.fields, options.sizes, options.layouts, options.engines,
+            options.formats,
+        ), options.repeat, out=sys.stdout)
+        env = environment()
+    finally:
+        connection.creation.destroy_test_db(test_db, verbosity=0)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'environment': env, 'results': results}, f, indent=2)
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], options.tolerance)
+        for name, before, after, ratio in regressions:
+            sys.stdout.write('Regression: {} took {:.4f}s instead of {:.4f}s ({:+.0%})\n'.format(
+                name, after, before, ratio - 1
+            ))
+        return 1 if regressions else 0
+    return 0
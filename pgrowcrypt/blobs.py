@@ -0,0 +1,160 @@
+"""
+Encrypted blobs that are too large to be loaded into memory as a whole, like uploaded
+files. A blob is split into chunks of ``PGROWCRYPT_BLOB_CHUNK_SIZE`` bytes that are
+encrypted and stored one row each in the table of ``EncryptedChunk``, which is created
+by the migrations of the ``pgrowcrypt`` app. Blobs are identified by a UUID that you
+store with your own models, and they are written and read through file objects that
+only hold one chunk in memory at a time. Reading a range of a blob only fetches and
+decrypts the chunks it overlaps.
+"""
+import io
+import uuid
+
+from django.conf import settings
+from django.db import router
+from django.db.models import Sum
+
+from .models.chunks import EncryptedChunk
+
+
+def get_chunk_size():
+    return getattr(settings, 'PGROWCRYPT_BLOB_CHUNK_SIZE', 1024 * 1024)
+
+
+class BlobWriter(io.RawIOBase):
+    """
+    A writable file object that encrypts everything written to it with ``key`` into a
+    new blob, with the UUID ``blob`` if it is given. A chunk is stored as soon as it is
+    full, the last one when the file is closed. If the ``with`` block of the writer is
+    left with an exception, the chunks it has written so far are deleted.
+    """
+
+    def __init__(self, key, blob=None, using=None, chunk_size=None):
+        if not key:
+            raise TypeError("No key set to encrypt the blob.")
+        self.key = key
+        self.blob = blob or uuid.uuid4()
+        self.using = using or router.db_for_write(EncryptedChunk)
+        self.chunk_size = chunk_size or get_chunk_size()
+        self.size = 0
+        self.buffer = bytearray()
+        # Whether this writer has stored a chunk, and so the blob is its own to delete
+        self.created = False
+        if blob and EncryptedChunk.objects.using(self.using).filter(blob=blob).exists():
+            raise ValueError("The blob {} exists already.".format(blob))
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError("I/O operation on closed blob.")
+        b = memoryview(b).cast('B')
+        self.buffer += b
+        while len(self.buffer) >= self.chunk_size:
+            self._write_chunk(bytes(self.buffer[:self.chunk_size]))
+            del self.buffer[:self.chunk_size]
+        return len(b)
+
+    def _write_chunk(self, data):
+        EncryptedChunk(blob=self.blob, offset=self.size, length=len(data), data=data, _key=self.key).save(using=self.using)
+        self.created = True
+        self.size += len(data)
+
+    def close(self):
+        if not self.closed:
+            try:
+                if self.buffer:
+                    self._write_chunk(bytes(self.buffer))
+                    self.buffer = bytearray()
+            finally:
+                super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.buffer = bytearray()
+            self.close()
+            if self.created:
+                delete_blob(self.blob, using=self.using)
+
+
+class BlobReader(io.RawIOBase):
+    """
+    A seekable, readable file object for the blob ``blob``, decrypted with ``key``.
+    """
+
+    def __init__(self, blob, key, using=None):
+        if not key:
+            raise TypeError("No key set to decrypt the blob.")
+        self.blob = blob
+        self.key = key
+        self.using = using or router.db_for_read(EncryptedChunk)
+        self.size = EncryptedChunk.objects.using(self.using).filter(blob=blob).aggregate(
+            size=Sum('length')
+        )['size'] or 0
+        self.position = 0
+        # The offset and data of the chunk that was read last
+        self.chunk = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        elif whence != io.SEEK_SET:
+            raise ValueError("Invalid whence {!r}.".format(whence))
+        if offset < 0:
+            raise ValueError("Negative seek position {}.".format(offset))
+        self.position = offset
+        return offset
+
+    def readinto(self, b):
+        b = memoryview(b).cast('B')
+        read = 0
+        while read < len(b) and self.position < self.size:
+            offset, data = self._get_chunk(self.position)
+            start = self.position - offset
+            n = min(len(b) - read, len(data) - start)
+            b[read:read + n] = data[start:start + n]
+            read += n
+            self.position += n
+        return read
+
+    def _get_chunk(self, position):
+        if self.chunk is None or not self.chunk[0] <= position < self.chunk[0] + len(self.chunk[1]):
+            self.chunk = EncryptedChunk.objects.using(self.using).with_key(self.key).filter(
+                blob=self.blob, offset__lte=position
+            ).order_by('-offset').values_list('offset', 'data')[0]
+        return self.chunk
+
+
+def write_blob(file, key, blob=None, using=None, chunk_size=None):
+    """
+    Encrypt the contents of the binary file object ``file`` into a new blob, with the
+    UUID ``blob`` if it is given, and return its UUID.
+    """
+    with BlobWriter(key, blob=blob, using=using, chunk_size=chunk_size) as writer:
+        while True:
+            data = file.read(writer.chunk_size)
+            if not data:
+                break
+            writer.write(data)
+    return writer.blob
+
+
+def delete_blob(blob, using=None):
+    """
+    Delete all chunks of the blob ``blob``.
+    """
+    EncryptedChunk.objects.using(using or router.db_for_write(EncryptedChunk)).filter(blob=blob).delete()
@@ -0,0 +1,173 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.encoding import force_bytes
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:  # pragma: no cover
+    Cipher = None
+
+DETERMINISTIC_FORMAT = b'\x01'
+DETERMINISTIC_ENCRYPTION_KEY = b'pgrowcrypt deterministic encryption key'
+DETERMINISTIC_IV_KEY = b'pgrowcrypt deterministic iv key'
+AES_FORMAT = b'\x02'
+AES_ENCRYPTION_KEY = b'pgrowcrypt aes encryption key'
+AES_MAC_KEY = b'pgrowcrypt aes mac key'
+KEY_FINGERPRINT = b'pgrowcrypt key fingerprint'
+BLIND_INDEX_KEY = b'pgrowcrypt blind index key'
+SEARCH_INDEX_KEY = b'pgrowcrypt search index key'
+
+
+class KeyCache:
+    """
+    A thread-safe cache of derived keys that holds at most ``PGROWCRYPT_KEY_CACHE_SIZE``
+    keys, evicting the least recently used, for ``PGROWCRYPT_KEY_CACHE_TTL`` seconds.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, cache_key, derive):
+        size = getattr(settings, 'PGROWCRYPT_KEY_CACHE_SIZE', 256)
+        ttl = getattr(settings, 'PGROWCRYPT_KEY_CACHE_TTL', 300)
+        if not size:
+            return derive()
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(cache_key)
+                return entry[0]
+        value = derive()
+        with self.lock:
+            self.entries[cache_key] = (value, now + ttl)
+            self.entries.move_to_end(cache_key)
+            while len(self.entries) > size:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+key_cache = KeyCache()
+
+
+def derive_key(key, info, length=32):
+    """
+    Derive a raw key of ``length`` bytes for the purpose described by ``info`` from a
+    user-supplied key, using HKDF-SHA256 (RFC 5869) without a salt. Derived keys are
+    cached, so a key is only derived once for all the rows of a query.
+    """
+    return key_cache.get((force_bytes(key), info, length), lambda: _hkdf(key, info, length))
+
+
+def key_fingerprint(key):
+    """
+    Return a fingerprint that identifies ``key`` without revealing it or any of the
+    other keys derived from it. Fingerprints are stored next to the data, so they are
+    derived with ``PGROWCRYPT_FINGERPRINT_ITERATIONS`` iterations of PBKDF2-HMAC-SHA256
+    and salted with the ``PGROWCRYPT_FINGERPRINT_SALT`` setting, which makes guessing
+    keys from the fingerprints in a database dump slow, and impossible without the salt.
+    """
+    salt = KEY_FINGERPRINT + force_bytes(getattr(settings, 'PGROWCRYPT_FINGERPRINT_SALT', ''))
+    iterations = getattr(settings, 'PGROWCRYPT_FINGERPRINT_ITERATIONS', 10000)
+    return key_cache.get(
+        (force_bytes(key), salt, iterations),
+        lambda: hashlib.pbkdf2_hmac('sha256', force_bytes(key), salt, iterations)
+    )
+
+
+def _hkdf(key, info, length):
+    prk = hmac.new(b'\x00' * hashlib.sha256().digest_size, force_bytes(key), hashlib.sha256).digest()
+    okm = b''
+    block = b''
+    counter = 1
+    while len(okm) < length:
+        block = hmac.new(prk, block + info + bytes([counter]), hashlib.sha256).digest()
+        okm += block
+        counter += 1
+    return okm[:length]
+
+
+def _aes_cbc(key, iv, data, encrypt):
+    if Cipher is None:
+        raise ValueError('Encryption outside of the database requires the cryptography package.')
+    cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
+    if encrypt:
+        padder = padding.PKCS7(128).padder()
+        data = padder.update(data) + padder.finalize()
+    ctx = cipher.encryptor() if encrypt else cipher.decryptor()
+    data = ctx.update(data) + ctx.finalize()
+    if not encrypt:
+        unpadder = padding.PKCS7(128).unpadder()
+        data = unpadder.update(data) + unpadder.finalize()
+    return data
+
+
+def deterministic_keys(key):
+    """
+    Return the encryption key and the IV key of the deterministic format for ``key``.
+    """
+    return derive_key(key, DETERMINISTIC_ENCRYPTION_KEY), derive_key(key, DETERMINISTIC_IV_KEY)
+
+
+def aes_keys(key):
+    """
+    Return the encryption key and the MAC key of the AES format for ``key``.
+    """
+    return derive_key(key, AES_ENCRYPTION_KEY), derive_key(key, AES_MAC_KEY)
+
+
+def encrypt_deterministic(value, key, derived_keys=None):
+    """
+    Encrypt ``value`` the same way as ``DeterministicEncryptionValueWrapper`` does
+    inside the database. ``derived_keys`` are the keys of ``deterministic_keys()``, if
+    they have been derived already.
+    """
+    encryption_key, iv_key = derived_keys or deterministic_keys(key)
+    data = value.encode('utf-8')
+    iv = hmac.new(iv_key, data, hashlib.sha256).digest()[:16]
+    return DETERMINISTIC_FORMAT + iv + _aes_cbc(encryption_key, iv, data, True)
+
+
+def decrypt_deterministic(value, key, derived_keys=None):
+    encryption_key, iv_key = derived_keys or deterministic_keys(key)
+    value = bytes(value)
+    if value[:1] != DETERMINISTIC_FORMAT or len(value) < 33:
+        raise ValueError('Corrupt data')
+    return _aes_cbc(encryption_key, value[1:17], value[17:], False).decode('utf-8')
+
+
+def encrypt_aes(value, key, derived_keys=None):
+    """
+    Encrypt ``value`` the same way as ``AESEncryptionValueWrapper`` does inside the
+    database: the format byte, a random IV and the ciphertext, followed by a HMAC of
+    all of them. ``derived_keys`` are the keys of ``aes_keys()``, if they have been
+    derived already.
+    """
+    encryption_key, mac_key = derived_keys or aes_keys(key)
+    iv = os.urandom(16)
+    data = AES_FORMAT + iv + _aes_cbc(encryption_key, iv, value.encode('utf-8'), True)
+    return data + hmac.new(mac_key, data, hashlib.sha256).digest()
+
+
+def decrypt_aes(value, key, derived_keys=None):
+    encryption_key, mac_key = derived_keys or aes_keys(key)
+    value = bytes(value)
+    if value[:1] != AES_FORMAT or len(value) < 65:
+        raise ValueError('Corrupt data')
+    data, mac = value[:-32], value[-32:]
+    if not hmac.compare_digest(hmac.new(mac_key, data, hashlib.sha256).digest(), mac):
+        raise ValueError('Wrong key or corrupt data')
+    return _aes_cbc(encryption_key, data[1:17], data[17:], False).decode('utf-8')
@@ -0,0 +1,123 @@
+"""
+By default, all values are encrypted and decrypted by pgcrypto inside the database.
+With ``PGROWCRYPT_ENGINE = 'python'``, values that are written or selected are
+encrypted and decrypted in the application process instead, optionally spread over
+a pool of ``PGROWCRYPT_POOL_SIZE`` threads (or processes, with
+``PGROWCRYPT_POOL = 'process'``). Comparisons and functions on encrypted columns
+are still evaluated by the database. Both engines produce the same data.
+"""
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import InternalError
+
+from . import pgp
+from .crypto import (
+    AES_FORMAT, aes_keys, decrypt_aes, decrypt_deterministic,
+    deterministic_keys, encrypt_aes, encrypt_deterministic,
+)
+
+ENGINE_DATABASE = 'database'
+ENGINE_PYTHON = 'python'
+
+FORMAT_PGP = 'pgp'
+FORMAT_AES = 'aes'
+FORMAT_DETERMINISTIC = 'deterministic'
+# PGP messages of binary data, as written by pgp_sym_encrypt_bytea()
+FORMAT_PGP_BYTEA = 'pgp_bytea'
+
+# Smaller batches are not worth the overhead of the pool
+POOL_THRESHOLD = 16
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def client_side():
+    return getattr(settings, 'PGROWCRYPT_ENGINE', ENGINE_DATABASE) == ENGINE_PYTHON
+
+
+def batch_size():
+    return getattr(settings, 'PGROWCRYPT_BATCH_SIZE', 1000)
+
+
+def get_pool():
+    global _pool
+    if not getattr(settings, 'PGROWCRYPT_POOL_SIZE', 0):
+        return None
+    with _pool_lock:
+        if _pool is None:
+            if getattr(settings, 'PGROWCRYPT_POOL', 'thread') == 'process':
+                _pool = ProcessPoolExecutor(max_workers=settings.PGROWCRYPT_POOL_SIZE)
+            else:
+                _pool = ThreadPoolExecutor(max_workers=settings.PGROWCRYPT_POOL_SIZE)
+    return _pool
+
+
+def _derive_keys(key, format):
+    # The keys are derived before the jobs are sent to the pool, so its processes never
+    # need the settings of the key cache
+    if format == FORMAT_DETERMINISTIC:
+        return deterministic_keys(key)
+    if format == FORMAT_AES:
+        return aes_keys(key)
+    return None
+
+
+def _encrypt(job):
+    value, key, format, options, derived_keys = job
+    if value is None:
+        return None
+    if format == FORMAT_DETERMINISTIC:
+        return encrypt_deterministic(value, key, derived_keys)
+    if format == FORMAT_AES:
+        return encrypt_aes(value, key, derived_keys)
+    if format == FORMAT_PGP_BYTEA:
+        return pgp.encrypt(value, key, text=False, **options)
+    return pgp.pgp_sym_encrypt(value, key, **options)
+
+
+def _decrypt(job):
+    value, key, format, derived_keys = job
+    if value is None:
+        return None
+    if format == FORMAT_DETERMINISTIC:
+        return decrypt_deterministic(value, key, derived_keys)
+    if format == FORMAT_AES and value[:1] == AES_FORMAT:
+        # Columns switched to the AES format may still contain PGP messages
+        return decrypt_aes(value, key, derived_keys)
+    if format == FORMAT_PGP_BYTEA:
+        return pgp.decrypt(value, key, text=False)
+    return pgp.pgp_sym_decrypt(value, key)
+
+
+def _map(func, jobs):
+    pool = get_pool()
+    try:
+        if pool is None or len(jobs) < POOL_THRESHOLD:
+            return [func(job) for job in jobs]
+        if isinstance(pool, ProcessPoolExecutor):
+            return list(pool.map(func, jobs, chunksize=max(1, len(jobs) // (settings.PGROWCRYPT_POOL_SIZE * 4))))
+        return list(pool.map(func, jobs))
+    except ValueError as e:
+        # Behave like pgcrypto would inside the database
+        raise InternalError(str(e)) from e
+
+
+def encrypt_values(jobs):
+    """
+    Encrypt a list of ``(plaintext, key, format, pgp_options)`` tuples.
+    """
+    return _map(_encrypt, [
+        (None if v is None else bytes(v) if d == FORMAT_PGP_BYTEA else str(v), k, d, o, _derive_keys(k, d))
+        for v, k, d, o in jobs
+    ])
+
+
+def decrypt_values(jobs):
+    """
+    Decrypt a list of ``(ciphertext, key, format)`` tuples.
+    """
+    # psycopg2 returns bytea values as memoryviews, which can't be sent to other processes
+    return _map(_decrypt, [(None if v is None else bytes(v), k, d, _derive_keys(k, d)) for v, k, d in jobs])
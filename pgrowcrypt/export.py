@@ -0,0 +1,96 @@
+"""
+Streams the decrypted rows of a queryset into a CSV or JSON Lines file. The rows are
+fetched as tuples from a server-side cursor in chunks of ``chunk_size``, so no model
+instances are built and only one chunk is held in memory at a time.
+"""
+import binascii
+import csv
+import gzip
+import io
+import itertools
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models.fields import (
+    BlindIndexField, KeyFingerprintField, SearchIndexField,
+)
+
+FORMATS = ('csv', 'jsonl')
+
+
+class ExportJSONEncoder(DjangoJSONEncoder):
+
+    def default(self, o):
+        if isinstance(o, (bytes, memoryview)):
+            return binascii.hexlify(o).decode()
+        return super().default(o)
+
+
+class CSVWriter:
+
+    def __init__(self, stream, fields):
+        self.writer = csv.writer(stream)
+        self.writer.writerow(fields)
+
+    def write(self, rows):
+        self.writer.writerows(
+            [binascii.hexlify(v).decode() if isinstance(v, (bytes, memoryview)) else v for v in row] for row in rows
+        )
+
+
+class JSONLinesWriter:
+
+    def __init__(self, stream, fields):
+        self.stream = stream
+        self.fields = fields
+        self.encoder = ExportJSONEncoder(ensure_ascii=False)
+
+    def write(self, rows):
+        self.stream.writelines(self.encoder.encode(dict(zip(self.fields, row))) + '\n' for row in rows)
+
+
+WRITERS = {'csv': CSVWriter, 'jsonl': JSONLinesWriter}
+
+
+def get_export_fields(model):
+    """
+    Return the names of the columns that are exported by default, i.e. all but the
+    index and fingerprint columns.
+    """
+    return [
+        f.attname for f in model._meta.concrete_fields
+        if not isinstance(f, (BlindIndexField, SearchIndexField, KeyFingerprintField))
+    ]
+
+
+def export_rows(queryset, file, format='csv', fields=None, chunk_size=2000, compress=False):
+    """
+    Write the rows of ``queryset`` (with their encrypted columns decrypted with the key of
+    the queryset) to the binary file object ``file`` as CSV with a header row or as JSON
+    Lines, with the columns ``fields`` or all but the index columns. The rows are fetched
+    ``chunk_size`` at a time. With ``compress``, the output is compressed with gzip.
+    Returns the number of rows.
+    """
+    if format not in WRITERS:
+        raise ValueError('Unknown export format {!r}, expected one of {}.'.format(format, ', '.join(FORMATS)))
+    fields = list(fields or get_export_fields(queryset.model))
+    if compress:
+        file = gzip.GzipFile(fileobj=file, mode='wb')
+    stream = io.TextIOWrapper(file, encoding='utf-8', newline='')
+    try:
+        writer = WRITERS[format](stream, fields)
+        rows = queryset.values_list(*fields).iterator(chunk_size=chunk_size)
+        count = 0
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            writer.write(chunk)
+            count += len(chunk)
+    finally:
+        stream.flush()
+        # Leave the file open for the caller, but finish the gzip stream
+        stream.detach()
+        if compress:
+            file.close()
+    return count
@@ -0,0 +1,181 @@
+"""
+Statistics about the cryptographic work of every statement. While ``query_key`` is
+active, the expressions that encrypt and decrypt values record themselves when they are
+compiled, and an execution wrapper attaches these counts to the next statement that is
+executed, together with its duration and row count, and sends them with the
+``query_executed`` signal.
+
+With ``PGROWCRYPT_INSPECT`` set to ``'warn'`` or ``'raise'`` and ``DEBUG`` enabled, every
+``SELECT`` that filters or orders by decrypted values is run through ``EXPLAIN`` first,
+and a ``DecryptingScanWarning`` is emitted (or raised) if PostgreSQL plans a sequential
+scan on the table, i.e. decrypts every row of it.
+"""
+import copy
+import json
+import time
+import warnings
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .signals import query_executed
+
+INSPECTED_CLAUSES = ('where', 'order_by')
+
+
+class DecryptingScanWarning(UserWarning):
+    pass
+
+
+class QueryStats:
+    """
+    The cryptographic work of a single statement: ``references`` counts the references
+    to encrypted columns by clause (``select``, ``where``, ``order_by``, ``group_by``,
+    ``having`` or ``other``, which includes all references in ``UPDATE`` statements),
+    ``decryptions`` and ``encryptions`` count the expressions
+    that decrypt or encrypt values inside the database, ``client_decryptions`` and
+    ``client_encryptions`` the columns and values that are handled by the Python engine
+    instead. ``rows`` and ``duration`` describe the execution of the statement.
+    """
+
+    def __init__(self):
+        self.model = None
+        self.references = Counter()
+        self.tables = set()
+        self.decryptions = 0
+        self.encryptions = 0
+        self.client_decryptions = 0
+        self.client_encryptions = 0
+        self.sql = None
+        self.rows = None
+        self.duration = None
+
+    def __bool__(self):
+        return bool(
+            sum(self.references.values()) or self.decryptions or self.encryptions or self.client_decryptions
+            or self.client_encryptions
+        )
+
+    def __repr__(self):
+        return '<QueryStats references={} decryptions={} encryptions={} rows={} duration={}>'.format(
+            dict(self.references), self.decryptions + self.client_decryptions,
+            self.encryptions + self.client_encryptions, self.rows, self.duration
+        )
+
+
+def _inspect_mode():
+    return settings.DEBUG and getattr(settings, 'PGROWCRYPT_INSPECT', None)
+
+
+def _plan_nodes(node):
+    yield node
+    for child in node.get('Plans', []):
+        yield from _plan_nodes(child)
+
+
+def inspect_plan(cursor, sql, params, stats):
+    """
+    Warn about (or, with ``PGROWCRYPT_INSPECT = 'raise'``, raise) sequential scans on
+    the tables whose encrypted columns the statement filters or orders by.
+    """
+    cursor.execute('EXPLAIN (FORMAT JSON) {}'.format(sql), params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    scanned = sorted({
+        node['Relation Name'] for node in _plan_nodes(plan[0]['Plan'])
+        if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') in stats.tables
+    })
+    if not scanned:
+        return
+    message = 'The query decrypts every row of {} to evaluate encrypted columns in {}: {}'.format(
+        ', '.join(scanned), ', '.join(c.upper().replace('_', ' ') for c in INSPECTED_CLAUSES if stats.references[c]),
+        sql
+    )
+    if _inspect_mode() == 'raise':
+        raise DecryptingScanWarning(message)
+    warnings.warn(message, DecryptingScanWarning)
+
+
+class Instrumentation:
+    """
+    Collects the statistics of the statements on one connection.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.pending = QueryStats()
+
+    def __call__(self, execute, sql, params, many, context):
+        stats, self.pending = self.pending, QueryStats()
+        if not stats:
+            return execute(sql, params, many, context)
+        if not many and _inspect_mode() and any(stats.references[c] for c in INSPECTED_CLAUSES) and (
+            sql.lstrip()[:6].upper() == 'SELECT'
+        ):
+            # The cursor of the query may be a named cursor, which can only run the query itself
+            with self.connection.connection.cursor() as cursor:
+                inspect_plan(cursor, sql, params, stats)
+
+        start = time.perf_counter()
+        result = execute(sql, params, many, context)
+        stats.duration = time.perf_counter() - start
+        stats.sql = sql
+        stats.rows = context['cursor'].rowcount
+        query_executed.send(sender=stats.model, connection=self.connection, stats=stats)
+        return result
+
+
+@contextmanager
+def instrument(connection):
+    """
+    Collect statistics about the statements executed on ``connection`` within this
+    block, if anybody listens to them.
+    """
+    if getattr(connection, '_pgrowcrypt_instrumentation', None) is not None or not (
+        query_executed.has_listeners() or _inspect_mode()
+    ):
+        yield
+        return
+    connection._pgrowcrypt_instrumentation = Instrumentation(connection)
+    try:
+        with connection.execute_wrapper(connection._pgrowcrypt_instrumentation):
+            yield
+    finally:
+        connection._pgrowcrypt_instrumentation = None
+
+
+def record(connection, field=None, clause=None, **counts):
+    """
+    Add ``counts`` to the statistics of the next statement on ``connection``. A
+    reference to the encrypted ``field`` in ``clause`` is recorded if both are given.
+    """
+    instrumentation = getattr(connection, '_pgrowcrypt_instrumentation', None)
+    if instrumentation is None:
+        return
+    stats = instrumentation.pending
+    if field is not None:
+        if stats.model is None:
+            stats.model = field.model
+        if clause is not None:
+            stats.references[clause] += 1
+            if clause in INSPECTED_CLAUSES:
+                stats.tables.add(field.model._meta.db_table)
+    for k, v in counts.items():
+        setattr(stats, k, getattr(stats, k) + v)
+
+
+def checkpoint(connection):
+    """
+    Return the statistics recorded for the next statement so far, to be restored with
+    ``rollback()`` when a query is compiled again.
+    """
+    instrumentation = getattr(connection, '_pgrowcrypt_instrumentation', None)
+    return copy.deepcopy(instrumentation.pending) if instrumentation is not None else None
+
+
+def rollback(connection, stats):
+    instrumentation = getattr(connection, '_pgrowcrypt_instrumentation', None)
+    if instrumentation is not None and stats is not None:
+        instrumentation.pending = stats
@@ -0,0 +1,54 @@
+import os
+import sys
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from pgrowcrypt.export import FORMATS, export_rows
+
+
+class Command(BaseCommand):
+    help = 'Exports the decrypted rows of a model as CSV or JSON Lines.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='The model to export, e.g. "myapp.Customer".')
+        parser.add_argument('--key', help='The key. Defaults to the environment variable PGROWCRYPT_KEY.')
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('--fields', help='A comma-separated list of the columns to export. Defaults to all columns.')
+        parser.add_argument('--filter', action='append', default=[], metavar='LOOKUP=VALUE',
+                            help='Only export rows matching this lookup. Can be given multiple times.')
+        parser.add_argument('--output', default='-', help='The file to write to. Defaults to the standard output.')
+        parser.add_argument('--gzip', action='store_true', help='Compress the output with gzip.')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='The number of rows to fetch at a time.')
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+
+        key = options['key'] or os.environ.get('PGROWCRYPT_KEY')
+        if not key:
+            raise CommandError('The key needs to be given.')
+
+        lookups = {}
+        for f in options['filter']:
+            if '=' not in f:
+                raise CommandError('Invalid filter "{}", expected LOOKUP=VALUE.'.format(f))
+            lookup, value = f.split('=', 1)
+            lookups[lookup] = value
+
+        if not hasattr(model._default_manager, 'with_key'):
+            raise CommandError('{} is not an encrypted model.'.format(model._meta.label))
+        qs = model._default_manager.using(options['database']).with_key(key).filter(**lookups).order_by('pk')
+        fields = options['fields'].split(',') if options['fields'] else None
+        kwargs = {'format': options['format'], 'fields': fields, 'chunk_size': options['chunk_size'],
+                  'compress': options['gzip']}
+        if options['output'] == '-':
+            rows = export_rows(qs, sys.stdout.buffer, **kwargs)
+            sys.stdout.buffer.flush()
+        else:
+            with open(options['output'], 'wb') as f:
+                rows = export_rows(qs, f, **kwargs)
+        self.stderr.write('Exported {} rows.'.format(rows))
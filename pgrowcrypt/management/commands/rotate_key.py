@@ -0,0 +1,46 @@
+import os
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from pgrowcrypt.rotation import rotate_key
+
+
+class Command(BaseCommand):
+    help = 'Re-encrypts the rows of a model with a new key.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='The model to rotate, e.g. "myapp.Customer".')
+        parser.add_argument('--old-key', help='The current key. Defaults to the environment variable PGROWCRYPT_OLD_KEY.')
+        parser.add_argument('--new-key', help='The new key. Defaults to the environment variable PGROWCRYPT_NEW_KEY.')
+        parser.add_argument('--filter', action='append', default=[], metavar='LOOKUP=VALUE',
+                            help='Only rotate rows matching this lookup. Can be given multiple times.')
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--workers', type=int, default=1, help='The number of batches to run in parallel.')
+        parser.add_argument('--checkpoint', help='A file to record the progress in, to resume an interrupted rotation.')
+        parser.add_argument('--throttle', type=float, default=0, help='Seconds to pause after every batch.')
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+
+        old_key = options['old_key'] or os.environ.get('PGROWCRYPT_OLD_KEY')
+        new_key = options['new_key'] or os.environ.get('PGROWCRYPT_NEW_KEY')
+        if not old_key or not new_key:
+            raise CommandError('Both the old and the new key need to be given.')
+
+        lookups = {}
+        for f in options['filter']:
+            if '=' not in f:
+                raise CommandError('Invalid filter "{}", expected LOOKUP=VALUE.'.format(f))
+            lookup, value = f.split('=', 1)
+            lookups[lookup] = value
+
+        rows = rotate_key(
+            model, old_key, new_key, filter=lookups, batch_size=options['batch_size'], workers=options['workers'],
+            using=options['database'], checkpoint=options['checkpoint'], throttle=options['throttle'],
+        )
+        self.stdout.write('Rotated {} rows.'.format(rows))
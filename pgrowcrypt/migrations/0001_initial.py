@@ -0,0 +1,33 @@
+# Generated by Django 2.1.15 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+import pgrowcrypt.models.fields
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EncryptedChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('blob', models.UUIDField()),
+                ('offset', models.BigIntegerField()),
+                ('length', models.IntegerField()),
+                ('data', pgrowcrypt.models.fields.EncryptedBinaryField()),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='encryptedchunk',
+            unique_together={('blob', 'offset')},
+        ),
+    ]
@@ -1,4 +1,10 @@
-from .fields import EncryptedField, EncryptedTextField
+from django.apps import apps as _apps
+
+from .fields import (
+    EncryptedBinaryField, EncryptedField, EncryptedTextField,
+    KeyFingerprintField, search_index,
+)
+from .keys import encryption_key
 from .manager import EncryptedColumnsManager, EncryptedColumnsQuerySet
 from .models import EncryptedModel
 
@@ -6,6 +12,14 @@ __all__ = [
     'EncryptedColumnsManager',
     'EncryptedModel',
     'EncryptedTextField',
+    'EncryptedBinaryField',
     'EncryptedColumnsQuerySet',
-    'EncryptedField'
+    'EncryptedField',
+    'encryption_key',
+    'KeyFingerprintField',
+    'search_index',
 ]
+
+if _apps.apps_ready and _apps.is_installed('pgrowcrypt'):
+    # The table for blobs is only created if pgrowcrypt is an installed app
+    from .chunks import EncryptedChunk  # noqa
@@ -0,0 +1,71 @@
+"""
+Asynchronous versions of the methods of encrypted querysets and models. There is no
+asynchronous database driver for Django, so like Django's own asynchronous ORM methods,
+they run their synchronous counterparts in the thread that is shared by all
+thread-sensitive code. The key of ``encryption_key()`` is carried over, because every
+call copies the context of the calling task.
+
+This module requires Python 3.6 and asgiref (which comes with Django 3.0+).
+"""
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+
+
+def _async(name):
+    async def method(self, *args, **kwargs):
+        return await sync_to_async(getattr(self, name), thread_sensitive=True)(*args, **kwargs)
+
+    method.__name__ = 'a{}'.format(name)
+    method.__doc__ = 'An asynchronous version of ``{}()``.'.format(name)
+    return method
+
+
+class AsyncQuerySetMixin:
+    aget = _async('get')
+    acreate = _async('create')
+    aget_or_create = _async('get_or_create')
+    aupdate_or_create = _async('update_or_create')
+    abulk_create = _async('bulk_create')
+    abulk_update = _async('bulk_update')
+    abulk_load = _async('bulk_load')
+    acount = _async('count')
+    ain_bulk = _async('in_bulk')
+    aexists = _async('exists')
+    aaggregate = _async('aggregate')
+    afirst = _async('first')
+    alast = _async('last')
+    aupdate = _async('update')
+    adelete = _async('delete')
+
+    async def aiterator(self, chunk_size=2000):
+        """
+        An asynchronous version of ``iterator()``, which fetches ``chunk_size`` objects
+        at a time.
+        """
+        iterator = self.iterator(chunk_size=chunk_size)
+        fetch = sync_to_async(lambda: list(islice(iterator, chunk_size)), thread_sensitive=True)
+        try:
+            while True:
+                chunk = await fetch()
+                if not chunk:
+                    return
+                for obj in chunk:
+                    yield obj
+        finally:
+            # The iterator holds the key until it is closed, in the thread it runs in
+            await sync_to_async(iterator.close, thread_sensitive=True)()
+
+    def __aiter__(self):
+        async def iterate():
+            await sync_to_async(self._fetch_all, thread_sensitive=True)()
+            for obj in self._result_cache:
+                yield obj
+
+        return iterate()
+
+
+class AsyncModelMixin:
+    asave = _async('save')
+    adelete = _async('delete')
+    arefresh_from_db = _async('refresh_from_db')
@@ -0,0 +1,18 @@
+from django.db import models
+
+from .fields import EncryptedBinaryField
+from .models import EncryptedModel
+
+
+class EncryptedChunk(EncryptedModel):
+    """
+    A part of an encrypted blob, see ``pgrowcrypt.blobs``.
+    """
+    blob = models.UUIDField()
+    offset = models.BigIntegerField()
+    length = models.IntegerField()
+    data = EncryptedBinaryField()
+
+    class Meta:
+        app_label = 'pgrowcrypt'
+        unique_together = (('blob', 'offset'),)
@@ -0,0 +1,300 @@
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from itertools import islice
+
+from django.db import NotSupportedError
+from django.db.models.sql.compiler import SQLCompiler
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE, MULTI
+from django.db.models.sql.where import AND, WhereNode
+
+from .. import engine, instrumentation
+from .fields import DecryptedCol
+from .lazy import LazyDecryptionBatch
+from .prepared import get_statements
+
+
+class DecryptingSQLCompiler(SQLCompiler):
+    """
+    A compiler that decrypts every encrypted column only once per row, even if the
+    query references it in multiple places (e.g. in SELECT, WHERE and ORDER BY).
+
+    The query is compiled as usual first, counting the references to every encrypted
+    column. If a column is referenced more than once, the query is compiled again with
+    its decryption moved into a ``LATERAL`` subselect and all references pointing to
+    the decrypted value of that subselect. ``OFFSET 0`` prevents PostgreSQL from
+    pulling the subselect up into the outer query, which would duplicate the
+    decryption again.
+
+    With the Python engine, encrypted columns that are selected as they are are
+    fetched as ciphertext and decrypted by the application instead. With
+    ``lazy_decrypt()``, the model fields are fetched as ciphertext as well and only
+    decrypted once they are accessed.
+
+    Querysets returned by ``prepared()`` are executed as a prepared statement that is
+    only planned once per connection.
+
+    If the model has a ``KeyFingerprintField`` and a key is set, only the rows with the
+    fingerprint of that key are selected.
+
+    With ``with_keys()``, the list of keys is joined to the base table, so every row is
+    decrypted with its own key.
+    """
+    decrypted_alias = 'pgrowcrypt_decrypted'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.decrypted_refs = Counter()
+        self.decrypted_cols = OrderedDict()
+        self.hoisted_decryptions = OrderedDict()
+        self.decrypt_in_python = False
+        self.decrypt_lazily = False
+        self.python_decrypted_cols = OrderedDict()
+        self.lazy_cols = OrderedDict()
+        self.decryption_key = None
+        self.prepare = False
+        # The statement of the prepared query that has been compiled last
+        self.statement_key = None
+        # The clause that is being compiled, for the statistics of the query
+        self.clause = 'other'
+
+    @contextmanager
+    def in_clause(self, clause):
+        previous, self.clause = self.clause, clause
+        try:
+            yield
+        finally:
+            self.clause = previous
+
+    def compile(self, node, *args, **kwargs):
+        if node is not None and node is getattr(self, 'where', None):
+            with self.in_clause('where'):
+                return super().compile(node, *args, **kwargs)
+        if node is not None and node is getattr(self, 'having', None):
+            with self.in_clause('having'):
+                return super().compile(node, *args, **kwargs)
+        return super().compile(node, *args, **kwargs)
+
+    def get_order_by(self):
+        with self.in_clause('order_by'):
+            return super().get_order_by()
+
+    def get_group_by(self, *args, **kwargs):
+        with self.in_clause('group_by'):
+            return super().get_group_by(*args, **kwargs)
+
+    def get_base_alias(self, field):
+        """
+        Return the alias of the base table of the query if ``field`` is one of its columns.
+        """
+        if not self.query.alias_map:
+            return None
+        alias = next(iter(self.query.alias_map))
+        if self.query.alias_map[alias].table_name != field.model._meta.db_table:
+            # The field is on a parent model that is not part of this query
+            return None
+        return alias
+
+    def get_key_scope(self):
+        key = getattr(self.connection, '_pgrowcrypt_key', None)
+        get_field = getattr(self.query.model, 'get_key_fingerprint_field', None)
+        fingerprint_field = get_field() if key and get_field and self.query.row_keys is None else None
+        alias = self.get_base_alias(fingerprint_field) if fingerprint_field else None
+        if alias is None:
+            return None
+        return fingerprint_field.get_scope(alias, key)
+
+    def pre_sql_setup(self):
+        result = super().pre_sql_setup()
+        scope = self.get_key_scope()
+        if scope is not None:
+            self.where = WhereNode([self.where, scope], AND)
+        return result
+
+    def can_hoist_decryptions(self):
+        # With GROUP BY, PostgreSQL would not accept references to the subselect that are not
+        # grouped by themselves, and row locks cannot be applied to the subselect.
+        return not (self.query.group_by is not None or self.query.select_for_update or self.query.combinator)
+
+    def can_decrypt_in_python(self):
+        # Ciphertexts are salted, so the database can only group or deduplicate decrypted values,
+        # and the Python engine only decrypts with a single key.
+        return not (
+            self.query.group_by is not None or self.query.distinct or self.query.combinator or
+            self.query.row_keys is not None
+        )
+
+    def compile_decrypted_col(self, col):
+        instrumentation.record(self.connection, col.target, self.clause)
+        key = (col.alias, col.target)
+        if key in self.hoisted_decryptions:
+            return self.hoisted_decryptions[key], []
+        self.decrypted_refs[key] += 1
+        self.decrypted_cols.setdefault(key, col)
+        return col.as_decrypt_sql(self, self.connection)
+
+    def as_prepared_sql(self, *args, **kwargs):
+        self.prepare = False
+        try:
+            sql, params = self.as_sql(*args, **kwargs)
+        finally:
+            self.prepare = True
+        # The SQL identifies the statement, so a query derived from a prepared queryset
+        # (e.g. by get(), values() or another filter()) gets a statement of its own. The
+        # parameters, including the key, are those of this query.
+        self.connection.ensure_connection()
+        statements = get_statements(self.connection)
+        self.statement_key = (self.query.prepared_name, sql)
+        statement = statements.get(self.statement_key)
+        if statement is None:
+            with self.connection.cursor() as cursor:
+                statement = statements.prepare(cursor, self.statement_key, sql, len(params))
+        return statement.execute_sql, params
+
+    def as_sql(self, *args, **kwargs):
+        if self.prepare:
+            return self.as_prepared_sql(*args, **kwargs)
+        stats = instrumentation.checkpoint(self.connection)
+        result = super().as_sql(*args, **kwargs)
+        if self.hoisted_decryptions or not self.can_hoist_decryptions():
+            return result
+
+        hoist = [k for k, count in self.decrypted_refs.items() if count > 1 and k[0] in self.query.alias_map]
+        if not hoist:
+            return result
+
+        qn = self.quote_name_unless_alias
+        compiler = type(self)(self.query, self.connection, self.using)
+        compiler.decrypt_in_python, compiler.decrypt_lazily = self.decrypt_in_python, self.decrypt_lazily
+        for i, key in enumerate(hoist):
+            compiler.decrypted_cols[key] = self.decrypted_cols[key]
+            compiler.hoisted_decryptions[key] = '{}.{}'.format(qn(self.decrypted_alias), qn('d{}'.format(i)))
+        # Only the second compilation ends up in the query
+        instrumentation.rollback(self.connection, stats)
+        sql, params = compiler.as_sql(*args, **kwargs)
+        # The caller reads the selected columns from this compiler
+        self.select, self.klass_info, self.annotation_col_map = (
+            compiler.select, compiler.klass_info, compiler.annotation_col_map
+        )
+        self.python_decrypted_cols, self.lazy_cols = compiler.python_decrypted_cols, compiler.lazy_cols
+        self.decryption_key = compiler.decryption_key
+        return sql, params
+
+    def execute_sql(self, result_type=MULTI, chunked_fetch=False, chunk_size=GET_ITERATOR_CHUNK_SIZE):
+        # Only queries whose results we read ourselves can be decrypted in Python, not subqueries
+        self.decrypt_in_python = engine.client_side() and self.can_decrypt_in_python()
+        self.decrypt_lazily = self.query.lazy_decrypt and self.can_decrypt_in_python()
+        # The keys of with_keys() are part of the statement, and a server-side cursor
+        # cannot be declared for EXECUTE
+        self.prepare = (
+            self.query.prepared_name is not None and result_type == MULTI and self.query.row_keys is None and
+            not chunked_fetch
+        )
+        try:
+            return super().execute_sql(result_type, chunked_fetch, chunk_size)
+        except NotSupportedError as e:
+            if not self.prepare or 'cached plan must not change result type' not in str(e):
+                raise
+            # The schema has changed under the statement since it has been prepared
+            get_statements(self.connection).discard(self.statement_key)
+            if self.connection.in_atomic_block:
+                # The transaction has failed, only the next query can prepare it again
+                raise
+        return super().execute_sql(result_type, chunked_fetch, chunk_size)
+
+    def get_model_select_fields(self, klass_info):
+        if not klass_info or not self.query.default_cols:
+            # values() and values_list() don't return model instances
+            return set()
+        fields = set(klass_info['select_fields'])
+        for related_klass_info in klass_info.get('related_klass_infos', []):
+            fields |= self.get_model_select_fields(related_klass_info)
+        return fields
+
+    def get_select(self):
+        with self.in_clause('select'):
+            ret, klass_info, annotations = super().get_select()
+        if not self.decrypt_in_python and not self.decrypt_lazily:
+            return ret, klass_info, annotations
+
+        self.decryption_key = getattr(self.connection, '_pgrowcrypt_key', None) or ' '
+        model_fields = self.get_model_select_fields(klass_info) if self.decrypt_lazily else set()
+        ret = list(ret)
+        for i, (col, _, alias) in enumerate(ret):
+            if not isinstance(col, DecryptedCol):
+                continue
+            if i in model_fields:
+                self.lazy_cols[i] = col
+            elif self.decrypt_in_python:
+                self.python_decrypted_cols[i] = col
+            else:
+                continue
+            # Select the ciphertext instead and don't count this reference for hoisting
+            self.decrypted_refs[(col.alias, col.target)] -= 1
+            instrumentation.record(
+                self.connection, decryptions=-1, client_decryptions=1 if i in self.python_decrypted_cols else 0
+            )
+            ret[i] = (col, self.compile(col.raw_col), alias)
+        return ret, klass_info, annotations
+
+    def get_converters(self, expressions):
+        converters = super().get_converters(expressions)
+        for i in list(self.python_decrypted_cols) + list(self.lazy_cols):
+            converters.setdefault(i, ([], expressions[i]))
+        return converters
+
+    def apply_converters(self, rows, converters):
+        if self.python_decrypted_cols:
+            rows = self.decrypt_rows(rows)
+        if self.lazy_cols:
+            rows = self.wrap_lazy_rows(rows)
+        return super().apply_converters(rows, converters)
+
+    def wrap_lazy_rows(self, rows):
+        batch = LazyDecryptionBatch(self.connection.alias, self.decryption_key)
+        cols = list(self.lazy_cols.items())
+        for row in rows:
+            row = list(row)
+            for i, col in cols:
+                row[i] = batch.add(col.target, row[i])
+            yield row
+
+    def decrypt_rows(self, rows):
+        cols = list(self.python_decrypted_cols.items())
+        rows = iter(rows)
+        while True:
+            chunk = [list(row) for row in islice(rows, engine.batch_size())]
+            if not chunk:
+                return
+            values = iter(engine.decrypt_values([
+                (row[i], self.decryption_key, col.target.ciphertext_format) for row in chunk for i, col in cols
+            ]))
+            for row in chunk:
+                for i, col in cols:
+                    row[i] = col.target.to_python(next(values))
+                yield row
+
+    def get_from_clause(self):
+        result, params = super().get_from_clause()
+        row_keys = self.query.row_keys
+        if row_keys is not None:
+            alias = self.get_base_alias(row_keys.field)
+            if alias is None:
+                raise ValueError("The keys can only be chosen by a column of the table of {}.".format(
+                    self.query.model._meta.label
+                ))
+            selector_sql, selector_params = self.compile(row_keys.field.get_col(alias))
+            join_sql, join_params = row_keys.join_sql(self.connection, selector_sql)
+            result[-1] += join_sql
+            params = list(params) + join_params + list(selector_params)
+        if not self.hoisted_decryptions:
+            return result, params
+
+        columns = []
+        params = list(params)
+        qn = self.quote_name_unless_alias
+        for i, key in enumerate(self.hoisted_decryptions):
+            col_sql, col_params = self.decrypted_cols[key].as_decrypt_sql(self, self.connection)
+            columns.append('{} AS {}'.format(col_sql, qn('d{}'.format(i))))
+            params.extend(col_params)
+        result.append(', LATERAL (SELECT {} OFFSET 0) {}'.format(', '.join(columns), qn(self.decrypted_alias)))
+        return result, params
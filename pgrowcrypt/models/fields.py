@@ -1,16 +1,38 @@
+from django.conf import settings
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 from django.core import checks
 from django.core.exceptions import ImproperlyConfigured
 from django.db import models
 from django.db.models.expressions import Col, Expression, Func, Value
+from django.db.models.lookups import (
+    Contains, Exact, IContains, IExact, In, IStartsWith, StartsWith,
+)
+from django.db.models.sql.compiler import SQLUpdateCompiler
+from django.utils.datastructures import OrderedSet
 from django.utils.functional import cached_property
 
+from .. import engine, instrumentation, pgp
+from ..crypto import (
+    AES_ENCRYPTION_KEY, AES_MAC_KEY, BLIND_INDEX_KEY,
+    DETERMINISTIC_ENCRYPTION_KEY, DETERMINISTIC_IV_KEY, SEARCH_INDEX_KEY,
+    key_fingerprint,
+)
+from .keys import RowKeys, get_query_key, key_sql
+
 
 class EncryptionValueWrapper(Func):
+    sql_template = "pgp_sym_encrypt({value}::text, {key}{options})"
+    # The counter of QueryStats this expression adds to
+    stats_name = 'encryptions'
+    # The purpose of the key derived from the key of the row, or None for the key itself
+    key_purpose = None
 
-    def __init__(self, value, key, **extra):
+    def __init__(self, value, key, options=None, **extra):
         self.value = value
         self.key = key
-        if not isinstance(value, Expression):
+        self.options = options
+        if not hasattr(value, 'resolve_expression'):
             value = Value(value)
         super().__init__(value, **extra)
 
@@ -20,7 +42,12 @@ class EncryptionValueWrapper(Func):
     def __repr__(self):
         return "EncryptionValueWrapper(%r, key)" % self.value
 
+    def record(self, connection):
+        if self.stats_name:
+            instrumentation.record(connection, **{self.stats_name: 1})
+
     def as_sql(self, compiler, connection):
+        self.record(connection)
         sql_parts = []
         params = []
         for arg in self.source_expressions:
@@ -28,21 +55,363 @@ class EncryptionValueWrapper(Func):
             sql_parts.append(arg_sql)
             params.extend(arg_params)
 
-        params.append(self.key)
-        return "pgp_sym_encrypt({}::text, %s)".format(', '.join(sql_parts)), params
+        key_sql_, key_params = key_sql(connection, self.key, self.key_purpose)
+        params.extend(key_params)
+        options_sql = ''
+        if self.options:
+            options_sql = ', %s'
+            params.append(pgp.options_string(self.options))
+        return self.sql_template.format(value=', '.join(sql_parts), key=key_sql_, options=options_sql), params
 
 
-class EncryptedField(models.Field):
+class BlindIndexValueWrapper(EncryptionValueWrapper):
+    """
+    Computes the blind index value of the plaintext, normalized to lowercase with all runs
+    of whitespace collapsed to a single space and stripped at both ends, with a key of its
+    own.
+    """
+    sql_template = (
+        "hmac(convert_to(lower(btrim(regexp_replace({value}::text, '\\s+', ' ', 'g'))), 'UTF8'), {key}, 'sha256')"
+    )
+    stats_name = None
+    key_purpose = BLIND_INDEX_KEY
+
+    def __repr__(self):
+        return "BlindIndexValueWrapper(%r, key)" % self.value
+
+
+class DeterministicEncryptionValueWrapper(EncryptionValueWrapper):
+    """
+    Encrypts with AES-256-CBC and a synthetic IV derived from the plaintext, so equal
+    plaintexts encrypted with the same key result in equal ciphertexts. The output is
+    prefixed with a format byte so it can be told apart from a PGP message.
+    """
+    sql_template = (
+        "(SELECT '\\x01'::bytea || s.iv || encrypt_iv(s.d, s.ek, s.iv, 'aes-cbc/pad:pkcs') FROM ("
+        "SELECT s0.d, s0.ek, substring(hmac(s0.d, s0.mk, 'sha256') from 1 for 16) AS iv FROM ("
+        "SELECT convert_to({value}::text, 'UTF8') AS d, {ek}::bytea AS ek, {mk}::bytea AS mk"
+        ") s0) s)"
+    )
+
+    def __repr__(self):
+        return "DeterministicEncryptionValueWrapper(%r, key)" % self.value
+
+    def as_sql(self, compiler, connection):
+        self.record(connection)
+        sql, params = compiler.compile(self.source_expressions[0])
+        params = list(params)
+        ek_sql, ek_params = key_sql(connection, self.key, DETERMINISTIC_ENCRYPTION_KEY)
+        mk_sql, mk_params = key_sql(connection, self.key, DETERMINISTIC_IV_KEY)
+        params.extend(ek_params)
+        params.extend(mk_params)
+        return self.sql_template.format(value=sql, ek=ek_sql, mk=mk_sql), params
+
+
+class BinaryEncryptionValueWrapper(EncryptionValueWrapper):
+    sql_template = "pgp_sym_encrypt_bytea({value}::bytea, {key}{options})"
+
+    def __repr__(self):
+        return "BinaryEncryptionValueWrapper(%r, key)" % self.value
+
+
+class AESEncryptionValueWrapper(EncryptionValueWrapper):
+    """
+    Encrypts with AES-256-CBC, a random IV and a raw key that is derived from the key
+    once in the application, so no key derivation happens per row, and appends a
+    HMAC-SHA256 of the result with another derived key. The output is prefixed with a
+    format byte so it can be told apart from a PGP message.
+    """
+    sql_template = (
+        "(SELECT s.c || hmac(s.c, {mk}::bytea, 'sha256') FROM ("
+        "SELECT '\\x02'::bytea || s0.iv || encrypt_iv(convert_to({value}::text, 'UTF8'), {ek}::bytea, s0.iv, "
+        "'aes-cbc/pad:pkcs') AS c FROM (SELECT gen_random_bytes(16) AS iv{correlation}) s0) s)"
+    )
+
+    def __repr__(self):
+        return "AESEncryptionValueWrapper(%r, key)" % self.value
+
+    def as_sql(self, compiler, connection):
+        self.record(connection)
+        sql, params = compiler.compile(self.source_expressions[0])
+        ek_sql, ek_params = key_sql(connection, self.key, AES_ENCRYPTION_KEY)
+        mk_sql, mk_params = key_sql(connection, self.key, AES_MAC_KEY)
+        correlation = ''
+        if isinstance(compiler, SQLUpdateCompiler):
+            # PostgreSQL evaluates a subquery that doesn't refer to the updated row only
+            # once per statement, which would give all rows the same IV
+            correlation = ' WHERE {}.ctid IS NOT NULL'.format(compiler.quote_name_unless_alias(compiler.query.base_table))
+        return self.sql_template.format(value=sql, ek=ek_sql, mk=mk_sql, correlation=correlation), (
+            list(mk_params) + list(params) + list(ek_params)
+        )
+
+
+class ClientEncryptedValue(EncryptionValueWrapper):
+    """
+    A value that has already been encrypted outside of the database.
+    """
+    stats_name = 'client_encryptions'
+
+    def __init__(self, value, key, ciphertext, **extra):
+        self.ciphertext = ciphertext
+        super().__init__(value, key, **extra)
+
+    def __repr__(self):
+        return "ClientEncryptedValue(%r, key)" % self.value
+
+    def as_sql(self, compiler, connection):
+        self.record(connection)
+        return '%s', [self.ciphertext]
+
+
+class SearchIndexValueWrapper(EncryptionValueWrapper):
+    sql_template = (
+        "ARRAY(SELECT DISTINCT hmac(convert_to(substr(s.v, i, 3), 'UTF8'), s.k, 'sha256') "
+        "FROM (SELECT lower({value}::text) AS v, {key}::bytea AS k) s, generate_series(1, length(s.v) - 2) i)"
+    )
+    stats_name = None
+    key_purpose = SEARCH_INDEX_KEY
+
+    def __repr__(self):
+        return "SearchIndexValueWrapper(%r, key)" % self.value
+
+
+class IndexFieldMixin:
+    """
+    Common behaviour of the columns that hold index data for the ``EncryptedField``
+    named ``source``.
+    """
+
+    def __init__(self, *args, source=None, **kwargs):
+        self.source = source
+        kwargs.setdefault('null', True)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['source'] = self.source
+        return name, path, args, kwargs
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        # The encrypted field adds us on its own, but migration states also contain
+        # us explicitly, so we must not end up on the model twice.
+        if any(f.name == name for f in cls._meta.local_fields):
+            return
+        super().contribute_to_class(cls, name, **kwargs)
+
+
+class BlindIndexField(IndexFieldMixin, models.BinaryField):
+    """
+    Stores a keyed HMAC of the plaintext of an ``EncryptedField`` so equality lookups
+    can be answered through a regular B-tree index. Added automatically by
+    ``EncryptedField(blind_index=True)``.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('db_index', True)
+        super().__init__(*args, **kwargs)
+
+
+class SearchIndexField(IndexFieldMixin, ArrayField):
+    """
+    Stores keyed HMACs of all trigrams of the lowercased plaintext of an ``EncryptedField``
+    so substring lookups can be narrowed down through a GIN index. Added automatically by
+    ``EncryptedField(search_index=True)``, the index needs to be declared with
+    ``search_index()``.
+    """
 
     def __init__(self, *args, **kwargs):
-        for k in ('primary_key', 'unique', 'db_index'):
-            if kwargs.get('primary_key'):
+        kwargs['base_field'] = models.BinaryField()
+        kwargs.setdefault('editable', False)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        del kwargs['base_field']
+        del kwargs['size']
+        return name, path, args, kwargs
+
+
+def search_index(name):
+    """
+    Return the GIN index of the search index column of the encrypted field ``name``, to
+    be added to the ``indexes`` of the model's ``Meta``.
+    """
+    return GinIndex(fields=['{}_sidx'.format(name)])
+
+
+class KeyFingerprintField(models.BinaryField):
+    """
+    Stores a fingerprint of the key every row is encrypted with, so queries with a key
+    can skip the rows of all other keys through a regular B-tree index instead of
+    trying to decrypt them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('db_index', True)
+        kwargs.setdefault('null', True)
+        super().__init__(*args, **kwargs)
+
+    def get_scope(self, alias, key):
+        """
+        Return a condition that matches the rows of the table ``alias`` that are
+        encrypted with ``key``, or that have been written before this field was added.
+        """
+        return KeyFingerprintMatch(self.get_col(alias), key)
+
+
+class KeyFingerprintMatch(Expression):
+    contains_aggregate = False
+
+    def __init__(self, col, key):
+        super().__init__(output_field=models.BooleanField())
+        self.col = col
+        self.key = key
+
+    def __repr__(self):
+        return "KeyFingerprintMatch(%r, key)" % self.col
+
+    def as_sql(self, compiler, connection):
+        col_sql, col_params = compiler.compile(self.col)
+        return '({0} = %s OR {0} IS NULL)'.format(col_sql), (
+            list(col_params) + [key_fingerprint(self.key)] + list(col_params)
+        )
+
+
+class EncryptedField(models.Field):
+    formats = (engine.FORMAT_PGP, engine.FORMAT_AES)
+    encryption_wrapper = EncryptionValueWrapper
+
+    def __init__(self, *args, blind_index=False, search_index=False, deterministic=False, format=engine.FORMAT_PGP,
+                 cipher=None, s2k_mode=None, s2k_count=None, s2k_digest=None, compress=None, compress_level=None,
+                 **kwargs):
+        # Salted ciphertexts can't be compared, so only deterministic fields can be indexed
+        for k in ('primary_key',) if deterministic else ('primary_key', 'unique', 'db_index'):
+            if kwargs.get(k):
                 raise ImproperlyConfigured(
                     "CryptedTextField does not support {}.".format(k)
                 )
+        if deterministic and blind_index:
+            raise ImproperlyConfigured(
+                "A deterministic CryptedTextField can be compared directly and does not need a blind index."
+            )
 
+        pgp_options = {
+            'cipher': cipher, 's2k_mode': s2k_mode, 's2k_count': s2k_count, 's2k_digest': s2k_digest,
+            'compress': compress, 'compress_level': compress_level,
+        }
+        self.pgp_options = {k: v for k, v in pgp_options.items() if v is not None}
+        if format not in self.formats:
+            raise ImproperlyConfigured("Unknown format {!r} for CryptedTextField.".format(format))
+        if deterministic and format != engine.FORMAT_PGP:
+            raise ImproperlyConfigured("A deterministic CryptedTextField has a format of its own.")
+        if (deterministic or format != engine.FORMAT_PGP) and self.pgp_options:
+            raise ImproperlyConfigured("Only CryptedTextFields in the PGP format can have PGP options.")
+        try:
+            pgp.check_options(self.pgp_options)
+        except pgp.PGPError as e:
+            raise ImproperlyConfigured(str(e))
+
+        self.blind_index = blind_index
+        self.search_index = search_index
+        self.deterministic = deterministic
+        self.format = format
         super().__init__(*args, **kwargs)
 
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.deterministic:
+            kwargs['deterministic'] = True
+        if self.blind_index:
+            kwargs['blind_index'] = True
+        if self.search_index:
+            kwargs['search_index'] = True
+        if self.format != engine.FORMAT_PGP:
+            kwargs['format'] = self.format
+        kwargs.update(self.pgp_options)
+        return name, path, args, kwargs
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        from .lazy import EncryptedFieldDescriptor
+
+        super().contribute_to_class(cls, name, **kwargs)
+        descriptor = next((c.__dict__[self.attname] for c in cls.__mro__ if self.attname in c.__dict__), None)
+        setattr(cls, self.attname, EncryptedFieldDescriptor(self, descriptor))
+        if not cls._meta.abstract:
+            if self.blind_index:
+                BlindIndexField(source=name).contribute_to_class(cls, self.blind_index_name)
+            if self.search_index:
+                SearchIndexField(source=name).contribute_to_class(cls, self.search_index_name)
+
+    @property
+    def blind_index_name(self):
+        return '{}_bidx'.format(self.name)
+
+    @property
+    def search_index_name(self):
+        return '{}_sidx'.format(self.name)
+
+    @property
+    def companion_names(self):
+        """
+        The names of the index columns that are maintained together with this field.
+        """
+        names = []
+        if self.blind_index:
+            names.append(self.blind_index_name)
+        if self.search_index:
+            names.append(self.search_index_name)
+        return names
+
+    @property
+    def ciphertext_format(self):
+        """
+        The format new values of this field are encrypted in.
+        """
+        return engine.FORMAT_DETERMINISTIC if self.deterministic else self.format
+
+    def get_pgp_options(self):
+        """
+        Return the options for ``pgp_sym_encrypt()``, i.e. the ``PGROWCRYPT_PGP_OPTIONS``
+        setting overridden by the options of this field.
+        """
+        if self.deterministic or self.format != engine.FORMAT_PGP:
+            return {}
+        options = dict(getattr(settings, 'PGROWCRYPT_PGP_OPTIONS', {}))
+        options.update(self.pgp_options)
+        return options
+
+    def get_encryption_job(self, value, key):
+        """
+        Return the job to encrypt ``value`` with ``key`` with the Python engine.
+        """
+        return value, key, self.ciphertext_format, self.get_pgp_options()
+
+    def get_encrypted_value(self, value, key):
+        """
+        Return an expression that encrypts ``value`` with ``key``, either inside the
+        database or, with the Python engine, right away.
+        """
+        if engine.client_side() and not hasattr(value, 'resolve_expression') and not isinstance(key, RowKeys):
+            ciphertext, = engine.encrypt_values([self.get_encryption_job(value, key)])
+            return ClientEncryptedValue(value, key, ciphertext)
+        if self.deterministic:
+            return DeterministicEncryptionValueWrapper(value, key)
+        if self.format == engine.FORMAT_AES:
+            return AESEncryptionValueWrapper(value, key)
+        return self.encryption_wrapper(value, key, self.get_pgp_options())
+
+    def get_companion_values(self, value, key):
+        """
+        Return a dictionary of values for the index columns that need to be written
+        together with ``value``.
+        """
+        values = {}
+        if self.blind_index:
+            values[self.blind_index_name] = BlindIndexValueWrapper(value, key)
+        if self.search_index:
+            values[self.search_index_name] = SearchIndexValueWrapper(value, key)
+        return values
+
     def db_type(self, connection):
         return 'bytea'
 
@@ -70,8 +439,37 @@ class EncryptedField(models.Field):
     def check(self, **kwargs):
         errors = super().check(**kwargs)
         errors.extend(self._check_model_class())
+        errors.extend(self._check_search_index())
+        errors.extend(self._check_pgp_options())
         return errors
 
+    def _check_pgp_options(self):
+        try:
+            pgp.check_options(self.get_pgp_options())
+        except pgp.PGPError as e:
+            return [
+                checks.Error(
+                    'Invalid PGROWCRYPT_PGP_OPTIONS setting: {}'.format(e),
+                    obj=self,
+                    id='pgrowcrypt.E003',
+                ),
+            ]
+        return []
+
+    def _check_search_index(self):
+        if not self.search_index or any(
+            index.fields == [self.search_index_name] for index in self.model._meta.indexes
+        ):
+            return []
+        return [
+            checks.Warning(
+                'The search index of {} has no GIN index.'.format(self.name),
+                hint="Add search_index('{}') to the indexes in the Meta of the model.".format(self.name),
+                obj=self,
+                id='pgrowcrypt.W001',
+            ),
+        ]
+
     def _check_model_class(self):
         from .models import EncryptedModel
 
@@ -94,22 +492,260 @@ class EncryptedField(models.Field):
 
 
 class DecryptedCol(Col):
-    decrypt_sql_template = "pgp_sym_decrypt({sql}, %s)::{dbtype}"
+    decrypt_sql_template = "pgp_sym_decrypt({sql}, {key})::{dbtype}"
+    deterministic_decrypt_sql_template = (
+        "convert_from(decrypt_iv(substring({sql} from 18), {key}, substring({sql} from 2 for 16), "
+        "'aes-cbc/pad:pkcs'), 'UTF8')::{dbtype}"
+    )
+    binary_decrypt_sql_template = "pgp_sym_decrypt_bytea({sql}, {key})"
+    # Columns switched to the AES format may still contain PGP messages. If the HMAC does not
+    # match, decrypt_iv() fails on a ciphertext that is shorter than a block.
+    aes_decrypt_sql_template = (
+        "(CASE WHEN get_byte({sql}, 0) = 2 THEN convert_from(decrypt_iv("
+        "CASE WHEN hmac(substring({sql} from 1 for length({sql}) - 32), {mk}, 'sha256') = "
+        "substring({sql} from length({sql}) - 31) THEN substring({sql} from 18 for length({sql}) - 49) "
+        "ELSE '\\x00'::bytea END, {ek}, substring({sql} from 2 for 16), 'aes-cbc/pad:pkcs'), 'UTF8') "
+        "ELSE pgp_sym_decrypt({sql}, {key}) END)::{dbtype}"
+    )
 
     def __init__(self, alias, target, output_field=None):
         self.target = target
         super(DecryptedCol, self).__init__(alias, target, output_field)
 
+    @property
+    def raw_col(self):
+        """
+        A column expression that refers to the stored ciphertext.
+        """
+        return Col(self.alias, self.target)
+
     def as_sql(self, compiler, connection):
+        if hasattr(compiler, 'compile_decrypted_col'):
+            # The compiler may want to replace us with a reference to a column that is already decrypted
+            return compiler.compile_decrypted_col(self)
+        instrumentation.record(connection, self.target, 'other')
+        return self.as_decrypt_sql(compiler, connection)
+
+    def as_decrypt_sql(self, compiler, connection):
         sql, params = super(DecryptedCol, self).as_sql(compiler, connection)
-        decrypt_sql = self.decrypt_sql_template.format(
-            dbtype=self.target._get_base_db_type(connection),
-            sql=sql
-        )
+        key = get_query_key(compiler, connection) or ' '
+        decrypt_sql, key_params = self.decrypt_sql(self.target, sql, connection, key)
         params = list(params)
-        params.append(getattr(connection, '_pgrowcrypt_key', '') or ' ')
+        params.extend(key_params)
         return decrypt_sql, tuple(params)
 
+    @classmethod
+    def decrypt_sql(cls, field, sql, connection, key):
+        """
+        Return the SQL that decrypts the ciphertext ``sql`` of ``field`` and the
+        parameters it needs for the key.
+        """
+        instrumentation.record(connection, decryptions=1)
+        if field.ciphertext_format == engine.FORMAT_PGP_BYTEA:
+            key_sql_, key_params = key_sql(connection, key)
+            return cls.binary_decrypt_sql_template.format(sql=sql, key=key_sql_), key_params
+        if field.deterministic:
+            template = cls.deterministic_decrypt_sql_template
+            key_sql_, key_params = key_sql(connection, key, DETERMINISTIC_ENCRYPTION_KEY)
+        elif field.format == engine.FORMAT_AES:
+            ek_sql, ek_params = key_sql(connection, key, AES_ENCRYPTION_KEY)
+            mk_sql, mk_params = key_sql(connection, key, AES_MAC_KEY)
+            key_sql_, key_params = key_sql(connection, key)
+            return cls.aes_decrypt_sql_template.format(
+                dbtype=field._get_base_db_type(connection), sql=sql, ek=ek_sql, mk=mk_sql, key=key_sql_
+            ), list(mk_params) + list(ek_params) + list(key_params)
+        else:
+            template = cls.decrypt_sql_template
+            key_sql_, key_params = key_sql(connection, key)
+        return template.format(dbtype=field._get_base_db_type(connection), sql=sql, key=key_sql_), key_params
+
+    def get_group_by_cols(self, alias=None):
+        if self.target.deterministic:
+            # Equal plaintexts have equal ciphertexts, so we can group without decrypting
+            return [self.raw_col]
+        return [self]
+
+
+def get_lookup_values(lookup):
+    """
+    Return the distinct values on the right-hand side of an exact or ``__in`` lookup.
+    """
+    if isinstance(lookup, In):
+        return list(OrderedSet(lookup.rhs))
+    return [lookup.rhs]
+
+
+class IndexLookupMixin:
+    """
+    Narrows down a lookup on an encrypted field through one of its index columns if
+    the field has the index enabled. The comparison on the decrypted value is kept
+    as a recheck. Rows without an index value, e.g. from before the index has been
+    enabled, are always rechecked.
+    """
+    index_option = None
+
+    def rhs_is_value(self):
+        return self.rhs_is_direct_value()
+
+    def get_index_condition(self, compiler, index_col, key):
+        """
+        Return the SQL and parameters of a condition on the index column ``index_col``
+        that narrows down the rows, or None if the lookup can't use the index.
+        """
+        return None
+
+    def as_sql(self, compiler, connection):
+        sql, params = super().as_sql(compiler, connection)
+        key = get_query_key(compiler, connection)
+        if not key or not self.rhs_is_value() or not isinstance(self.lhs, DecryptedCol):
+            return sql, params
+        field = self.lhs.target
+        if not getattr(field, self.index_option, False):
+            return sql, params
+
+        index_field = field.model._meta.get_field(getattr(field, '{}_name'.format(self.index_option)))
+        index_col = index_field.get_col(self.lhs.alias)
+        condition = self.get_index_condition(compiler, index_col, key)
+        if condition is None:
+            return sql, params
+        index_sql, index_params = condition
+        col_sql, col_params = compiler.compile(index_col)
+        return '(({} OR {} IS NULL) AND {})'.format(index_sql, col_sql, sql), (
+            list(index_params) + list(col_params) + list(params)
+        )
+
+
+class BlindIndexLookupMixin(IndexLookupMixin):
+    index_option = 'blind_index'
+
+    def get_index_condition(self, compiler, index_col, key):
+        values = [v for v in get_lookup_values(self) if v is not None]
+        if not values:
+            return None
+
+        index_sql, index_params = compiler.compile(index_col)
+        index_params = list(index_params)
+        value_sqls = []
+        for v in values:
+            value_sql, value_params = compiler.compile(BlindIndexValueWrapper(v, key))
+            value_sqls.append(value_sql)
+            index_params.extend(value_params)
+        if len(value_sqls) == 1:
+            return '{} = {}'.format(index_sql, value_sqls[0]), index_params
+        return '{} IN ({})'.format(index_sql, ', '.join(value_sqls)), index_params
+
+
+class DeterministicLookupMixin:
+    """
+    Compares the ciphertext of a deterministic field with the encrypted right-hand side
+    (or the ciphertext of another deterministic field) instead of decrypting every row.
+    """
+
+    def rhs_is_value(self):
+        return self.rhs_is_direct_value()
+
+    def as_sql(self, compiler, connection):
+        if not isinstance(self.lhs, DecryptedCol) or not self.lhs.target.deterministic:
+            return super().as_sql(compiler, connection)
+
+        if self.rhs_is_value():
+            key = get_query_key(compiler, connection) or ' '
+            values = [v for v in get_lookup_values(self) if v is not None]
+            if not values:
+                return super().as_sql(compiler, connection)
+            rhs_sqls = []
+            rhs_params = []
+            for v in values:
+                value_sql, value_params = compiler.compile(self.lhs.target.get_encrypted_value(v, key))
+                rhs_sqls.append(value_sql)
+                rhs_params.extend(value_params)
+        elif isinstance(self.rhs, DecryptedCol) and self.rhs.target.deterministic:
+            rhs_sql, rhs_params = compiler.compile(self.rhs.raw_col)
+            rhs_sqls = [rhs_sql]
+        else:
+            return super().as_sql(compiler, connection)
+
+        lhs_sql, lhs_params = compiler.compile(self.lhs.raw_col)
+        params = list(lhs_params) + list(rhs_params)
+        if len(rhs_sqls) == 1:
+            return '{} = {}'.format(lhs_sql, rhs_sqls[0]), params
+        return '{} IN ({})'.format(lhs_sql, ', '.join(rhs_sqls)), params
+
+
+class EncryptedExact(DeterministicLookupMixin, BlindIndexLookupMixin, Exact):
+    pass
+
+
+class EncryptedIExact(BlindIndexLookupMixin, IExact):
+    pass
+
+
+class EncryptedIn(DeterministicLookupMixin, BlindIndexLookupMixin, In):
+    pass
+
+
+class SearchIndexLookupMixin(IndexLookupMixin):
+    index_option = 'search_index'
+
+    def get_index_condition(self, compiler, index_col, key):
+        value = str(self.rhs)
+        if len(value) < 3:
+            # No trigrams to look for
+            return None
+
+        index_sql, index_params = compiler.compile(index_col)
+        value_sql, value_params = compiler.compile(SearchIndexValueWrapper(value, key))
+        return '{} @> {}'.format(index_sql, value_sql), list(index_params) + list(value_params)
+
+
+class SearchIndexContains(SearchIndexLookupMixin, Contains):
+    pass
+
+
+class SearchIndexIContains(SearchIndexLookupMixin, IContains):
+    pass
+
+
+class SearchIndexStartsWith(SearchIndexLookupMixin, StartsWith):
+    pass
+
+
+class SearchIndexIStartsWith(SearchIndexLookupMixin, IStartsWith):
+    pass
+
+
+for lookup in (EncryptedExact, EncryptedIExact, EncryptedIn, SearchIndexContains, SearchIndexIContains,
+               SearchIndexStartsWith, SearchIndexIStartsWith):
+    EncryptedField.register_lookup(lookup)
+
 
 class EncryptedTextField(EncryptedField, models.TextField):
     pass
+
+
+class EncryptedBinaryField(EncryptedField, models.BinaryField):
+    """
+    Stores binary data as a PGP message, like ``pgp_sym_encrypt_bytea()`` does. Values
+    are read as ``bytes``. For values of many megabytes, see ``pgrowcrypt.blobs``.
+    """
+    formats = (engine.FORMAT_PGP,)
+    encryption_wrapper = BinaryEncryptionValueWrapper
+
+    def __init__(self, *args, **kwargs):
+        for k in ('deterministic', 'blind_index', 'search_index'):
+            if kwargs.get(k):
+                raise ImproperlyConfigured("EncryptedBinaryField does not support {}.".format(k))
+        super().__init__(*args, **kwargs)
+
+    @property
+    def ciphertext_format(self):
+        return engine.FORMAT_PGP_BYTEA
+
+    def from_db_value(self, value, expression, connection, *args):
+        # psycopg2 returns bytea values as memoryviews
+        return bytes(value) if isinstance(value, memoryview) else value
+
+    def to_python(self, value):
+        if isinstance(value, memoryview):
+            return bytes(value)
+        return super().to_python(value)
@@ -0,0 +1,275 @@
+import binascii
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from psycopg2.extensions import TRANSACTION_STATUS_INERROR
+
+from ..crypto import (
+    AES_ENCRYPTION_KEY, AES_MAC_KEY, BLIND_INDEX_KEY,
+    DETERMINISTIC_ENCRYPTION_KEY, DETERMINISTIC_IV_KEY, SEARCH_INDEX_KEY,
+    derive_key,
+)
+from ..instrumentation import instrument
+
+try:
+    from contextvars import ContextVar
+except ImportError:  # pragma: no cover
+    ContextVar = None
+
+# The configuration parameters the key is stored in with PGROWCRYPT_KEY_MODE = 'setting',
+# by purpose of the derived key (or None for the key itself)
+KEY_SETTINGS = (
+    (None, 'pgrowcrypt.key'),
+    (DETERMINISTIC_ENCRYPTION_KEY, 'pgrowcrypt.deterministic_encryption_key'),
+    (DETERMINISTIC_IV_KEY, 'pgrowcrypt.deterministic_iv_key'),
+    (AES_ENCRYPTION_KEY, 'pgrowcrypt.aes_encryption_key'),
+    (AES_MAC_KEY, 'pgrowcrypt.aes_mac_key'),
+    (BLIND_INDEX_KEY, 'pgrowcrypt.blind_index_key'),
+    (SEARCH_INDEX_KEY, 'pgrowcrypt.search_index_key'),
+)
+
+
+class RowKeys:
+    """
+    The keys of a query that decrypts every row with its own key, chosen by the value of
+    the column of ``field``. ``keys`` maps the values of that column to keys.
+
+    The keys are joined to the query as a list of rows of the selector value, the key
+    and the keys derived from it, so every reference to the key becomes a reference to
+    the matching column of the joined row.
+    """
+    alias = 'pgrowcrypt_keys'
+
+    def __init__(self, field, keys):
+        self.field = field
+        self.keys = {self.normalize(v): k for v, k in keys.items()}
+
+    @staticmethod
+    def normalize(value):
+        # bytea values are read as memoryview, which can't be hashed
+        return bytes(value) if isinstance(value, memoryview) else value
+
+    def column(self, purpose=None):
+        return 'k{}'.format([p for p, name in KEY_SETTINGS].index(purpose))
+
+    def key_sql(self, purpose=None):
+        return '{}.{}'.format(self.alias, self.column(purpose))
+
+    def join_sql(self, connection, selector_sql):
+        """
+        Return the SQL and parameters of the join of the list of keys to the rows whose
+        selector column is ``selector_sql``.
+        """
+        selectors = list(self.keys)
+        params = [[self.field.get_db_prep_value(v, connection) for v in selectors]]
+        types = [self.field.rel_db_type(connection)]
+        for purpose, name in KEY_SETTINGS:
+            if purpose is None:
+                params.append([self.keys[v] for v in selectors])
+                types.append('text')
+            else:
+                params.append([derive_key(self.keys[v], purpose) for v in selectors])
+                types.append('bytea')
+        sql = ' INNER JOIN unnest({}) {}(s, {}) ON ({}.s = {})'.format(
+            ', '.join('%s::{}[]'.format(t) for t in types), self.alias,
+            ', '.join(self.column(purpose) for purpose, name in KEY_SETTINGS), self.alias, selector_sql
+        )
+        return sql, params
+
+    def get_key(self, obj):
+        """
+        Return the key of the row of the model instance ``obj``, if its selector is loaded.
+        """
+        if self.field.attname not in obj.__dict__:
+            return None
+        return self.keys.get(self.normalize(obj.__dict__[self.field.attname]))
+
+
+class _ThreadLocalVar(threading.local):
+    """
+    A stand-in for ``ContextVar`` on Python < 3.7, bound to the current thread.
+    """
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self.value = default
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        token, self.value = self.value, value
+        return token
+
+    def reset(self, token):
+        self.value = token
+
+
+def context_var(name, default=None):
+    """
+    Return a ``ContextVar``, or a thread-local stand-in with the same methods on Python
+    < 3.7, for state that follows the current task or thread.
+    """
+    return (ContextVar or _ThreadLocalVar)(name, default=default)
+
+
+_current_key = context_var('pgrowcrypt_key')
+
+
+class _LoadingKeys(threading.local):
+    """
+    The keys of the query whose rows are being turned into model instances in the
+    current thread, so ``EncryptedModel.from_db()`` does not need to look them up on the
+    connection for every single row.
+    """
+    db = None
+    key = None
+    row_keys = None
+
+
+loading_keys = _LoadingKeys()
+
+
+def key_sql(connection, key, purpose=None):
+    """
+    Return SQL and parameters that refer to ``key``, or the key derived from it for
+    ``purpose``. If the key has been installed in the database session by
+    ``query_key``, this reads it from there instead of sending it again.
+    """
+    if isinstance(key, RowKeys):
+        return key.key_sql(purpose), []
+    if getattr(connection, '_pgrowcrypt_key_setting', False) and connection._pgrowcrypt_key == key:
+        name = dict(KEY_SETTINGS)[purpose]
+        if purpose is None:
+            return "current_setting('{}')".format(name), []
+        return "decode(current_setting('{}'), 'hex')".format(name), []
+    if purpose is None:
+        return '%s', [key]
+    return '%s', [derive_key(key, purpose)]
+
+
+def _set_key_settings(connection, key):
+    values = []
+    for purpose, name in KEY_SETTINGS:
+        if purpose is None or not key:
+            values.append(key)
+        else:
+            values.append(binascii.hexlify(derive_key(key, purpose)).decode())
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT {}'.format(', '.join(
+            "set_config('{}', %s, true)".format(name) for purpose, name in KEY_SETTINGS
+        )), values)
+
+
+def _transaction_failed(connection):
+    return connection.connection.get_transaction_status() == TRANSACTION_STATUS_INERROR
+
+
+@contextmanager
+def encryption_key(key):
+    """
+    Use ``key`` for all queries and new instances of encrypted models in this block that
+    are not given a key of their own. The key is bound to the current thread or, on
+    Python 3.7+, to the current asyncio task, and nested blocks override it.
+    """
+    token = _current_key.set(key)
+    try:
+        yield
+    finally:
+        _current_key.reset(token)
+
+
+def get_current_key():
+    """
+    Return the key of the innermost ``encryption_key()`` block, if any.
+    """
+    return _current_key.get()
+
+
+def get_query_key(compiler, connection):
+    """
+    Return the key the query of ``compiler`` decrypts with: the ``RowKeys`` of a
+    query with ``with_keys()`` or the key of the connection.
+    """
+    row_keys = getattr(compiler.query, 'row_keys', None)
+    if row_keys is not None:
+        return row_keys
+    return getattr(connection, '_pgrowcrypt_key', None)
+
+
+@contextmanager
+def query_row_keys(connection, row_keys):
+    """
+    Give the model instances loaded from ``connection`` in this block the key of their
+    row from ``row_keys``.
+    """
+    if row_keys is None:
+        yield
+        return
+    outer = getattr(connection, '_pgrowcrypt_row_keys', None)
+    connection._pgrowcrypt_row_keys = row_keys
+    loading_db, loading_keys.db = loading_keys.db, None
+    try:
+        yield
+    finally:
+        connection._pgrowcrypt_row_keys = outer
+        loading_keys.db = loading_db
+
+
+@contextmanager
+def query_loading_keys(db, connection):
+    """
+    Give the model instances loaded from ``db`` in this block the keys of the queries on
+    ``connection``.
+    """
+    outer = loading_keys.db, loading_keys.key, loading_keys.row_keys
+    loading_keys.db = db
+    loading_keys.key = getattr(connection, '_pgrowcrypt_key', None)
+    loading_keys.row_keys = getattr(connection, '_pgrowcrypt_row_keys', None)
+    try:
+        yield
+    finally:
+        loading_keys.db, loading_keys.key, loading_keys.row_keys = outer
+
+
+@contextmanager
+def query_key(connection, key):
+    """
+    Use ``key`` for the queries on ``connection`` in this block, or the current key of
+    ``encryption_key()`` if it is not set. A nested block without a key or with the same
+    key keeps the key of the outer block (e.g. for the queries of ``prefetch_related``),
+    a nested block with a different key uses its own key until it is left.
+    """
+    outer = getattr(connection, '_pgrowcrypt_key', None)
+    if outer and (not key or key == outer):
+        yield
+        return
+    key = key or get_current_key()
+    outer_setting = getattr(connection, '_pgrowcrypt_key_setting', False)
+    connection._pgrowcrypt_key = key
+    connection._pgrowcrypt_key_setting = False
+    # The keys published for the instances loaded in an outer block don't apply anymore
+    loading_db, loading_keys.db = loading_keys.db, None
+    try:
+        # The key is only installed inside a transaction, which discards it no matter what
+        # happens. Outside of one, it is sent as a parameter as usual.
+        if key and getattr(settings, 'PGROWCRYPT_KEY_MODE', 'parameter') == 'setting' and \
+                not connection.get_autocommit():
+            _set_key_settings(connection, key)
+            connection._pgrowcrypt_key_setting = True
+        with instrument(connection):
+            yield
+    finally:
+        loading_keys.db = loading_db
+        installed = connection._pgrowcrypt_key_setting
+        if outer:
+            connection._pgrowcrypt_key, connection._pgrowcrypt_key_setting = outer, outer_setting
+        else:
+            del connection._pgrowcrypt_key
+            del connection._pgrowcrypt_key_setting
+        # A failed transaction will be rolled back together with the key, and a lost
+        # connection takes the key with it
+        if installed and connection.connection is not None and not connection.connection.closed and \
+                not _transaction_failed(connection):
+            _set_key_settings(connection, outer if outer_setting else '')
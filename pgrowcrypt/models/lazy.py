@@ -0,0 +1,104 @@
+from collections import defaultdict
+
+from django.db import connections
+
+from .. import engine
+from .fields import DecryptedCol
+
+
+def _identity(value):
+    return value
+
+
+class LazyCiphertext:
+    """
+    Takes the place of the value of an encrypted field on a model instance loaded
+    with ``lazy_decrypt()`` until the field is accessed.
+    """
+    __slots__ = ('batch', 'field', 'ciphertext', 'value', 'decrypted')
+
+    def __init__(self, batch, field, ciphertext):
+        self.batch = batch
+        self.field = field
+        self.ciphertext = ciphertext
+        self.value = None
+        self.decrypted = False
+
+    def get(self):
+        if not self.decrypted:
+            self.batch.decrypt(self.field)
+        return self.value
+
+    def __reduce__(self):
+        return _identity, (self.get(),)
+
+
+class LazyDecryptionBatch:
+    """
+    Collects the ciphertexts of all instances loaded by the same query, so the first
+    access to a field decrypts this field on all of them at once.
+    """
+
+    def __init__(self, using, key):
+        self.using = using
+        self.key = key
+        self.pending = defaultdict(list)
+
+    def add(self, field, ciphertext):
+        if ciphertext is None:
+            return None
+        value = LazyCiphertext(self, field, bytes(ciphertext))
+        self.pending[field].append(value)
+        return value
+
+    def decrypt(self, field):
+        values = self.pending.pop(field, [])
+        if not values:
+            return
+        if engine.client_side():
+            plaintexts = engine.decrypt_values([(v.ciphertext, self.key, field.ciphertext_format) for v in values])
+        else:
+            plaintexts = self.decrypt_in_database(field, [v.ciphertext for v in values])
+        for v, plaintext in zip(values, plaintexts):
+            v.value = field.to_python(plaintext)
+            v.ciphertext = None
+            v.decrypted = True
+
+    def decrypt_in_database(self, field, ciphertexts):
+        connection = connections[self.using]
+        sql, params = DecryptedCol.decrypt_sql(field, 't.v', connection, self.key)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT {} FROM unnest(%s::bytea[]) WITH ORDINALITY AS t(v, i) ORDER BY t.i'.format(sql),
+                list(params) + [ciphertexts]
+            )
+            return [r[0] for r in cursor.fetchall()]
+
+
+class EncryptedFieldDescriptor:
+    """
+    Wraps the attribute of an encrypted field on the model class, so values that
+    have been loaded lazily are decrypted on first access.
+    """
+
+    def __init__(self, field, descriptor=None):
+        self.field = field
+        if isinstance(descriptor, EncryptedFieldDescriptor):
+            descriptor = descriptor.descriptor
+        self.descriptor = descriptor
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self.descriptor.__get__(instance, cls) if self.descriptor else self
+        value = instance.__dict__.get(self.field.attname)
+        if isinstance(value, LazyCiphertext):
+            instance.__dict__[self.field.attname] = value.get()
+        if self.descriptor:
+            return self.descriptor.__get__(instance, cls)
+        try:
+            return instance.__dict__[self.field.attname]
+        except KeyError:
+            raise AttributeError(self.field.attname)
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
@@ -0,0 +1,203 @@
+import binascii
+import datetime
+import decimal
+import io
+import itertools
+import uuid
+
+from django.db import connections, transaction
+from django.db.models.expressions import RawSQL, Value
+from django.db.models.sql import Query
+from psycopg2.extras import Json, Range
+
+from .. import engine
+from ..crypto import key_fingerprint
+from .fields import (
+    BlindIndexField, EncryptedField, KeyFingerprintField, SearchIndexField,
+)
+from .keys import query_key
+
+_names = itertools.count()
+
+
+def quote_element(text):
+    """
+    Quote the text of an element of an array or range literal.
+    """
+    return '"{}"'.format(text.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def copy_text(value):
+    """
+    Format a value prepared for the database in PostgreSQL's text input format. Raises
+    ``TypeError`` for values that have no such format here, e.g. ``hstore`` dicts.
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\x' + binascii.hexlify(value).decode()
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, Json):
+        return value.dumps(value.adapted)
+    if isinstance(value, (list, tuple)):
+        return '{{{}}}'.format(','.join(
+            'NULL' if v is None else copy_text(v) if isinstance(v, (list, tuple)) else quote_element(copy_text(v))
+            for v in value
+        ))
+    if isinstance(value, Range):
+        if value.isempty:
+            return 'empty'
+        return '{}{},{}{}'.format(
+            '[' if value.lower_inc else '(',
+            '' if value.lower is None else quote_element(copy_text(value.lower)),
+            '' if value.upper is None else quote_element(copy_text(value.upper)),
+            ']' if value.upper_inc else ')',
+        )
+    if isinstance(value, datetime.timedelta):
+        return '{} days {} seconds {} microseconds'.format(value.days, value.seconds, value.microseconds)
+    if isinstance(value, (str, int, float, decimal.Decimal, datetime.date, datetime.time, uuid.UUID)):
+        return str(value)
+    raise TypeError("bulk_load() can't copy values of type {}.".format(type(value).__name__))
+
+
+def copy_value(value):
+    """
+    Format a value for PostgreSQL's ``COPY`` text format.
+    """
+    if value is None:
+        return '\\N'
+    value = copy_text(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class BulkLoader:
+    """
+    Inserts large numbers of objects with a single key. Every batch of objects is
+    streamed into a temporary staging table with ``COPY`` and then inserted into the
+    model's table with a single ``INSERT ... SELECT`` that encrypts the whole batch.
+    With the Python engine, the batch is encrypted before it is copied instead.
+    """
+    row_column = 'pgrowcrypt_row'
+
+    def __init__(self, model, using, key):
+        self.model = model
+        self.using = using
+        self.key = key
+        self.connection = connections[using]
+        self.staging_table = 'pgrowcrypt_load_{}'.format(next(_names))
+        self.client_side = engine.client_side()
+        # (field, staging column of the value, staging column of the ciphertext)
+        self.columns = []
+        self.fingerprint_field = None
+        for f in model._meta.concrete_fields:
+            if isinstance(f, (BlindIndexField, SearchIndexField)):
+                # Computed from the plaintext of their encrypted field
+                continue
+            if isinstance(f, KeyFingerprintField):
+                # The same for all rows
+                self.fingerprint_field = f
+                continue
+            if f.primary_key and f.get_internal_type() in ('AutoField', 'BigAutoField', 'SmallAutoField'):
+                continue
+            if isinstance(f, EncryptedField) and self.client_side:
+                plaintext = 'p{}'.format(len(self.columns)) if f.blind_index or f.search_index else None
+                self.columns.append((f, plaintext, 'c{}'.format(len(self.columns))))
+            else:
+                self.columns.append((f, 'v{}'.format(len(self.columns)), None))
+
+    def create_staging_table(self, cursor):
+        qn = self.connection.ops.quote_name
+        columns = ['{} integer'.format(qn(self.row_column))]
+        for f, value_column, ciphertext_column in self.columns:
+            if value_column:
+                db_type = 'text' if isinstance(f, EncryptedField) else f.db_type(self.connection)
+                columns.append('{} {}'.format(qn(value_column), db_type))
+            if ciphertext_column:
+                columns.append('{} bytea'.format(qn(ciphertext_column)))
+        cursor.execute('CREATE TEMPORARY TABLE {} ({}) ON COMMIT DROP'.format(
+            qn(self.staging_table), ', '.join(columns)
+        ))
+
+    def get_insert_sql(self, returning):
+        qn = self.connection.ops.quote_name
+        compiler = Query(self.model).get_compiler(connection=self.connection)
+        target_columns = []
+        select = []
+        params = []
+
+        def add(column, expression):
+            sql, expression_params = compiler.compile(expression)
+            target_columns.append(qn(column))
+            select.append(sql)
+            params.extend(expression_params)
+
+        for f, value_column, ciphertext_column in self.columns:
+            value = RawSQL('s.{}'.format(qn(value_column)), []) if value_column else None
+            if not isinstance(f, EncryptedField):
+                add(f.column, value)
+                continue
+            if ciphertext_column:
+                add(f.column, RawSQL('s.{}'.format(qn(ciphertext_column)), []))
+            else:
+                add(f.column, f.get_encrypted_value(value, self.key))
+            for name, companion in f.get_companion_values(value, self.key).items():
+                add(self.model._meta.get_field(name).column, companion)
+        if self.fingerprint_field:
+            add(self.fingerprint_field.column, Value(key_fingerprint(self.key), output_field=self.fingerprint_field))
+
+        sql = 'INSERT INTO {} ({}) SELECT {} FROM {} s ORDER BY s.{}'.format(
+            qn(self.model._meta.db_table), ', '.join(target_columns), ', '.join(select),
+            qn(self.staging_table), qn(self.row_column)
+        )
+        if returning:
+            sql += ' RETURNING {}'.format(qn(self.model._meta.pk.column))
+        return sql, params
+
+    def get_rows(self, objs):
+        ciphertexts = {}
+        if self.client_side:
+            jobs = [
+                ((i, f.attname), f.get_encryption_job(getattr(obj, f.attname), self.key))
+                for i, obj in enumerate(objs)
+                for f, value_column, ciphertext_column in self.columns if ciphertext_column
+            ]
+            ciphertexts = dict(zip((k for k, job in jobs), engine.encrypt_values([job for k, job in jobs])))
+
+        for i, obj in enumerate(objs):
+            row = [i]
+            for f, value_column, ciphertext_column in self.columns:
+                if value_column:
+                    if isinstance(f, EncryptedField):
+                        row.append(getattr(obj, f.attname))
+                    else:
+                        row.append(f.get_db_prep_save(f.pre_save(obj, True), self.connection))
+                if ciphertext_column:
+                    row.append(ciphertexts[(i, f.attname)])
+            yield '\t'.join(copy_value(v) for v in row) + '\n'
+
+    def load(self, objs, batch_size, return_pks=False):
+        qn = self.connection.ops.quote_name
+        pks = [] if return_pks else None
+        count = 0
+        objs = iter(objs)
+        with transaction.atomic(using=self.using, savepoint=False), query_key(self.connection, self.key):
+            with self.connection.cursor() as cursor:
+                self.create_staging_table(cursor)
+                insert_sql, insert_params = self.get_insert_sql(return_pks)
+                while True:
+                    batch = list(itertools.islice(objs, batch_size))
+                    if not batch:
+                        break
+                    cursor.execute('TRUNCATE {}'.format(qn(self.staging_table)))
+                    cursor.copy_expert(
+                        'COPY {} FROM STDIN'.format(qn(self.staging_table)), io.StringIO(''.join(self.get_rows(batch)))
+                    )
+                    cursor.execute(insert_sql, insert_params)
+                    if return_pks:
+                        for obj, (pk,) in zip(batch, cursor.fetchall()):
+                            obj.pk = pk
+                            obj._state.adding = False
+                            obj._state.db = self.using
+                            pks.append(pk)
+                    count += len(batch)
+                cursor.execute('DROP TABLE {}'.format(qn(self.staging_table)))
+        return pks if return_pks else count
@@ -1,75 +1,383 @@
+import itertools
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import ExitStack, contextmanager
 
-from django.db import connections
-from django.db.models import QuerySet
+from django.db import connections, transaction
+from django.db.models import Case, Q, QuerySet, Value, When
+from django.db.models.functions import Cast
 
-from .fields import EncryptedField, EncryptionValueWrapper
+from .. import engine
+from ..crypto import key_fingerprint
+from .fields import EncryptedField
+from .keys import (
+    RowKeys, get_current_key, query_key, query_loading_keys, query_row_keys,
+)
+from .loader import BulkLoader
+from .query import EncryptedQuery
+from .records import RecordIterable
 
+try:
+    from .aio import AsyncQuerySetMixin
+except (ImportError, SyntaxError):  # pragma: no cover
+    # Python < 3.6 or no asgiref
+    class AsyncQuerySetMixin:
+        pass
 
-@contextmanager
-def query_key(connection, key):
-    if getattr(connection, '_pgrowcrypt_key', None):
-        # be re-entry safe (required for prefetch_related)
-        yield
-        return
-    connection._pgrowcrypt_key = key
-    try:
-        yield
-    finally:
-        del connection._pgrowcrypt_key
 
+def close_connections(executor, workers, using):
+    """
+    Close the connections to ``using`` that the threads of the pool ``executor`` with
+    ``workers`` threads have opened, each of them once in the thread that owns it.
+    """
+    # The barrier keeps a thread from taking a second task, so each task runs in another
+    # thread
+    barrier = threading.Barrier(workers)
 
-class EncryptedColumnsQuerySet(QuerySet):
-    def __init__(self, *args, **kwargs):
+    def close():
+        connections[using].close()
+        barrier.wait()
+
+    for future in [executor.submit(close) for i in range(workers)]:
+        future.result()
+
+
+class EncryptedColumnsQuerySet(AsyncQuerySetMixin, QuerySet):
+    def __init__(self, model=None, query=None, using=None, hints=None):
         self.key = None
-        super().__init__(*args, **kwargs)
+        super().__init__(model, query or EncryptedQuery(model), using, hints)
+
+    @contextmanager
+    def _query_keys(self, db=None):
+        # A router may send every query to a different database, so the database is
+        # chosen once and the key is set on the connection that runs the query
+        db = db or self.db
+        pinned = self._db is None
+        if pinned:
+            self._db = db
+        try:
+            connection = connections[db]
+            with query_key(connection, self.key), query_row_keys(connection, self.query.row_keys), \
+                    query_loading_keys(db, connection):
+                yield
+        finally:
+            if pinned:
+                self._db = None
 
     def wrap_method(method):
         def wrapped_method(self, *args, **kwargs):
-            with query_key(connections[self.db], self.key):
+            with self._query_keys():
                 return getattr(super(), method)(*args, **kwargs)
 
         return wrapped_method
 
     def _iterator(self, use_chunked_fetch, chunk_size):
-        with query_key(connections[self.db], self.key):
-            yield from super()._iterator(use_chunked_fetch, chunk_size)
+        # The keys are only set while a chunk of rows is fetched and turned into objects,
+        # so iterators that are consumed in turns don't load their rows with each other's
+        # keys
+        db = self.db
+        iterator = super()._iterator(use_chunked_fetch, chunk_size)
+        try:
+            while True:
+                with self._query_keys(db):
+                    chunk = list(itertools.islice(iterator, chunk_size))
+                yield from chunk
+                if len(chunk) < chunk_size:
+                    return
+        finally:
+            iterator.close()
 
     _fetch_all = wrap_method('_fetch_all')
     count = wrap_method('count')
     exists = wrap_method('exists')
     aggregate = wrap_method('aggregate')
-    delete = wrap_method('delete')
     _prefetch_related_objects = wrap_method('_prefetch_related_objects')
 
+    def _get_key_fingerprint_field(self):
+        get_field = getattr(self.model, 'get_key_fingerprint_field', None)
+        return get_field() if get_field else None
+
+    def _scoped(self, key):
+        """
+        Return this queryset restricted to the rows encrypted with ``key`` and the rows
+        without a fingerprint, if the model has a ``KeyFingerprintField``. Selects are
+        restricted by the compiler, but updates and deletes are not compiled by it.
+        """
+        fingerprint_field = self._get_key_fingerprint_field()
+        if not key or not fingerprint_field:
+            return self
+        return self.filter(
+            Q(**{fingerprint_field.name: key_fingerprint(key)}) | Q(**{'{}__isnull'.format(fingerprint_field.name): True})
+        )
+
+    def _check_single_key(self, method):
+        if self.query.row_keys is not None:
+            raise TypeError("Cannot use {}() on a queryset with multiple keys.".format(method))
+
+    def delete(self):
+        self._check_single_key('delete')
+        self._for_write = True
+        with query_key(connections[self.db], self.key):
+            return super(EncryptedColumnsQuerySet, self._scoped(self.get_key())).delete()
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def _encrypt_objects(self, objs, fields=None):
+        """
+        With the Python engine, encrypt the values of ``fields`` (or all encrypted fields)
+        of all objects at once, so they can be spread over the pool. Returns a dictionary
+        of ciphertexts for every object.
+        """
+        if not engine.client_side():
+            return [None] * len(objs)
+        jobs = [
+            (i, name, job)
+            for i, obj in enumerate(objs) for name, job in obj._EncryptedModel__get_encryption_jobs(fields)
+        ]
+        ciphertexts = [{} for obj in objs]
+        for (i, name, job), ciphertext in zip(jobs, engine.encrypt_values([job for i, name, job in jobs])):
+            ciphertexts[i][name] = ciphertext
+        return ciphertexts
+
     def bulk_create(self, objs, batch_size=None):
+        objs = list(objs)
+        ciphertexts = self._encrypt_objects(objs)
+        self._for_write = True
+
         with ExitStack() as stack:
-            for obj in objs:
-                stack.enter_context(obj._EncryptedModel__wrap_values())
+            keys = {obj._EncryptedModel__key for obj in objs}
+            if len(keys) == 1:
+                stack.enter_context(query_key(connections[self.db], keys.pop()))
+            for obj, obj_ciphertexts in zip(objs, ciphertexts):
+                stack.enter_context(obj._EncryptedModel__wrap_values(obj_ciphertexts))
             return super().bulk_create(objs, batch_size)
 
+    def bulk_update(self, objs, fields, batch_size=None):
+        """
+        Update the given fields of all objects, encrypting them with the key of every
+        object. Objects are grouped by their key and every batch of objects with the
+        same key is updated with a single statement.
+        """
+        objs = list(objs)
+        fields = self._get_bulk_update_fields(objs, fields)
+        encrypted_fields = [f for f in fields if isinstance(f, EncryptedField)]
+        groups = OrderedDict()
+        if encrypted_fields:
+            fields += [self.model._meta.get_field(name) for f in encrypted_fields for name in f.companion_names]
+            fingerprint_field = self._get_key_fingerprint_field()
+            if fingerprint_field and fingerprint_field not in fields:
+                for obj in objs:
+                    obj._EncryptedModel__check_fingerprint(encrypted_fields)
+                fields.append(fingerprint_field)
+            for obj in objs:
+                groups.setdefault(obj._EncryptedModel__key, []).append(obj)
+        elif objs:
+            groups[None] = objs
+
+        batch_size = batch_size or engine.batch_size()
+        rows = 0
+        self._for_write = True
+        with transaction.atomic(using=self.db, savepoint=False):
+            for key, group in groups.items():
+                for i in range(0, len(group), batch_size):
+                    rows += self._update_batch(group[i:i + batch_size], fields, encrypted_fields, key)
+        return rows
+
+    def _get_bulk_update_fields(self, objs, names):
+        # The same checks as in QuerySet.bulk_update() of Django 2.2+
+        if not names:
+            raise ValueError('Field names must be given to bulk_update().')
+        fields = [self.model._meta.get_field(name) for name in names]
+        if any(not f.concrete or f.many_to_many for f in fields):
+            raise ValueError('bulk_update() can only be used with concrete fields.')
+        if any(f.primary_key for f in fields):
+            raise ValueError('bulk_update() cannot be used with primary key fields.')
+        if any(obj.pk is None for obj in objs):
+            raise ValueError('All bulk_update() objects must have a primary key set.')
+        return fields
+
+    def _update_batch(self, objs, fields, encrypted_fields, key):
+        with ExitStack() as stack:
+            if encrypted_fields:
+                for obj, obj_ciphertexts in zip(objs, self._encrypt_objects(objs, encrypted_fields)):
+                    stack.enter_context(obj._EncryptedModel__wrap_values(obj_ciphertexts, fields=encrypted_fields))
+            values = {}
+            for f in fields:
+                whens = []
+                for obj in objs:
+                    value = getattr(obj, f.attname)
+                    if not hasattr(value, 'resolve_expression'):
+                        value = Value(value, output_field=f)
+                    whens.append(When(pk=obj.pk, then=value))
+                # Without the cast, a CASE with only NULL values would be of type text
+                values[f.attname] = Cast(Case(*whens, output_field=f), output_field=f)
+            with query_key(connections[self.db], key):
+                # The values are encrypted already
+                return super(EncryptedColumnsQuerySet, self.filter(pk__in=[obj.pk for obj in objs])).update(**values)
+
+    def bulk_load(self, objs, key=None, batch_size=None, return_pks=False):
+        """
+        Insert the objects from the iterable ``objs`` in batches of ``batch_size``, all
+        encrypted with ``key`` (or the key of this queryset). Every batch is copied into a
+        staging table and encrypted by a single statement, which is considerably faster
+        than ``bulk_create()`` for large numbers of objects. Returns the number of objects
+        or, with ``return_pks``, a list of their primary keys. Like ``bulk_create()``, this
+        does not call ``save()`` or send any signals.
+        """
+        key = key or self.get_key()
+        if not key:
+            raise TypeError("No key set to encrypt the objects.")
+        if self.model._meta.parents:
+            raise ValueError("Can't bulk load a multi-table inherited model")
+        self._for_write = True
+        loader = BulkLoader(self.model, self.db, key)
+        return loader.load(objs, batch_size or engine.batch_size(), return_pks)
+
     def create(self, **kwargs):
-        if self.key:
-            kwargs['_key'] = self.key
+        if self.get_key():
+            kwargs['_key'] = self.get_key()
         return super().create(**kwargs)
 
     def update(self, **kwargs):
+        self._check_single_key('update')
+        self._for_write = True
+        key = self.get_key()
         for f in self.model._meta.get_fields():
             if isinstance(f, EncryptedField):
                 if f.name in kwargs:
-                    kwargs[f.name] = EncryptionValueWrapper(kwargs[f.name], self.key)
-        with query_key(connections[self.db], self.key):
-            return super().update(**kwargs)
+                    kwargs.update(f.get_companion_values(kwargs[f.name], key))
+                    kwargs[f.name] = f.get_encrypted_value(kwargs[f.name], key)
+        with query_key(connections[self.db], key):
+            return super(EncryptedColumnsQuerySet, self._scoped(key)).update(**kwargs)
 
     def _create_object_from_params(self, lookup, params, lock=False):
-        if self.key:
-            params['_key'] = self.key
+        if self.get_key():
+            params['_key'] = self.get_key()
         return super()._create_object_from_params(lookup, params, lock)
 
+    def lazy_decrypt(self):
+        """
+        Fetch encrypted fields of the returned instances as ciphertext and only decrypt
+        them when they are first accessed, for all instances of this queryset at once.
+        """
+        clone = self._chain()
+        clone.query.lazy_decrypt = True
+        return clone
+
+    def parallel_iterator(self, workers=4, chunk_size=None, ordered=False):
+        """
+        Like ``iterator()``, but split the rows into ranges of ``chunk_size`` primary keys
+        that are fetched and decrypted by ``workers`` threads, each with a connection of
+        its own. Results are yielded as the ranges complete or, with ``ordered``, in the
+        order of their primary keys. At most two ranges per worker are held in memory.
+
+        Every range is read in a snapshot of its own, so the ranges may not be consistent
+        with each other, and none of them sees the uncommitted changes of the transaction
+        of the caller.
+        """
+        if not self.query.can_filter():
+            raise TypeError("Cannot use parallel_iterator() on a sliced queryset.")
+        queryset = self.using(self.db).with_key(self.get_key())
+        return queryset._parallel_iterator(workers, chunk_size or engine.batch_size(), ordered)
+
+    def _parallel_iterator(self, workers, chunk_size, ordered):
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                for first, last in self._pk_ranges(chunk_size):
+                    pending.append(executor.submit(self._fetch_range, first, last))
+                    if len(pending) >= 2 * workers:
+                        yield from self._next_range(pending, ordered)
+                while pending:
+                    yield from self._next_range(pending, ordered)
+            finally:
+                # The iterator has been closed early or a range has failed
+                for future in pending:
+                    future.cancel()
+                close_connections(executor, workers, self.db)
+
+    def _pk_ranges(self, chunk_size):
+        pks = self.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=chunk_size)
+        while True:
+            chunk = list(itertools.islice(pks, chunk_size))
+            if not chunk:
+                return
+            yield chunk[0], chunk[-1]
+
+    def _fetch_range(self, first, last):
+        return list(self.filter(pk__gte=first, pk__lte=last).order_by('pk'))
+
+    @staticmethod
+    def _next_range(pending, ordered):
+        if ordered:
+            future = pending.popleft()
+        else:
+            done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+            future = next(iter(done))
+            pending.remove(future)
+        return future.result()
+
+    def records(self, *fields):
+        """
+        Return lightweight records instead of model instances: named tuples of the values
+        of ``fields`` (or of all columns) that also know the primary key, the key and the
+        database of their row, and turn into model instances with ``_to_instance()``.
+        """
+        # The primary key is selected by its own name, 'pk' would hide Record.pk
+        pk = self.model._meta.pk.attname
+        fields = [pk if f == 'pk' else f for f in fields] or [f.attname for f in self.model._meta.concrete_fields]
+        clone = self.values_list(*fields)
+        clone._iterable_class = RecordIterable
+        return clone
+
+    def prepared(self, name, **kwargs):
+        """
+        Filter by the given lookups like ``filter()``, but execute the resulting query as a
+        server-side prepared statement that is only planned once per database connection
+        and SQL text, passing only the values and the key. ``name`` labels the queries
+        the statements are prepared for.
+        """
+        clone = self.filter(**kwargs)
+        clone.query.prepared_name = name
+        return clone
+
     def with_key(self, key):
         self.key = key
         return self
 
+    def with_keys(self, keys, field=None):
+        """
+        Decrypt every row with its own key in a single query. ``keys`` is a dictionary from
+        the values of the column ``field`` (e.g. a tenant's foreign key) to the keys of the
+        rows with that value, or a list of keys if the rows are chosen by the
+        ``KeyFingerprintField`` of the model. Rows without a key in ``keys`` are skipped.
+        """
+        if field is None:
+            field = self._get_key_fingerprint_field()
+            if field is None:
+                raise TypeError("{} has no KeyFingerprintField, so with_keys() needs a field.".format(
+                    self.model._meta.label
+                ))
+            keys = {key_fingerprint(key): key for key in keys}
+        else:
+            field = self.model._meta.get_field(field)
+            if isinstance(field, EncryptedField) or not field.concrete:
+                raise TypeError("The keys can't be chosen by the column of {}.".format(field.name))
+        if not all(keys.values()):
+            raise TypeError("All keys passed to with_keys() need to be set.")
+        clone = self._chain()
+        clone.query.row_keys = RowKeys(field, keys)
+        return clone
+
+    def get_key(self):
+        """
+        Return the key of this queryset or, if it has none, the current key of
+        ``encryption_key()``.
+        """
+        return self.key or get_current_key()
+
     def _clone(self):
         c = super()._clone()
         c.key = self.key
@@ -1,51 +1,221 @@
 from contextlib import contextmanager
 
-from django.db import connections, models
+from django.db import connections, models, router
+from django.db.models.base import DEFERRED
 
-from .fields import EncryptedField, EncryptionValueWrapper
-from .manager import EncryptedColumnsManager, query_key
+from ..crypto import key_fingerprint
+from .fields import ClientEncryptedValue, EncryptedField, KeyFingerprintField
+from .keys import get_current_key, loading_keys, query_key
+from .lazy import LazyCiphertext
+from .manager import EncryptedColumnsManager
 
+try:
+    from .aio import AsyncModelMixin
+except (ImportError, SyntaxError):  # pragma: no cover
+    # Python < 3.6 or no asgiref
+    class AsyncModelMixin:
+        pass
 
-class EncryptedModel(models.Model):
+
+class EncryptedModel(AsyncModelMixin, models.Model):
     objects = EncryptedColumnsManager()
 
     class Meta:
         abstract = True
 
     def __init__(self, *args, **kwargs):
-        self.__key = kwargs.pop('_key', None)
+        self.__key = kwargs.pop('_key', None) or get_current_key()
+        # The key and the values of the encrypted fields as they are stored in the database
+        self.__stored = None
+        # The unchanged encrypted fields that the current save() leaves out of the update
+        self.__skipped = []
         super().__init__(*args, **kwargs)
 
     @classmethod
     def from_db(cls, db, field_names, values):
         v = super().from_db(db, field_names, values)
-        if hasattr(connections[db], '_pgrowcrypt_key'):
-            v.__key = connections[db]._pgrowcrypt_key
+        if loading_keys.db == db:
+            key, row_keys = loading_keys.key, loading_keys.row_keys
+        else:
+            # Not loaded by an encrypted queryset, e.g. by refresh_from_db()
+            connection = connections[db]
+            key = getattr(connection, '_pgrowcrypt_key', v.__key)
+            row_keys = getattr(connection, '_pgrowcrypt_row_keys', None)
+        if row_keys is not None and issubclass(cls, row_keys.field.model):
+            key = row_keys.get_key(v)
+        v.__key = key
+        v.__remember_values()
         return v
 
+    @classmethod
+    def from_record(cls, record):
+        """
+        Return a model instance with the values and the key of ``record``, as returned by
+        ``records()``.
+        """
+        values = dict(zip(record._fields, record))
+        v = super().from_db(
+            record._db, list(values), [values.get(f.attname, DEFERRED) for f in cls._meta.concrete_fields]
+        )
+        v.__key = record._key
+        v.__remember_values()
+        return v
+
+    @classmethod
+    def get_encrypted_fields(cls):
+        """
+        Return the encrypted fields of this model.
+        """
+        if '_pgrowcrypt_encrypted_fields' not in cls.__dict__:
+            cls._pgrowcrypt_encrypted_fields = [f for f in cls._meta.concrete_fields if isinstance(f, EncryptedField)]
+        return cls._pgrowcrypt_encrypted_fields
+
+    @classmethod
+    def get_key_fingerprint_field(cls):
+        """
+        Return the ``KeyFingerprintField`` of this model, or None.
+        """
+        if '_pgrowcrypt_key_fingerprint_field' not in cls.__dict__:
+            cls._pgrowcrypt_key_fingerprint_field = next(
+                (f for f in cls._meta.concrete_fields if isinstance(f, KeyFingerprintField)), None
+            )
+        return cls._pgrowcrypt_key_fingerprint_field
+
     def refresh_from_db(self, using=None, fields=None):
         with query_key(connections[using or self._state.db], self.__key):
             super().refresh_from_db(using, fields)
+        if fields is None:
+            self.__remember_values()
+        else:
+            self.__remember_values([f for f in self.get_encrypted_fields() if f.attname in fields or f.name in fields])
+
+    def __remember_values(self, fields=None):
+        """
+        Remember the current values of ``fields`` (or all encrypted fields) as stored.
+        """
+        if fields is None:
+            self.__stored = (self.__key, {
+                f.attname: self.__dict__[f.attname] for f in self.get_encrypted_fields() if f.attname in self.__dict__
+            })
+        elif self.__stored is not None:
+            self.__stored[1].update({f.attname: self.__dict__[f.attname] for f in fields if f.attname in self.__dict__})
+
+    def __is_unchanged(self, field):
+        stored = self.__stored[1]
+        if field.attname not in stored or field.attname not in self.__dict__:
+            return False
+        old, current = stored[field.attname], self.__dict__[field.attname]
+        if current is old:
+            return True
+        if isinstance(old, LazyCiphertext):
+            return old.decrypted and old.value == current
+        return old == current
+
+    def get_unchanged_fields(self):
+        """
+        Return the encrypted fields whose values have not changed since they were loaded
+        from or saved to the database with the current key.
+        """
+        if self.__stored is None or self.__stored[0] != self.__key:
+            return []
+        return [f for f in self.get_encrypted_fields() if self.__is_unchanged(f)]
+
+    def __get_encryption_jobs(self, fields=None):
+        return [
+            (f.name, f.get_encryption_job(getattr(self, f.name), self.__key))
+            for f in (self.get_encrypted_fields() if fields is None else fields)
+            if self.__key and not hasattr(getattr(self, f.name), 'resolve_expression')
+        ]
 
     @contextmanager
-    def __wrap_values(self):
+    def __wrap_values(self, ciphertexts=None, fields=None):
+        fingerprint_field = self.get_key_fingerprint_field()
+        if fingerprint_field and self.__key:
+            setattr(self, fingerprint_field.attname, key_fingerprint(self.__key))
         fieldnames = []
-        for f in self._meta.get_fields():
-            if isinstance(f, EncryptedField):
-                if not self.__key:
-                    raise TypeError("No key set to encrypt the value in column '{}'.".format(f.name))
-                setattr(self, f.name, EncryptionValueWrapper(getattr(self, f.name), self.__key))
-                fieldnames.append(f.name)
+        companions = []
+        for f in self.get_encrypted_fields() if fields is None else fields:
+            if not self.__key:
+                raise TypeError("No key set to encrypt the value in column '{}'.".format(f.name))
+            value = getattr(self, f.name)
+            for k, v in f.get_companion_values(value, self.__key).items():
+                setattr(self, k, v)
+                companions.append(k)
+            if ciphertexts and f.name in ciphertexts:
+                setattr(self, f.name, ClientEncryptedValue(value, self.__key, ciphertexts[f.name]))
+            else:
+                setattr(self, f.name, f.get_encrypted_value(value, self.__key))
+            fieldnames.append(f.name)
 
         try:
             yield
         finally:
             for k in fieldnames:
                 setattr(self, k, getattr(self, k).value)
+            for k in companions:
+                # The index values are only ever computed inside the database
+                setattr(self, k, None)
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        if self.__skipped:
+            skip = {name for f in self.__skipped for name in [f.name] + f.companion_names}
+            values = [v for v in values if v[0].name not in skip]
+        return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+
+    def _do_insert(self, *args, **kwargs):
+        if not self.__skipped:
+            return super()._do_insert(*args, **kwargs)
+        # The row has been deleted in the meantime, so the unchanged fields are inserted as well
+        with self.__wrap_values(fields=self.__skipped):
+            return super()._do_insert(*args, **kwargs)
+
+    def __check_fingerprint(self, fields):
+        """
+        Make sure that the fingerprint of our key is only written together with ``fields``
+        if no other encrypted field may still be stored with another key.
+        """
+        if self.get_key_fingerprint_field() is None or len(fields) == len(self.get_encrypted_fields()):
+            return
+        if not self._state.adding and (self.__stored is None or self.__stored[0] != self.__key):
+            raise ValueError(
+                'Cannot save only some of the encrypted fields of {} with a new key, the others would '
+                'still be encrypted with the old key.'.format(self._meta.label)
+            )
 
     def save(self, *args, **kwargs):
         if '_key' in kwargs:
             self.__key = kwargs.pop('_key')
+        self.__key = self.__key or get_current_key()
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+
+        fields = None
+        if not args and kwargs.get('update_fields') is None and not kwargs.get('force_insert') and (
+            not self._state.adding and self.pk is not None
+        ):
+            # Unchanged encrypted fields are neither encrypted nor written again, and Django
+            # only saves the loaded fields of an instance with deferred fields
+            self.__skipped = self.get_unchanged_fields()
+            deferred = self.get_deferred_fields() if using == self._state.db else set()
+            fields = [f for f in self.get_encrypted_fields() if f not in self.__skipped and f.attname not in deferred]
+            self.__check_fingerprint(fields + self.__skipped)
+        elif kwargs.get('update_fields') is not None:
+            names = set(kwargs['update_fields'])
+            fields = [f for f in self.get_encrypted_fields() if f.name in names or f.attname in names]
+            fingerprint_field = self.get_key_fingerprint_field()
+            if fields and fingerprint_field and not names & {fingerprint_field.name, fingerprint_field.attname}:
+                # The fields are encrypted with our key now
+                self.__check_fingerprint(fields)
+                kwargs['update_fields'] = list(kwargs['update_fields']) + [fingerprint_field.name]
 
-        with self.__wrap_values():
-            super().save(*args, **kwargs)
+        try:
+            with query_key(connections[using], self.__key), self.__wrap_values(fields=fields):
+                super().save(*args, **kwargs)
+        finally:
+            self.__skipped = []
+        if fields is None or len(fields) == len(self.get_encrypted_fields()):
+            self.__remember_values()
+        elif self.__stored is not None and self.__stored[0] == self.__key:
+            self.__remember_values(fields)
+        else:
+            # Some fields may still be stored with another key
+            self.__stored = None
@@ -0,0 +1,125 @@
+"""
+Support for ``EncryptedColumnsQuerySet.prepared()``. The SQL of a prepared queryset is
+turned into a server-side prepared statement once per database connection, which is
+then executed with the parameters of the current query, including its key. Every
+connection keeps at most ``PGROWCRYPT_PREPARED_STATEMENTS`` statements and deallocates
+the least recently used one to make room for another.
+"""
+import itertools
+import re
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
+from django.dispatch import receiver
+
+PLACEHOLDER_RE = re.compile(r'%([s%])')
+
+_names = itertools.count()
+
+
+class PreparedStatement:
+    """
+    The SQL of a compiled query as a prepared statement.
+    """
+
+    def __init__(self, sql, param_count):
+        self.name = 'pgrowcrypt_{}'.format(next(_names))
+        counter = itertools.count(1)
+        self.prepare_sql = 'PREPARE {} AS {}'.format(self.name, PLACEHOLDER_RE.sub(
+            lambda m: '${}'.format(next(counter)) if m.group(1) == 's' else '%', sql
+        ))
+        if param_count:
+            self.execute_sql = 'EXECUTE {} ({})'.format(self.name, ', '.join(['%s'] * param_count))
+        else:
+            self.execute_sql = 'EXECUTE {}'.format(self.name)
+
+
+class StatementCache:
+    """
+    The prepared statements of a connection, by the key the compiler uses to identify a
+    query, from the least to the most recently used.
+    """
+
+    def __init__(self):
+        self.statements = OrderedDict()
+        # The names of discarded statements that still need to be deallocated
+        self.stale = []
+
+    def __len__(self):
+        return len(self.statements)
+
+    def get(self, key):
+        statement = self.statements.get(key)
+        if statement is not None:
+            self.statements.move_to_end(key)
+        return statement
+
+    def prepare(self, cursor, key, sql, param_count):
+        """
+        Prepare the statement ``key`` for ``sql``, after making room for it.
+        """
+        size = max(1, getattr(settings, 'PGROWCRYPT_PREPARED_STATEMENTS', 100))
+        while len(self.statements) >= size:
+            self.stale.append(self.statements.popitem(last=False)[1].name)
+        self.deallocate_stale(cursor)
+        statement = PreparedStatement(sql, param_count)
+        cursor.execute(statement.prepare_sql)
+        self.statements[key] = statement
+        return statement
+
+    def discard(self, key):
+        """
+        Forget the statement ``key``. It is deallocated with the next statement that is
+        prepared, as the current transaction might have failed.
+        """
+        statement = self.statements.pop(key, None)
+        if statement is not None:
+            self.stale.append(statement.name)
+
+    def deallocate_stale(self, cursor):
+        while self.stale:
+            cursor.execute('DEALLOCATE {}'.format(self.stale.pop()))
+
+    def clear(self, cursor=None):
+        """
+        Forget all statements, and deallocate them if ``cursor`` is given.
+        """
+        for key in list(self.statements):
+            self.discard(key)
+        if cursor is not None:
+            self.deallocate_stale(cursor)
+        self.stale = []
+
+
+def get_statements(connection):
+    """
+    Return the ``StatementCache`` of ``connection``.
+    """
+    try:
+        return connection._pgrowcrypt_statements
+    except AttributeError:
+        connection._pgrowcrypt_statements = StatementCache()
+        return connection._pgrowcrypt_statements
+
+
+@receiver(connection_created)
+def reset_statements(sender, connection, **kwargs):
+    # Prepared statements only live as long as the database session
+    connection._pgrowcrypt_statements = StatementCache()
+
+
+@receiver(post_migrate)
+def deallocate_statements(sender, **kwargs):
+    # The schema might have changed under our statements
+    for connection in connections.all():
+        statements = getattr(connection, '_pgrowcrypt_statements', None)
+        if statements is None:
+            continue
+        if connection.connection is not None:
+            with connection.cursor() as cursor:
+                statements.clear(cursor)
+        else:
+            statements.clear()
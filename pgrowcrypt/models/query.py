@@ -0,0 +1,31 @@
+from django.db import connections
+from django.db.models.sql import Query
+
+from .compiler import DecryptingSQLCompiler
+from .fields import DecryptedCol
+
+
+class EncryptedQuery(Query):
+    lazy_decrypt = False
+    prepared_name = None
+    row_keys = None
+
+    def get_compiler(self, using=None, connection=None):
+        if self.compiler != 'SQLCompiler':
+            return super().get_compiler(using, connection)
+        if using is None and connection is None:
+            raise ValueError("Need either using or connection")
+        if using:
+            connection = connections[using]
+        return DecryptingSQLCompiler(self, connection, using)
+
+    def set_group_by(self, *args, **kwargs):
+        super().set_group_by(*args, **kwargs)
+        # Group deterministic fields by their ciphertext instead of the decrypted value
+        group_by = []
+        for expr in self.group_by:
+            if isinstance(expr, DecryptedCol):
+                group_by.extend(expr.get_group_by_cols())
+            else:
+                group_by.append(expr)
+        self.group_by = tuple(group_by)
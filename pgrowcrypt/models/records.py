@@ -0,0 +1,74 @@
+from collections import namedtuple
+from functools import lru_cache
+
+from django.db import connections
+from django.db.models.query import ValuesListIterable
+
+
+class Record:
+    """
+    The base of the named tuples returned by ``records()``. Besides the values of the
+    selected fields, a record knows the primary key, the key and the database of its
+    row. Like in other named tuples, the names of its own attributes start with an
+    underscore, so they never collide with field names.
+    """
+    __slots__ = ()
+    _model = None
+    _db = None
+    _query_key = None
+    _row_keys = None
+
+    @property
+    def pk(self):
+        attname = self._model._meta.pk.attname
+        if attname not in self._fields:
+            raise AttributeError("The primary key {} has not been selected.".format(attname))
+        return getattr(self, attname)
+
+    @property
+    def _key(self):
+        if self._row_keys is None:
+            return self._query_key
+        attname = self._row_keys.field.attname
+        if attname not in self._fields:
+            return None
+        return self._row_keys.keys.get(self._row_keys.normalize(getattr(self, attname)))
+
+    def _to_instance(self):
+        """
+        Return a model instance with the values and the key of this record, e.g. to
+        ``save()`` it. Fields that have not been selected are deferred.
+        """
+        return self._model.from_record(self)
+
+
+@lru_cache()
+def get_record_class(model, names):
+    """
+    Return the record class for rows of ``model`` with the values of the fields
+    ``names``.
+    """
+    name = '{}Record'.format(model.__name__)
+    return type(name, (Record, namedtuple(name, names)), {'__slots__': (), '_model': model})
+
+
+class RecordIterable(ValuesListIterable):
+    """
+    Yields a record for each row. The key and the database of the query are stored once
+    in a subclass of the record class instead of in every record.
+    """
+
+    def __iter__(self):
+        queryset = self.queryset
+        db = queryset.db
+        connection = connections[db]
+        base = get_record_class(queryset.model, tuple(queryset._fields))
+        record_class = type(base.__name__, (base,), {
+            '__slots__': (),
+            '_db': db,
+            '_query_key': getattr(connection, '_pgrowcrypt_key', None),
+            '_row_keys': queryset.query.row_keys,
+        })
+        new = tuple.__new__
+        for row in super().__iter__():
+            yield new(record_class, row)
@@ -0,0 +1,273 @@
+"""
+Migration operations that encrypt an existing plaintext column in place or decrypt an
+encrypted one, without rewriting the table under an exclusive lock.
+
+The new values are written to a shadow column next to the old one, in batches of
+consecutive primary keys that are each a single ``UPDATE`` statement. In a migration
+with ``atomic = False``, every batch is committed on its own, so an interrupted
+migration resumes with the rows whose shadow value is still missing. A trigger clears
+the shadow value of every row whose old value changes in the meantime. At the end, the
+table is locked against writes for a last batch of the rows written in the meantime,
+and the shadow column replaces the old one.
+"""
+import time
+
+from django.db import transaction
+from django.db.backends.utils import truncate_name
+from django.db.migrations.operations import AlterField
+from django.db.migrations.operations.base import Operation
+from django.db.models.expressions import RawSQL
+from django.db.models.sql import Query
+
+from . import engine
+from .models.fields import DecryptedCol, EncryptedField
+from .models.keys import RowKeys
+
+
+class ColumnConversion:
+    """
+    Converts the column of the field ``name`` of ``from_model`` into the column of the
+    same field of ``to_model``, encrypting or decrypting all values.
+    """
+    shadow_suffix = '_pgrowcrypt'
+    row_alias = 'pgrowcrypt_row'
+
+    def __init__(self, schema_editor, from_model, to_model, name, encrypt, key=None, key_source=None, batch_size=None,
+                 throttle=0, progress=None):
+        self.connection = schema_editor.connection
+        self.schema_editor = schema_editor
+        self.from_model = from_model
+        self.to_model = to_model
+        self.source_field = from_model._meta.get_field(name)
+        self.target_field = to_model._meta.get_field(name)
+        self.encrypted_field = self.target_field if encrypt else self.source_field
+        self.encrypt = encrypt
+        self.key = key
+        self.key_source = key_source
+        self.batch_size = batch_size or engine.batch_size()
+        self.throttle = throttle
+        self.progress = progress
+        self.rows = 0
+
+        qn = self.connection.ops.quote_name
+        self.table = qn(from_model._meta.db_table)
+        self.column = qn(self.source_field.column)
+        self.shadow = qn(self.source_field.column + self.shadow_suffix)
+        self.pk = qn(from_model._meta.pk.column)
+        self.trigger = qn(truncate_name(
+            '{}_{}{}'.format(from_model._meta.db_table, self.source_field.column, self.shadow_suffix),
+            self.connection.ops.max_name_length(),
+        ))
+
+    def get_trigger_columns(self):
+        columns = [self.source_field.column]
+        if isinstance(self.key_source, str):
+            columns.append(self.from_model._meta.get_field(self.key_source).column)
+        return [self.connection.ops.quote_name(column) for column in columns]
+
+    def create_trigger(self):
+        """
+        Clear the shadow value of a row whenever its old value or the column with its
+        key changes, so the row is converted again.
+        """
+        columns = self.get_trigger_columns()
+        self.schema_editor.execute(
+            'CREATE OR REPLACE FUNCTION {trigger}() RETURNS trigger AS $$ '
+            'BEGIN NEW.{shadow} := NULL; RETURN NEW; END $$ LANGUAGE plpgsql'.format(
+                trigger=self.trigger, shadow=self.shadow,
+            )
+        )
+        self.schema_editor.execute('DROP TRIGGER IF EXISTS {} ON {}'.format(self.trigger, self.table))
+        self.schema_editor.execute(
+            'CREATE TRIGGER {trigger} BEFORE UPDATE OF {columns} ON {table} FOR EACH ROW WHEN ({changed}) '
+            'EXECUTE PROCEDURE {trigger}()'.format(
+                trigger=self.trigger, table=self.table, columns=', '.join(columns),
+                changed=' OR '.join('OLD.{0} IS DISTINCT FROM NEW.{0}'.format(column) for column in columns),
+            )
+        )
+
+    def drop_trigger(self):
+        self.schema_editor.execute('DROP TRIGGER IF EXISTS {} ON {}'.format(self.trigger, self.table))
+        self.schema_editor.execute('DROP FUNCTION IF EXISTS {}()'.format(self.trigger))
+
+    def get_batch(self, last):
+        """
+        Return the primary keys and keys of the next batch of rows after ``last`` whose
+        shadow value is still missing.
+        """
+        key_column = ''
+        if isinstance(self.key_source, str):
+            key_column = ', {}'.format(self.connection.ops.quote_name(
+                self.from_model._meta.get_field(self.key_source).column
+            ))
+        sql = 'SELECT {pk}{key} FROM {table} WHERE {shadow} IS NULL AND {column} IS NOT NULL'.format(
+            pk=self.pk, key=key_column, table=self.table, shadow=self.shadow, column=self.column
+        )
+        params = []
+        if last is not None:
+            sql += ' AND {} > %s'.format(self.pk)
+            params.append(last)
+        # The rows stay locked until their batch is committed, so an update cannot slip in
+        # between reading the old value and writing the shadow value
+        sql += ' ORDER BY {} LIMIT %s FOR UPDATE'.format(self.pk)
+        params.append(self.batch_size)
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        pks = [row[0] for row in rows]
+
+        if self.key:
+            keys = [self.key] * len(pks)
+        elif key_column:
+            keys = [row[1] for row in rows]
+        else:
+            names = [f.name for f in self.from_model._meta.concrete_fields if not isinstance(f, EncryptedField)]
+            objs = self.from_model._base_manager.using(self.connection.alias).filter(pk__in=pks).only(*names)
+            objs = {obj.pk: obj for obj in objs}
+            keys = [self.key_source(objs[pk]) for pk in pks]
+        for pk, key in zip(pks, keys):
+            if not key:
+                raise ValueError('There is no key for the row {} of {}.'.format(pk, self.from_model._meta.label))
+        return pks, keys
+
+    def get_value_sql(self, source_sql, row_keys):
+        if self.encrypt:
+            compiler = Query(self.from_model).get_compiler(connection=self.connection)
+            return compiler.compile(self.encrypted_field.get_encrypted_value(RawSQL(source_sql, []), row_keys))
+        return DecryptedCol.decrypt_sql(self.encrypted_field, source_sql, self.connection, row_keys)
+
+    def convert_batch(self, pks, keys):
+        row_keys = RowKeys(self.from_model._meta.pk, dict(zip(pks, keys)))
+        value_sql, value_params = self.get_value_sql('{}.{}'.format(self.row_alias, self.column), row_keys)
+        join_sql, join_params = row_keys.join_sql(self.connection, '{}.{}'.format(self.row_alias, self.pk))
+        sql = (
+            'UPDATE {table} SET {shadow} = {row}.value FROM (SELECT {row}.{pk} AS pk, {value} AS value FROM {table} {row}{join}) '
+            '{row} WHERE {table}.{pk} = {row}.pk'
+        ).format(table=self.table, shadow=self.shadow, pk=self.pk, value=value_sql, join=join_sql, row=self.row_alias)
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, list(value_params) + join_params)
+            return cursor.rowcount
+
+    def backfill(self, throttle=True):
+        last = None
+        while True:
+            with transaction.atomic(using=self.connection.alias):
+                pks, keys = self.get_batch(last)
+                if not pks:
+                    return
+                self.rows += self.convert_batch(pks, keys)
+            last = pks[-1]
+            if self.progress:
+                self.progress(self.from_model._meta.label, self.source_field.name, self.rows)
+            if throttle and self.throttle:
+                time.sleep(self.throttle)
+
+    def run(self):
+        self.schema_editor.execute('ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {}'.format(
+            self.table, self.shadow, self.target_field.db_type(self.connection)
+        ))
+        self.create_trigger()
+        self.backfill()
+        with transaction.atomic(using=self.connection.alias):
+            # Reads can go on, but the rows written during the backfill need to be converted now
+            self.schema_editor.execute('LOCK TABLE {} IN EXCLUSIVE MODE'.format(self.table))
+            self.backfill(throttle=False)
+            self.drop_trigger()
+            self.schema_editor.execute('ALTER TABLE {} DROP COLUMN {}'.format(self.table, self.column))
+            self.schema_editor.execute('ALTER TABLE {} RENAME COLUMN {} TO {}'.format(self.table, self.shadow, self.column))
+            if not self.target_field.null:
+                self.schema_editor.execute('ALTER TABLE {} ALTER COLUMN {} SET NOT NULL'.format(self.table, self.column))
+        return self.rows
+
+
+class ColumnConversionOperation(Operation):
+    reduces_to_sql = False
+    encrypt = None
+
+    def __init__(self, model_name, name, field, key=None, key_source=None, batch_size=None, throttle=0,
+                 progress=None):
+        if bool(key) == bool(key_source):
+            raise TypeError('Either a key or a key source needs to be given.')
+        self.model_name = model_name
+        self.name = name
+        self.field = field
+        self.key = key
+        self.key_source = key_source
+        self.batch_size = batch_size
+        self.throttle = throttle
+        self.progress = progress
+
+    @property
+    def model_name_lower(self):
+        return self.model_name.lower()
+
+    def deconstruct(self):
+        kwargs = {'model_name': self.model_name, 'name': self.name, 'field': self.field}
+        for k in ('key', 'key_source', 'batch_size', 'progress'):
+            if getattr(self, k) is not None:
+                kwargs[k] = getattr(self, k)
+        if self.throttle:
+            kwargs['throttle'] = self.throttle
+        return self.__class__.__name__, [], kwargs
+
+    def state_forwards(self, app_label, state):
+        AlterField(self.model_name, self.name, self.field).state_forwards(app_label, state)
+
+    def convert(self, app_label, schema_editor, from_state, to_state, encrypt):
+        to_model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, to_model):
+            return
+        from_model = from_state.apps.get_model(app_label, self.model_name)
+        ColumnConversion(
+            schema_editor, from_model, to_model, self.name, encrypt, self.key, self.key_source, self.batch_size,
+            self.throttle, self.progress,
+        ).run()
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        self.convert(app_label, schema_editor, from_state, to_state, self.encrypt)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        self.convert(app_label, schema_editor, from_state, to_state, not self.encrypt)
+
+    def references_field(self, model_name, name, app_label=None):
+        return model_name.lower() == self.model_name_lower and name.lower() == self.name.lower()
+
+
+class EncryptColumn(ColumnConversionOperation):
+    """
+    Encrypt the existing values of the plaintext field ``name`` of the model
+    ``model_name`` and turn it into the ``EncryptedField`` ``field``. Every row is
+    encrypted with ``key``, or with the key that ``key_source`` returns for it: the
+    name of a column that holds the key, or a function that is called with a model
+    instance that has all unencrypted fields loaded.
+    """
+    encrypt = True
+
+    def __init__(self, model_name, name, field, *args, **kwargs):
+        if not isinstance(field, EncryptedField):
+            raise TypeError('EncryptColumn needs an EncryptedField.')
+        if field.blind_index or field.search_index:
+            raise TypeError('EncryptColumn cannot fill in indexes, enable them in a separate migration.')
+        super().__init__(model_name, name, field, *args, **kwargs)
+
+    def describe(self):
+        return 'Encrypt the values of {} on {}'.format(self.name, self.model_name)
+
+
+class DecryptColumn(ColumnConversionOperation):
+    """
+    Decrypt the existing values of the ``EncryptedField`` ``name`` of the model
+    ``model_name`` and turn it into the plaintext field ``field``. The keys are given
+    like for ``EncryptColumn``.
+    """
+    encrypt = False
+
+    def __init__(self, model_name, name, field, *args, **kwargs):
+        if isinstance(field, EncryptedField):
+            raise TypeError('DecryptColumn needs a field that is not encrypted.')
+        if field.db_index or field.unique:
+            raise TypeError('DecryptColumn cannot create indexes, add them in a separate migration.')
+        super().__init__(model_name, name, field, *args, **kwargs)
+
+    def describe(self):
+        return 'Decrypt the values of {} on {}'.format(self.name, self.model_name)
@@ -0,0 +1,366 @@
+"""
+The subset of OpenPGP (RFC 4880) that is required to read and write the messages of
+pgcrypto's ``pgp_sym_encrypt()`` and ``pgp_sym_decrypt()`` functions, so values can be
+encrypted and decrypted outside of the database.
+
+This requires the ``cryptography`` package.
+"""
+import hashlib
+import os
+import struct
+import time
+import zlib
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:  # pragma: no cover
+    Cipher = None
+try:
+    from cryptography.hazmat.decrepit.ciphers import algorithms as decrepit_algorithms, modes as decrepit_modes
+except ImportError:  # pragma: no cover
+    decrepit_algorithms = decrepit_modes = None
+
+PKT_SYMENCRYPTED_SESSKEY = 3
+PKT_COMPRESSED_DATA = 8
+PKT_SYMENCRYPTED_DATA = 9
+PKT_MARKER = 10
+PKT_LITERAL_DATA = 11
+PKT_SYMENCRYPTED_DATA_MDC = 18
+PKT_MDC = 19
+
+# algorithm id: (name in cryptography, key length)
+CIPHERS = {
+    2: ('TripleDES', 24),
+    3: ('CAST5', 16),
+    4: ('Blowfish', 16),
+    7: ('AES', 16),
+    8: ('AES', 24),
+    9: ('AES', 32),
+}
+DIGESTS = {
+    1: 'md5',
+    2: 'sha1',
+    3: 'ripemd160',
+    8: 'sha256',
+    9: 'sha384',
+    10: 'sha512',
+    11: 'sha224',
+}
+
+# The defaults of pgp_sym_encrypt()
+DEFAULT_CIPHER = 7
+DEFAULT_S2K_DIGEST = 2
+
+# The values pgcrypto accepts for the options of pgp_sym_encrypt()
+CIPHER_NAMES = {'3des': 2, 'cast5': 3, 'bf': 4, 'aes128': 7, 'aes192': 8, 'aes256': 9}
+S2K_DIGEST_NAMES = {'md5': 1, 'sha1': 2}
+COMPRESS_NAMES = {'none': 0, 'zip': 1, 'zlib': 2}
+
+# Our names of the options of pgp_sym_encrypt(), with their names in pgcrypto
+OPTIONS = {
+    'cipher': 'cipher-algo',
+    's2k_mode': 's2k-mode',
+    's2k_count': 's2k-count',
+    's2k_digest': 's2k-digest-algo',
+    'compress': 'compress-algo',
+    'compress_level': 'compress-level',
+}
+
+
+class PGPError(ValueError):
+    pass
+
+
+def _get_algorithm(cipher_algo, key):
+    if Cipher is None:
+        raise PGPError('Encryption outside of the database requires the cryptography package.')
+    try:
+        name, key_len = CIPHERS[cipher_algo]
+    except KeyError:
+        raise PGPError('Unsupported cipher algorithm')
+    # Legacy ciphers have been moved to a separate module in newer versions of cryptography
+    algorithm_class = getattr(decrepit_algorithms, name, None) or getattr(algorithms, name)
+    return algorithm_class(key)
+
+
+def _cfb(cipher_algo, key, iv, data, encrypt):
+    algorithm = _get_algorithm(cipher_algo, key)
+    mode = getattr(decrepit_modes, 'CFB', None) or modes.CFB
+    cipher = Cipher(algorithm, mode(iv or b'\x00' * (algorithm.block_size // 8)), backend=default_backend())
+    ctx = cipher.encryptor() if encrypt else cipher.decryptor()
+    return ctx.update(data) + ctx.finalize()
+
+
+def _block_size(cipher_algo):
+    return 16 if CIPHERS[cipher_algo][0] == 'AES' else 8
+
+
+def s2k_count(count_byte):
+    return (16 + (count_byte & 15)) << ((count_byte >> 4) + 6)
+
+
+def s2k(password, mode, digest_algo, salt, count, key_len):
+    """
+    Derive a key from ``password`` with one of the OpenPGP string-to-key specifiers.
+    """
+    try:
+        digest = DIGESTS[digest_algo]
+    except KeyError:
+        raise PGPError('Unsupported digest algorithm')
+    data = (salt if mode else b'') + password
+    if mode == 3:
+        full, rest = divmod(max(count, len(data)), len(data))
+        data = data * full + data[:rest]
+    key = b''
+    while len(key) < key_len:
+        h = hashlib.new(digest, b'\x00' * (len(key) // hashlib.new(digest).digest_size))
+        h.update(data)
+        key += h.digest()
+    return key[:key_len]
+
+
+def check_options(options):
+    """
+    Raise ``PGPError`` if ``options`` contains an option or value that pgcrypto
+    does not support.
+    """
+    choices = {
+        'cipher': CIPHER_NAMES,
+        's2k_mode': (0, 1, 3),
+        's2k_digest': S2K_DIGEST_NAMES,
+        'compress': COMPRESS_NAMES,
+        'compress_level': range(10),
+    }
+    for name, value in options.items():
+        if name not in OPTIONS:
+            raise PGPError('Unknown option {}'.format(name))
+        if name == 's2k_count':
+            if not isinstance(value, int) or not 1024 <= value <= 65011712:
+                raise PGPError('s2k_count needs to be between 1024 and 65011712')
+        elif value not in choices[name]:
+            raise PGPError('Unsupported value {!r} for option {}'.format(value, name))
+
+
+def options_string(options):
+    """
+    Format ``options`` as the options argument of pgcrypto's ``pgp_sym_encrypt()``.
+    """
+    parts = []
+    for name, value in sorted(options.items()):
+        if name == 'compress':
+            value = COMPRESS_NAMES[value]
+        parts.append('{}={}'.format(OPTIONS[name], value))
+    return ', '.join(parts)
+
+
+def _read_new_length(data, pos):
+    if pos >= len(data):
+        raise PGPError('Corrupt data')
+    first = data[pos]
+    if first < 192:
+        return first, pos + 1, False
+    elif first < 224:
+        return ((first - 192) << 8) + data[pos + 1] + 192, pos + 2, False
+    elif first == 255:
+        return struct.unpack('>I', data[pos + 1:pos + 5])[0], pos + 5, False
+    # Partial body length, another length follows after this chunk
+    return 1 << (first & 0x1f), pos + 1, True
+
+
+def _read_packets(data):
+    pos = 0
+    while pos < len(data):
+        header = data[pos]
+        pos += 1
+        if not header & 0x80:
+            raise PGPError('Corrupt data')
+        body = []
+        if header & 0x40:
+            tag = header & 0x3f
+            while True:
+                length, pos, partial = _read_new_length(data, pos)
+                body.append(data[pos:pos + length])
+                pos += length
+                if not partial:
+                    break
+        else:
+            tag = (header >> 2) & 0x0f
+            length_type = header & 3
+            if length_type == 3:
+                length = len(data) - pos
+            else:
+                size = (1, 2, 4)[length_type]
+                length = int.from_bytes(data[pos:pos + size], 'big')
+                pos += size
+            body.append(data[pos:pos + length])
+            pos += length
+        if pos > len(data):
+            raise PGPError('Corrupt data')
+        yield tag, b''.join(body)
+
+
+def _write_packet(tag, body):
+    length = len(body)
+    if length < 192:
+        header = bytes([length])
+    elif length < 8384:
+        length -= 192
+        header = bytes([(length >> 8) + 192, length & 0xff])
+    else:
+        header = b'\xff' + struct.pack('>I', length)
+    return bytes([0xc0 | tag]) + header + body
+
+
+def _parse_session_key(body, password):
+    if len(body) < 4 or body[0] != 4:
+        raise PGPError('Corrupt data')
+    cipher_algo, mode, digest_algo = body[1], body[2], body[3]
+    if mode == 0:
+        salt, count, pos = b'', 0, 4
+    elif mode == 1:
+        salt, count, pos = body[4:12], 0, 12
+    elif mode == 3:
+        salt, count, pos = body[4:12], s2k_count(body[12]), 13
+    else:
+        raise PGPError('Unsupported S2K mode')
+    if cipher_algo not in CIPHERS:
+        raise PGPError('Unsupported cipher algorithm')
+    key = s2k(password, mode, digest_algo, salt, count, CIPHERS[cipher_algo][1])
+    if pos < len(body):
+        # The actual session key has been encrypted with the derived key
+        session_key = _cfb(cipher_algo, key, None, body[pos:], encrypt=False)
+        cipher_algo, key = session_key[0], session_key[1:]
+        if cipher_algo not in CIPHERS or len(key) != CIPHERS[cipher_algo][1]:
+            raise PGPError('Wrong key or corrupt data')
+    return cipher_algo, key
+
+
+def _decrypt_data(tag, body, cipher_algo, key):
+    bs = _block_size(cipher_algo)
+    if tag == PKT_SYMENCRYPTED_DATA_MDC:
+        if not body or body[0] != 1:
+            raise PGPError('Corrupt data')
+        plain = _cfb(cipher_algo, key, None, body[1:], encrypt=False)
+        if len(plain) < bs + 2 + 22 or plain[bs - 2:bs] != plain[bs:bs + 2]:
+            raise PGPError('Wrong key or corrupt data')
+        if plain[-22:-20] != b'\xd3\x14' or hashlib.sha1(plain[:-20]).digest() != plain[-20:]:
+            raise PGPError('Corrupt data')
+        return plain[bs + 2:-22]
+    else:
+        prefix = _cfb(cipher_algo, key, None, body[:bs + 2], encrypt=False)
+        if len(prefix) < bs + 2 or prefix[bs - 2:bs] != prefix[bs:bs + 2]:
+            raise PGPError('Wrong key or corrupt data')
+        # Old-style packets resynchronize the CFB state after the prefix
+        return _cfb(cipher_algo, key, body[2:bs + 2], body[bs + 2:], encrypt=False)
+
+
+def _decompress(body):
+    algo = body[0] if body else -1
+    try:
+        if algo == 0:
+            return body[1:]
+        elif algo == 1:
+            return zlib.decompress(body[1:], -15)
+        elif algo == 2:
+            return zlib.decompress(body[1:])
+    except zlib.error:
+        raise PGPError('Corrupt data')
+    raise PGPError('Unsupported compression algorithm')
+
+
+def _parse_literal(data, text):
+    for tag, body in _read_packets(data):
+        if tag == PKT_COMPRESSED_DATA:
+            return _parse_literal(_decompress(body), text)
+        elif tag == PKT_LITERAL_DATA:
+            if len(body) < 6:
+                raise PGPError('Corrupt data')
+            data_type = body[0:1]
+            if text and data_type not in (b't', b'u'):
+                raise PGPError('Not text data')
+            return body[6 + body[1]:]
+        elif tag != PKT_MARKER:
+            raise PGPError('Unexpected packet in stream')
+    raise PGPError('Corrupt data')
+
+
+def decrypt(data, password, text=True):
+    """
+    Decrypt a message created with ``pgp_sym_encrypt()`` (``text=True``) or
+    ``pgp_sym_encrypt_bytea()`` (``text=False``) and return the raw plaintext.
+    """
+    data = bytes(data)
+    password = password.encode('utf-8') if isinstance(password, str) else password
+    session = None
+    for tag, body in _read_packets(data):
+        if tag == PKT_SYMENCRYPTED_SESSKEY:
+            if session is None:
+                session = _parse_session_key(body, password)
+        elif tag in (PKT_SYMENCRYPTED_DATA, PKT_SYMENCRYPTED_DATA_MDC):
+            if session is None:
+                raise PGPError('Corrupt data')
+            return _parse_literal(_decrypt_data(tag, body, *session), text)
+        elif tag != PKT_MARKER:
+            raise PGPError('Unexpected packet in stream')
+    raise PGPError('Corrupt data')
+
+
+def _s2k_iterations(count):
+    """
+    Return the encoded S2K count that pgcrypto would use for ``count``, and its value.
+    """
+    if count is None:
+        # pgcrypto picks a random count between 65536 and 253952
+        count_byte = 96 + (os.urandom(1)[0] & 0x1F)
+    else:
+        count_byte = next(b for b in range(256) if s2k_count(b) >= count)
+    return count_byte, s2k_count(count_byte)
+
+
+def _compress(algo, level, data):
+    if algo == 1:
+        c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    else:
+        c = zlib.compressobj(level)
+    return _write_packet(PKT_COMPRESSED_DATA, bytes([algo]) + c.compress(data) + c.flush())
+
+
+def encrypt(data, password, text=True, cipher='aes128', s2k_mode=3, s2k_count=None, s2k_digest='sha1',
+            compress='none', compress_level=6):
+    """
+    Encrypt ``data`` into a message that can be read by ``pgp_sym_decrypt()``
+    (``text=True``) or ``pgp_sym_decrypt_bytea()`` (``text=False``). The options
+    and their defaults are the same as those of pgcrypto.
+    """
+    password = password.encode('utf-8') if isinstance(password, str) else password
+    cipher_algo, digest_algo = CIPHER_NAMES[cipher], S2K_DIGEST_NAMES[s2k_digest]
+    bs = _block_size(cipher_algo)
+    salt = os.urandom(8) if s2k_mode else b''
+    session_key = bytes([4, cipher_algo, s2k_mode, digest_algo]) + salt
+    count = 0
+    if s2k_mode == 3:
+        count_byte, count = _s2k_iterations(s2k_count)
+        session_key += bytes([count_byte])
+    key = s2k(password, s2k_mode, digest_algo, salt, count, CIPHERS[cipher_algo][1])
+    session_key = _write_packet(PKT_SYMENCRYPTED_SESSKEY, session_key)
+
+    literal = _write_packet(
+        PKT_LITERAL_DATA,
+        (b't' if text else b'b') + b'\x00' + struct.pack('>I', int(time.time()) & 0xffffffff) + bytes(data)
+    )
+    if COMPRESS_NAMES[compress] and compress_level:
+        literal = _compress(COMPRESS_NAMES[compress], compress_level, literal)
+    prefix = os.urandom(bs)
+    plain = prefix + prefix[-2:] + literal + b'\xd3\x14'
+    plain += hashlib.sha1(plain).digest()
+    encrypted = _write_packet(PKT_SYMENCRYPTED_DATA_MDC, b'\x01' + _cfb(cipher_algo, key, None, plain, encrypt=True))
+    return session_key + encrypted
+
+
+def pgp_sym_encrypt(data, password, **options):
+    return encrypt(data.encode('utf-8'), password, text=True, **options)
+
+
+def pgp_sym_decrypt(data, password):
+    return decrypt(data, password, text=True).decode('utf-8')
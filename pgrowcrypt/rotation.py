@@ -0,0 +1,244 @@
+"""
+Re-encrypts the rows of a model with a new key inside the database. The rows are
+processed in batches of consecutive primary keys, every batch is a single ``UPDATE``
+statement in its own transaction.
+
+Progress can be recorded in a checkpoint file, so an interrupted rotation can be
+resumed. The range of every batch is written to the file before it is handed to a
+worker, and the ID of its transaction right before it is committed, so on resume we can
+ask PostgreSQL whether it has been committed.
+"""
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.db import NotSupportedError, connections, router, transaction
+from django.db.models import F, Q, QuerySet
+
+from . import engine
+from .crypto import key_fingerprint
+from .models.fields import EncryptedField, KeyFingerprintField
+from .models.keys import query_key
+from .models.manager import close_connections
+
+
+def _batch_order(batch):
+    # The first batch has no lower bound
+    return batch['lower'] is not None, batch['lower']
+
+
+class Checkpoint:
+    """
+    The progress of a rotation: all rows up to the primary key ``last`` have been
+    rotated, and the batches in ``pending`` after it, ordered by their range, have been
+    scheduled. They are scheduled in order, so their ranges follow each other without
+    gaps. Every batch records the ID of its transaction right before it commits.
+    """
+
+    def __init__(self, path, label):
+        self.path = path
+        self.label = label
+        self.last = None
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def load(self, connection):
+        """
+        Read the checkpoint file and return the batches that need to be repeated, from the
+        lowest one.
+        """
+        if not self.path or not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            data = json.load(f)
+        if data['model'] != self.label:
+            raise ValueError('The checkpoint {} belongs to a rotation of {}.'.format(self.path, data['model']))
+        self.last = data['last']
+
+        with connection.cursor() as cursor:
+            for lower, upper, txid in data['pending']:
+                status = 'aborted'
+                if txid is not None:
+                    cursor.execute('SELECT txid_status(%s)', [txid])
+                    status = cursor.fetchone()[0]
+                if status not in ('committed', 'aborted'):
+                    raise ValueError(
+                        'The state of the batch ({}, {}] of the rotation is unknown.'.format(lower, upper)
+                    )
+                self.pending.append({'lower': lower, 'upper': upper, 'txid': txid, 'done': status == 'committed'})
+        self.pending.sort(key=_batch_order)
+        return [(b['lower'], b['upper']) for b in self.pending if not b['done']]
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = '{}.tmp'.format(self.path)
+        with open(tmp, 'w') as f:
+            json.dump({
+                'model': self.label,
+                'last': self.last,
+                'pending': [[b['lower'], b['upper'], b['txid']] for b in self.pending],
+            }, f)
+        os.replace(tmp, self.path)
+
+    def get(self, lower, upper):
+        for batch in self.pending:
+            if batch['lower'] == lower and batch['upper'] == upper:
+                return batch
+
+    def start(self, lower, upper):
+        with self.lock:
+            batch = self.get(lower, upper)
+            if batch is None:
+                self.pending.append({'lower': lower, 'upper': upper, 'txid': None, 'done': False})
+                self.pending.sort(key=_batch_order)
+            else:
+                batch['txid'] = None
+            self.save()
+
+    def committing(self, lower, upper, txid):
+        with self.lock:
+            self.get(lower, upper)['txid'] = txid
+            self.save()
+
+    def committed(self, lower, upper):
+        with self.lock:
+            self.get(lower, upper)['done'] = True
+            # Batches can finish out of order with multiple workers
+            while self.pending and self.pending[0]['done'] and self.pending[0]['lower'] == self.last:
+                self.last = self.pending.pop(0)['upper']
+            self.save()
+
+    def finish(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class KeyRotation:
+
+    def __init__(self, model, old_key, new_key, filter=None, batch_size=None, using=None, checkpoint=None,
+                 throttle=0):
+        if not old_key or not new_key:
+            raise TypeError("Both the old and the new key need to be set.")
+        self.model = model
+        self.old_key = old_key
+        self.new_key = new_key
+        if isinstance(filter, dict):
+            filter = Q(**filter)
+        self.filter = filter or Q()
+        self.batch_size = batch_size or engine.batch_size()
+        self.using = using or router.db_for_write(model)
+        self.throttle = throttle
+        self.checkpoint = Checkpoint(checkpoint, model._meta.label)
+        self.fields = [f for f in model._meta.concrete_fields if isinstance(f, EncryptedField)]
+        self.fingerprint_field = next((f for f in model._meta.concrete_fields if isinstance(f, KeyFingerprintField)), None)
+        self.rows = 0
+
+    def get_queryset(self):
+        qs = self.model._base_manager.db_manager(self.using).all().filter(self.filter)
+        if self.fingerprint_field:
+            # Rows from before the field was added have no fingerprint yet
+            qs = qs.filter(
+                Q(**{self.fingerprint_field.name: key_fingerprint(self.old_key)})
+                | Q(**{'{}__isnull'.format(self.fingerprint_field.name): True})
+            )
+        return qs
+
+    def get_batches(self, last):
+        """
+        Yield the ranges ``(lower, upper]`` of primary keys of the batches after ``last``.
+        """
+        qs = self.get_queryset().order_by('pk').values_list('pk', flat=True)
+        while True:
+            batch = qs.filter(pk__gt=last) if last is not None else qs
+            with query_key(connections[self.using], self.old_key):
+                pks = list(batch[:self.batch_size])
+            if not pks:
+                return
+            yield last, pks[-1]
+            last = pks[-1]
+
+    def get_values(self):
+        values = {}
+        for f in self.fields:
+            # F() resolves to the column decrypted with the key of the connection
+            values.update(f.get_companion_values(F(f.name), self.new_key))
+            values[f.attname] = f.get_encrypted_value(F(f.name), self.new_key)
+        if self.fingerprint_field:
+            values[self.fingerprint_field.attname] = key_fingerprint(self.new_key)
+        return values
+
+    def rotate_batch(self, lower, upper):
+        connection = connections[self.using]
+        qs = self.get_queryset().filter(pk__lte=upper)
+        if lower is not None:
+            qs = qs.filter(pk__gt=lower)
+        with transaction.atomic(using=self.using), query_key(connection, self.old_key):
+            # The values are encrypted already, so we don't use EncryptedColumnsQuerySet.update()
+            rows = QuerySet.update(qs, **self.get_values())
+            if self.checkpoint.path:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT txid_current()')
+                    self.checkpoint.committing(lower, upper, cursor.fetchone()[0])
+        self.checkpoint.committed(lower, upper)
+        if self.throttle:
+            time.sleep(self.throttle)
+        return rows
+
+    def schedule(self, batches):
+        """
+        Record the ranges ``(lower, upper]`` of ``batches`` in the checkpoint in the order
+        they are handed out, before any of them runs.
+        """
+        for lower, upper in batches:
+            self.checkpoint.start(lower, upper)
+            yield lower, upper
+
+    def run(self, workers=1):
+        connection = connections[self.using]
+        if self.checkpoint.path and connection.pg_version < 100000:
+            # txid_status() tells us on resume whether a batch has been committed
+            raise NotSupportedError('A checkpoint of a key rotation requires PostgreSQL 10 or newer.')
+        # The batches that have not been committed, from the lowest one, and then the
+        # rows after all scheduled batches
+        retry = self.checkpoint.load(connection)
+        last = self.checkpoint.last
+        if self.checkpoint.pending:
+            last = self.checkpoint.pending[-1]['upper']
+        batches = self.schedule(itertools.chain(retry, self.get_batches(last)))
+
+        if workers <= 1:
+            for lower, upper in batches:
+                self.rows += self.rotate_batch(lower, upper)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = set()
+                try:
+                    for lower, upper in batches:
+                        if len(futures) >= workers * 2:
+                            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                            self.rows += sum(f.result() for f in done)
+                        futures.add(pool.submit(self.rotate_batch, lower, upper))
+                    self.rows += sum(f.result() for f in futures)
+                finally:
+                    # Threads don't share connections, so every worker has opened its own
+                    wait(futures)
+                    close_connections(pool, workers, self.using)
+        self.checkpoint.finish()
+        return self.rows
+
+
+def rotate_key(model, old_key, new_key, filter=None, batch_size=None, workers=1, using=None, checkpoint=None,
+               throttle=0):
+    """
+    Re-encrypt all rows of ``model`` that match ``filter`` (a ``Q`` object or a
+    dictionary of lookups) from ``old_key`` to ``new_key``, in batches of
+    ``batch_size`` rows. With ``workers``, batches run in parallel on separate
+    connections. Progress is recorded in the file ``checkpoint``, if given, and a
+    rotation with the same checkpoint resumes where the last one stopped. ``throttle``
+    is a pause in seconds after every batch. Returns the number of rotated rows.
+    """
+    return KeyRotation(model, old_key, new_key, filter, batch_size, using, checkpoint, throttle).run(workers)
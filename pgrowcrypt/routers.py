@@ -0,0 +1,87 @@
+"""
+A database router that sends the reads of encrypted models to read replicas, where the
+decryption does not compete with the writes on the primary.
+"""
+import random
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .models.keys import context_var
+
+# Whether the reads in the current block go to the primary: None outside of
+# read_your_writes(), False until the first write in it and True afterwards
+_primary_reads = context_var('pgrowcrypt_primary_reads')
+
+
+@contextmanager
+def read_your_writes():
+    """
+    Send the reads of encrypted models in this block to the primary once anything has
+    been written in it, so they don't miss writes that have not reached the replicas
+    yet. Useful around a request or a task.
+    """
+    token = _primary_reads.set(False)
+    try:
+        yield
+    finally:
+        _primary_reads.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    """
+    Send all reads of encrypted models in this block to the primary.
+    """
+    token = _primary_reads.set(True)
+    try:
+        yield
+    finally:
+        _primary_reads.reset(token)
+
+
+class ReplicaRouter:
+    """
+    Sends the reads of encrypted models to one of the databases in the
+    ``PGROWCRYPT_REPLICAS`` setting and their writes to ``PGROWCRYPT_PRIMARY``
+    (default: ``'default'``). Other models are left to the next router. Reads go to the
+    primary inside ``primary_reads()`` and after a write inside ``read_your_writes()``.
+    """
+
+    @property
+    def primary(self):
+        return getattr(settings, 'PGROWCRYPT_PRIMARY', 'default')
+
+    @property
+    def replicas(self):
+        return list(getattr(settings, 'PGROWCRYPT_REPLICAS', []))
+
+    @property
+    def databases(self):
+        return [self.primary] + self.replicas
+
+    def is_encrypted(self, model):
+        return hasattr(model._default_manager, 'with_key')
+
+    def db_for_read(self, model, **hints):
+        if not self.is_encrypted(model):
+            return None
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db in self.databases:
+            # Related objects are read from where their instance came from
+            return instance._state.db
+        if not self.replicas or _primary_reads.get():
+            return self.primary
+        return random.choice(self.replicas)
+
+    def db_for_write(self, model, **hints):
+        if not self.is_encrypted(model):
+            return None
+        if _primary_reads.get() is False:
+            _primary_reads.set(True)
+        return self.primary
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._state.db in self.databases and obj2._state.db in self.databases:
+            return True
+        return None
@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+# Sent after every statement that encrypted or decrypted values, while a key is in use
+# on the connection. Arguments: ``connection`` and ``stats``, a
+# ``pgrowcrypt.instrumentation.QueryStats``. The sender is the model whose encrypted
+# columns the statement referenced first, if any.
+query_executed = Signal()
@@ -0,0 +1,77 @@
+"""
+Helpers to check the cryptographic work of queries in tests, similar to Django's
+``CaptureQueriesContext`` and ``assertNumQueries``.
+"""
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from .signals import query_executed
+
+try:
+    import pytest
+except ImportError:  # pragma: no cover
+    pytest = None
+
+
+class CaptureCryptoContext:
+    """
+    Record the ``QueryStats`` of all statements executed on the connection ``using``
+    within this block.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.connection = connections[using]
+        self.captured_stats = []
+
+    def receive(self, sender, connection, stats, **kwargs):
+        if connection.alias == self.connection.alias:
+            self.captured_stats.append(stats)
+
+    def __enter__(self):
+        query_executed.connect(self.receive)
+        return self
+
+    def __exit__(self, *exc_info):
+        query_executed.disconnect(self.receive)
+
+    @property
+    def decryptions(self):
+        """
+        The number of decrypting expressions and of columns decrypted by the Python
+        engine, in all statements.
+        """
+        return sum(s.decryptions + s.client_decryptions for s in self.captured_stats)
+
+    @property
+    def encryptions(self):
+        return sum(s.encryptions + s.client_encryptions for s in self.captured_stats)
+
+    def describe(self):
+        return '\n'.join(
+            '{}. {!r}: {}'.format(i, s, s.sql) for i, s in enumerate(self.captured_stats, start=1)
+        )
+
+
+@contextmanager
+def assert_num_decryptions(num, using=DEFAULT_DB_ALIAS, exact=True):
+    """
+    Assert that the statements executed within this block contain ``num`` decryptions
+    (or, without ``exact``, at most ``num``).
+    """
+    with CaptureCryptoContext(using) as context:
+        yield context
+    if exact and context.decryptions != num or not exact and context.decryptions > num:
+        raise AssertionError('Expected {}{} decryptions, but {} were done:\n{}'.format(
+            '' if exact else 'at most ', num, context.decryptions, context.describe()
+        ))
+
+
+if pytest is not None:
+    @pytest.fixture
+    def django_assert_num_decryptions():
+        """
+        A fixture for ``assert_num_decryptions``. Import it into your ``conftest.py``
+        to use it.
+        """
+        return assert_num_decryptions
@@ -39,7 +39,10 @@ setup(
     keywords='encryption database models',
     install_requires=[
     ],
+    extras_require={
+        'python-engine': ['cryptography'],
+    },
 
-    packages=find_packages(exclude=['tests', 'tests.*', 'demoproject', 'demoproject.*']),
+    packages=find_packages(exclude=['tests', 'tests.*', 'benchmarks', 'benchmarks.*', 'demoproject', 'demoproject.*']),
     include_package_data=True,
 )
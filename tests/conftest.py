@@ -1,6 +1,10 @@
 import os
+import sys
 
 import pytest
+from django.db import connection
+
+from pgrowcrypt.testing import django_assert_num_decryptions  # noqa
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
 
@@ -8,6 +12,11 @@ import django
 
 django.setup()
 
+collect_ignore = []
+if sys.version_info < (3, 7):
+    # The tests of the asynchronous methods use async def and asyncio.run()
+    collect_ignore.append('test_async.py')
+
 
 @pytest.fixture(params=[
     "BQXhsXpgjbsa8Yj8r4ttrSciXLMJxJ",
@@ -19,4 +28,20 @@ django.setup()
     "key:with:parameters:%s:%s"
 ])
 def key(request):
-    return request.param
\ No newline at end of file
+    return request.param
+
+
+@pytest.fixture
+def ciphertexts():
+    """
+    Return a function that reads the stored bytes of a column of a model's table,
+    ordered by primary key.
+    """
+    def ciphertexts(model, column):
+        qn = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT {} FROM {} ORDER BY {}'.format(
+                qn(column), qn(model._meta.db_table), qn(model._meta.pk.column)
+            ))
+            return [bytes(value) if value is not None else None for value, in cursor.fetchall()]
+    return ciphertexts
@@ -17,6 +17,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'pgrowcrypt',
     'tests.testapp'
 ]
 
@@ -54,9 +55,16 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
         'NAME': 'pgrowcrypt',
-    }
+    },
 }
 
+if os.environ.get('PGROWCRYPT_TEST_REPLICA'):
+    # Only used by the tests of the replica router, which are skipped without it
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ['PGROWCRYPT_TEST_REPLICA'],
+    }
+
 STATIC_URL = '/static/'
 
 LANGUAGE_CODE = 'en'
@@ -0,0 +1,106 @@
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, connection
+from django.test.utils import CaptureQueriesContext
+
+from pgrowcrypt import crypto
+from pgrowcrypt.models import EncryptedTextField
+from pgrowcrypt.rotation import rotate_key
+
+from .testapp.models import Note
+
+
+def test_aes_field_options():
+    assert EncryptedTextField(format='aes').deconstruct()[3] == {'format': 'aes'}
+    with pytest.raises(ImproperlyConfigured):
+        EncryptedTextField(format='rot13')
+    with pytest.raises(ImproperlyConfigured):
+        EncryptedTextField(format='aes', cipher='aes256')
+    with pytest.raises(ImproperlyConfigured):
+        EncryptedTextField(format='aes', deterministic=True)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('engine', ['database', 'python'])
+def test_aes_storage(key, settings, engine, ciphertexts):
+    settings.PGROWCRYPT_ENGINE = engine
+    with CaptureQueriesContext(connection) as ctx:
+        Note.objects.create(body='Buy milk', _key=key)
+    assert 'pgp_sym_encrypt' not in ctx.captured_queries[0]['sql']
+    Note.objects.create(body='Buy milk', _key=key)
+    first, second = ciphertexts(Note, 'body')
+    assert first[:1] == b'\x02' and second[:1] == b'\x02'
+    # Random IVs
+    assert first != second
+    for engine in ('database', 'python'):
+        settings.PGROWCRYPT_ENGINE = engine
+        assert list(Note.objects.with_key(key).values_list('body', flat=True)) == ['Buy milk', 'Buy milk']
+        assert Note.objects.with_key(key).filter(body__startswith='Buy').count() == 2
+
+
+@pytest.mark.django_db
+def test_aes_update_ivs(key, ciphertexts):
+    for i in range(3):
+        Note.objects.create(body='Note {}'.format(i), _key=key)
+    Note.objects.with_key(key).update(body='Buy milk')
+    assert len(set(ciphertexts(Note, 'body'))) == 3
+    assert list(Note.objects.with_key(key).values_list('body', flat=True)) == ['Buy milk'] * 3
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('engine', ['database', 'python'])
+def test_aes_authenticated(key, settings, engine, ciphertexts):
+    settings.PGROWCRYPT_ENGINE = engine
+    Note.objects.create(body='Buy milk', _key=key)
+    ciphertext, = ciphertexts(Note, 'body')
+    assert len(ciphertext) == 1 + 16 + 16 + 32
+    # Flip a bit of the IV, which would change the first block of the plaintext
+    tampered = ciphertext[:1] + bytes([ciphertext[1] ^ 1]) + ciphertext[2:]
+    with connection.cursor() as cursor:
+        cursor.execute('UPDATE testapp_note SET body = %s', [tampered])
+    with pytest.raises((DatabaseError, ValueError)):
+        list(Note.objects.with_key(key).values_list('body', flat=True))
+    with pytest.raises(ValueError):
+        crypto.decrypt_aes(tampered, key)
+
+
+@pytest.mark.django_db
+def test_aes_key_setting(key, settings):
+    settings.PGROWCRYPT_KEY_MODE = 'setting'
+    n = Note.objects.create(body='Buy milk', _key=key)
+    Note.objects.with_key(key).update(body='Buy bread')
+    assert Note.objects.with_key(key).get(pk=n.pk).body == 'Buy bread'
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('engine', ['database', 'python'])
+def test_aes_reads_pgp_messages(key, settings, engine, ciphertexts):
+    Note.objects.create(body='Buy milk', _key=key)
+    with connection.cursor() as cursor:
+        cursor.execute("INSERT INTO testapp_note (body) VALUES (pgp_sym_encrypt('Buy bread', %s))", [key])
+    settings.PGROWCRYPT_ENGINE = engine
+    assert sorted(Note.objects.with_key(key).values_list('body', flat=True)) == ['Buy bread', 'Buy milk']
+    # Re-encrypting with the same key converts all rows to the format of the field
+    assert rotate_key(Note, key, key) == 2
+    assert [c[:1] for c in ciphertexts(Note, 'body')] == [b'\x02', b'\x02']
+    assert sorted(Note.objects.with_key(key).values_list('body', flat=True)) == ['Buy bread', 'Buy milk']
+
+
+def test_key_cache(settings, monkeypatch):
+    derived = []
+
+    def hkdf(key, info, length):
+        derived.append(key)
+        return bytes(length)
+
+    monkeypatch.setattr(crypto, '_hkdf', hkdf)
+    crypto.key_cache.clear()
+    settings.PGROWCRYPT_KEY_CACHE_SIZE = 2
+    for key in ('a', 'b', 'a', 'c', 'a', 'b'):
+        crypto.derive_key(key, crypto.AES_ENCRYPTION_KEY)
+    assert derived == ['a', 'b', 'c', 'b']
+    settings.PGROWCRYPT_KEY_CACHE_TTL = 0
+    crypto.derive_key('d', crypto.AES_ENCRYPTION_KEY)
+    crypto.derive_key('d', crypto.AES_ENCRYPTION_KEY)
+    assert derived[-2:] == ['d', 'd']
+    crypto.key_cache.clear()
@@ -0,0 +1,112 @@
+import asyncio
+import threading
+
+import pytest
+from django.db import connection, connections
+
+from pgrowcrypt.models import encryption_key
+from pgrowcrypt.models.keys import query_key
+
+from .test_keys import current_key
+from .testapp.models import Author, Book
+
+sync_to_async = pytest.importorskip('asgiref.sync').sync_to_async
+
+
+def run(coroutine):
+    async def main():
+        try:
+            return await coroutine
+        finally:
+            # The thread-sensitive code runs in a thread with connections of its own
+            await sync_to_async(connections.close_all, thread_sensitive=True)()
+
+    return asyncio.run(main())
+
+
+@pytest.mark.django_db
+def test_encryption_key(key):
+    with encryption_key(key):
+        b = Book.objects.create(title='The Hobbit')
+        Book(title='The Lord of the Rings').save()
+        assert Book.objects.get(pk=b.pk).title == 'The Hobbit'
+        with encryption_key('other'):
+            Author.objects.create(name='J. R. R. Tolkien')
+        assert sorted(Book.objects.values_list('title', flat=True)) == ['The Hobbit', 'The Lord of the Rings']
+    assert Author.objects.with_key('other').get().name == 'J. R. R. Tolkien'
+    with pytest.raises(TypeError):
+        Book.objects.create(title='Harry Potter')
+
+
+@pytest.mark.django_db
+def test_nested_keys():
+    Book.objects.create(title='The Hobbit', _key='a')
+    Author.objects.create(name='J. R. R. Tolkien', _key='b')
+    for book in Book.objects.with_key('a').iterator():
+        # The inner query uses its own key while the outer one is still open
+        assert Author.objects.with_key('b').get().name == 'J. R. R. Tolkien'
+        assert book.title == 'The Hobbit'
+    with query_key(connection, 'a'):
+        assert Book.objects.get().title == 'The Hobbit'
+        assert connection._pgrowcrypt_key == 'a'
+
+
+@pytest.mark.django_db
+def test_nested_keys_setting(settings):
+    settings.PGROWCRYPT_KEY_MODE = 'setting'
+    Book.objects.create(title='The Hobbit', _key='a')
+    Author.objects.create(name='J. R. R. Tolkien', _key='b')
+    with query_key(connection, 'a'):
+        assert Author.objects.with_key('b').get().name == 'J. R. R. Tolkien'
+        assert current_key() == 'a'
+        assert Book.objects.get().title == 'The Hobbit'
+    assert not current_key()
+
+
+@pytest.mark.django_db
+def test_encryption_key_threads():
+    results = {}
+
+    def work(key):
+        with encryption_key(key):
+            barrier.wait()
+            results[key] = Book(title='The Hobbit')._EncryptedModel__key
+
+    barrier = threading.Barrier(2)
+    threads = [threading.Thread(target=work, args=(k,)) for k in ('a', 'b')]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == {'a': 'a', 'b': 'b'}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_queryset(key):
+    async def main():
+        await Book.objects.with_key(key).abulk_create([Book(title='The Hobbit', _key=key), Book(title='Harry Potter', _key=key)])
+        b = await Book.objects.with_key(key).acreate(title='The Lord of the Rings')
+        assert (await Book.objects.with_key(key).aget(pk=b.pk)).title == 'The Lord of the Rings'
+        assert await Book.objects.with_key(key).filter(title__startswith='The').acount() == 2
+        assert sorted([b.title async for b in Book.objects.with_key(key).aiterator(chunk_size=2)]) == [
+            'Harry Potter', 'The Hobbit', 'The Lord of the Rings'
+        ]
+        b.title = 'The Silmarillion'
+        await b.asave()
+        assert [b.title async for b in Book.objects.with_key(key).filter(pk=b.pk)] == ['The Silmarillion']
+
+    run(main())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_tasks_keys():
+    async def task(key, title):
+        with encryption_key(key):
+            b = await Book.objects.acreate(title=title)
+            await asyncio.sleep(0)
+            return (await Book.objects.filter(pk=b.pk).aget()).title
+
+    async def main():
+        return await asyncio.gather(*(task('key {}'.format(i), 'Volume {}'.format(i)) for i in range(5)))
+
+    assert run(main()) == ['Volume {}'.format(i) for i in range(5)]
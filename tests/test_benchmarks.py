@@ -0,0 +1,19 @@
+import pytest
+from benchmarks.run import (
+    OPERATIONS, SINGLE_KEY_OPERATIONS, compare, get_benchmarks, run_benchmarks,
+)
+
+
+@pytest.mark.django_db
+def test_benchmarks_run():
+    results = run_benchmarks(get_benchmarks(
+        rows=[12], fields=[2], sizes=[8], engines=['database', 'python'], formats=['pgp', 'aes']
+    ), repeat=1)
+    assert len(results) == (len(OPERATIONS) * 2 - len(SINGLE_KEY_OPERATIONS)) * 4
+    assert all(r['seconds'] > 0 for r in results)
+
+
+def test_benchmarks_compare():
+    baseline = [{'name': 'get', 'seconds': 1.0}, {'name': 'filter', 'seconds': 1.0}]
+    results = [{'name': 'get', 'seconds': 1.05}, {'name': 'filter', 'seconds': 1.5}, {'name': 'new', 'seconds': 9}]
+    assert compare(results, baseline, tolerance=0.1) == [('filter', 1.0, 1.5, 1.5)]
@@ -0,0 +1,127 @@
+import io
+import os
+import uuid
+
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, connection
+from django.test.utils import CaptureQueriesContext
+
+from pgrowcrypt.blobs import BlobReader, BlobWriter, delete_blob, write_blob
+from pgrowcrypt.models import EncryptedBinaryField, encryption_key
+from pgrowcrypt.models.chunks import EncryptedChunk
+
+from .testapp.models import Attachment
+
+DATA = bytes(range(256)) * 40 + b'\x00\xff'
+
+
+@pytest.mark.django_db
+def test_binary_roundtrip(key):
+    with encryption_key(key):
+        a = Attachment.objects.create(name='Scan', content=DATA)
+        Attachment.objects.create(name='Empty', content=b'')
+        Attachment.objects.create(name='Missing')
+        a.refresh_from_db()
+        assert a.content == DATA
+        assert isinstance(a.content, bytes)
+        assert Attachment.objects.get(content=DATA).name == 'Scan'
+        assert dict(Attachment.objects.values_list('name', 'content')) == {'Scan': DATA, 'Empty': b'', 'Missing': None}
+
+
+@pytest.mark.django_db
+def test_binary_stored_as_pgp_bytea(key):
+    with encryption_key(key):
+        a = Attachment.objects.create(name='Scan', content=DATA)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pgp_sym_decrypt_bytea(content, %s) FROM testapp_attachment WHERE id = %s', [key, a.pk])
+        assert bytes(cursor.fetchone()[0]) == DATA
+
+
+def test_binary_field_options():
+    for k in ('deterministic', 'blind_index', 'search_index'):
+        with pytest.raises(ImproperlyConfigured):
+            EncryptedBinaryField(**{k: True})
+    with pytest.raises(ImproperlyConfigured):
+        EncryptedBinaryField(format='aes')
+
+
+@pytest.mark.django_db
+def test_blob_write_read(key):
+    data = os.urandom(10000)
+    with BlobWriter(key, chunk_size=1024) as writer:
+        writer.write(data[:100])
+        writer.write(data[100:])
+    assert writer.size == 10000
+    assert EncryptedChunk.objects.filter(blob=writer.blob).count() == 10
+
+    reader = BlobReader(writer.blob, key)
+    assert reader.size == 10000
+    assert reader.read() == data
+    assert reader.read() == b''
+
+
+@pytest.mark.django_db
+def test_blob_range_read(key):
+    data = os.urandom(10000)
+    blob = write_blob(io.BytesIO(data), key, chunk_size=1024)
+    reader = BlobReader(blob, key)
+    with CaptureQueriesContext(connection) as ctx:
+        reader.seek(3000)
+        assert reader.read(20) == data[3000:3020]
+        assert reader.read(20) == data[3020:3040]
+    assert len(ctx.captured_queries) == 1
+
+    reader.seek(-50, io.SEEK_END)
+    assert reader.read() == data[-50:]
+    reader.seek(1000)
+    assert reader.read(100) == data[1000:1100]
+    assert io.BufferedReader(BlobReader(blob, key)).read() == data
+
+
+@pytest.mark.django_db
+def test_blob_wrong_key():
+    blob = write_blob(io.BytesIO(DATA), 'a')
+    with pytest.raises(Exception):
+        BlobReader(blob, 'b').read()
+
+
+@pytest.mark.django_db
+def test_blob_delete(key):
+    blob = write_blob(io.BytesIO(DATA), key, chunk_size=1000)
+    other = write_blob(io.BytesIO(DATA), key, chunk_size=1000)
+    with pytest.raises(RuntimeError):
+        with BlobWriter(key, chunk_size=1000) as writer:
+            writer.write(DATA)
+            raise RuntimeError()
+    assert not EncryptedChunk.objects.filter(blob=writer.blob).exists()
+
+    delete_blob(blob)
+    assert BlobReader(blob, key).read() == b''
+    assert BlobReader(other, key).read() == DATA
+
+
+@pytest.mark.django_db
+def test_blob_existing(key):
+    blob = write_blob(io.BytesIO(DATA), key, chunk_size=1000)
+    with pytest.raises(ValueError):
+        BlobWriter(key, blob=blob)
+    with pytest.raises(ValueError):
+        write_blob(io.BytesIO(b'Other'), key, blob=blob)
+    assert BlobReader(blob, key).read() == DATA
+
+    new = uuid.uuid4()
+    assert write_blob(io.BytesIO(b'New'), key, blob=new) == new
+    assert BlobReader(new, key).read() == b'New'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_blob_exit_keeps_other_blob(key):
+    # Another writer stores the same UUID after this one has been created
+    blob = uuid.uuid4()
+    with pytest.raises(IntegrityError):
+        with BlobWriter(key, blob=blob, chunk_size=1000) as writer:
+            write_blob(io.BytesIO(DATA), key, blob=blob, chunk_size=1000)
+            writer.write(DATA)
+    assert not writer.created
+    assert BlobReader(blob, key).read() == DATA
@@ -0,0 +1,91 @@
+import datetime
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from psycopg2.extras import DateRange
+
+from pgrowcrypt.models.loader import copy_value
+
+from .testapp.models import Author, Book, Customer, Event, Tag, Ticket
+
+
+@pytest.mark.django_db
+def test_bulk_load_generator(key):
+    a = Author.objects.create(name='Unknown', _key=key)
+    books = (Book(title='Volume {}\twith\\special\ncharacters'.format(i), author=a) for i in range(25))
+    with CaptureQueriesContext(connection) as ctx:
+        assert Book.objects.bulk_load(books, key=key, batch_size=10) == 25
+    assert sum('INSERT INTO' in q['sql'] for q in ctx.captured_queries) == 3
+    assert sorted(Book.objects.with_key(key).values_list('title', flat=True)) == sorted(
+        'Volume {}\twith\\special\ncharacters'.format(i) for i in range(25)
+    )
+    assert Book.objects.filter(author=a).count() == 25
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('engine', ['database', 'python'])
+def test_bulk_load_field_types(key, settings, engine):
+    settings.PGROWCRYPT_ENGINE = engine
+    events = [
+        Event(
+            name='Launch', tags=['a', 'b "c"', 'd\\e,{f}', None, ''], data={'x': [1, 'tab\t'], 'y': None},
+            period=DateRange(datetime.date(2020, 1, 1), datetime.date(2020, 2, 1)),
+            duration=datetime.timedelta(days=1, seconds=5, microseconds=7), cancelled=True,
+        ),
+        Event(name='Party', period=DateRange(empty=True)),
+    ]
+    Event.objects.bulk_load(events, key=key)
+    launch, party = Event.objects.with_key(key).order_by('pk')
+    for loaded, event in zip((launch, party), events):
+        assert (loaded.name, loaded.tags, loaded.data, loaded.period, loaded.duration, loaded.cancelled) == (
+            event.name, event.tags, event.data, event.period, event.duration, event.cancelled
+        )
+
+
+def test_copy_value_unsupported():
+    with pytest.raises(TypeError):
+        copy_value({'a': '1'})
+
+
+@pytest.mark.django_db
+def test_bulk_load_return_pks(key):
+    books = [Book(title='Volume {}'.format(i)) for i in range(5)]
+    pks = Book.objects.with_key(key).bulk_load(books, return_pks=True)
+    assert pks == [b.pk for b in books]
+    assert [Book.objects.with_key(key).get(pk=pk).title for pk in pks] == ['Volume {}'.format(i) for i in range(5)]
+
+
+@pytest.mark.django_db
+def test_bulk_load_indexes(key):
+    Customer.objects.bulk_load([Customer(email='alice@example.org')], key=key)
+    Ticket.objects.bulk_load([Ticket(subject='Printer on fire')], key=key)
+    Tag.objects.bulk_load([Tag(label='urgent', color='red'), Tag(label='important')], key=key)
+    assert Customer.objects.with_key(key).get(email='alice@example.org').email == 'alice@example.org'
+    assert Customer.objects.values_list('email_bidx', flat=True).get() is not None
+    assert Ticket.objects.with_key(key).get(subject__icontains='fire').subject == 'Printer on fire'
+    assert Tag.objects.with_key(key).get(label='urgent').color == 'red'
+    assert Tag.objects.with_key(key).get(label='important').color is None
+
+
+@pytest.mark.django_db
+def test_bulk_load_python_engine(key, settings):
+    settings.PGROWCRYPT_ENGINE = 'python'
+    Customer.objects.bulk_load([Customer(email='alice@example.org')], key=key)
+    Tag.objects.bulk_load([Tag(label='urgent')], key=key)
+    settings.PGROWCRYPT_ENGINE = 'database'
+    assert Customer.objects.with_key(key).get(email='alice@example.org').email == 'alice@example.org'
+    assert Tag.objects.with_key(key).get(label='urgent').label == 'urgent'
+
+
+@pytest.mark.django_db
+def test_bulk_load_key_setting(key, settings):
+    settings.PGROWCRYPT_KEY_MODE = 'setting'
+    Tag.objects.bulk_load([Tag(label='urgent')], key=key)
+    assert Tag.objects.with_key(key).get(label='urgent').label == 'urgent'
+
+
+@pytest.mark.django_db
+def test_bulk_load_requires_key():
+    with pytest.raises(TypeError):
+        Book.objects.bulk_load([Book(title='The Hobbit')])
@@ -0,0 +1,76 @@
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from .testapp.models import Author, Book, Customer, Tag
+
+
+@pytest.mark.django_db
+def test_bulk_update_groups_by_key():
+    books = [Book.objects.create(title='Volume {}'.format(i), _key='a' if i % 2 else 'b') for i in range(6)]
+    for b in books:
+        b.title = b.title.replace('Volume', 'Book')
+    with CaptureQueriesContext(connection) as ctx:
+        assert Book.objects.bulk_update(books, ['title'], batch_size=2) == 6
+    assert sum(q['sql'].startswith('UPDATE') for q in ctx.captured_queries) == 4
+    assert sorted(Book.objects.with_key('a').filter(pk__in=[b.pk for b in books[1::2]]).values_list(
+        'title', flat=True)) == ['Book 1', 'Book 3', 'Book 5']
+    assert sorted(Book.objects.with_key('b').filter(pk__in=[b.pk for b in books[::2]]).values_list(
+        'title', flat=True)) == ['Book 0', 'Book 2', 'Book 4']
+
+
+@pytest.mark.django_db
+def test_bulk_update_indexes(key):
+    customers = [Customer.objects.create(email='user{}@example.org'.format(i), _key=key) for i in range(3)]
+    tags = [Tag.objects.create(label='tag {}'.format(i), _key=key) for i in range(3)]
+    author = Author.objects.create(name='Unknown', _key=key)
+    books = [Book.objects.create(title='Volume {}'.format(i), _key=key) for i in range(3)]
+    for i, (c, t, b) in enumerate(zip(customers, tags, books)):
+        c.email = 'user{}@example.com'.format(i)
+        t.label = 'label {}'.format(i)
+        b.author = author
+    Customer.objects.bulk_update(customers, ['email'])
+    Tag.objects.bulk_update(tags, ['label'])
+    Book.objects.bulk_update(books, ['author'])
+    assert Customer.objects.with_key(key).get(email='user1@example.com').pk == customers[1].pk
+    assert Tag.objects.with_key(key).get(label='label 2').pk == tags[2].pk
+    assert Book.objects.filter(author=author).count() == 3
+
+
+@pytest.mark.django_db
+def test_bulk_update_python_engine(key, settings):
+    settings.PGROWCRYPT_ENGINE = 'python'
+    customers = [Customer.objects.create(email='user{}@example.org'.format(i), _key=key) for i in range(3)]
+    for c in customers:
+        c.email = c.email.replace('.org', '.com')
+    Customer.objects.bulk_update(customers, ['email'])
+    assert Customer.objects.with_key(key).get(email='user1@example.com').pk == customers[1].pk
+
+
+@pytest.mark.django_db
+def test_bulk_update_only_given_fields(key):
+    tags = [Tag.objects.create(label='tag {}'.format(i), color='red', _key=key) for i in range(3)]
+    tags = list(Tag.objects.with_key(key).only('label').order_by('pk'))
+    for t in tags:
+        t.label = t.label.replace('tag', 'label')
+    with CaptureQueriesContext(connection) as ctx:
+        Tag.objects.bulk_update(tags, ['label'])
+    # The deferred color is neither loaded nor encrypted
+    assert [q['sql'].split()[0] for q in ctx.captured_queries] == ['UPDATE']
+    assert list(Tag.objects.with_key(key).order_by('pk').values_list('label', 'color')) == [
+        ('label 0', 'red'), ('label 1', 'red'), ('label 2', 'red')
+    ]
+
+
+@pytest.mark.django_db
+def test_bulk_update_plain_fields(key):
+    author = Author.objects.create(name='Tolkien', _key=key)
+    books = [Book.objects.create(title='Volume {}'.format(i), _key=key) for i in range(3)]
+    for b in books:
+        b.author = author
+    assert Book.objects.bulk_update(books, ['author']) == 3
+    assert Book.objects.filter(author=author).count() == 3
+    with pytest.raises(ValueError):
+        Book.objects.bulk_update(books, [])
+    with pytest.raises(ValueError):
+        Book.objects.bulk_update(books, ['id'])
@@ -0,0 +1,80 @@
+import warnings
+
+import pytest
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F
+from django.test.utils import CaptureQueriesContext
+
+from .testapp.models import Tag
+
+
+@pytest.mark.django_db
+def test_deterministic_storage(key, ciphertexts):
+    Tag.objects.create(label='urgent', color='red', _key=key)
+    Tag.objects.create(label='important', color='red', _key=key)
+    Tag.objects.create(label='later', color='blue', _key='other')
+    colors = ciphertexts(Tag, 'color')
+    assert colors[0] == colors[1]
+    assert colors[0] != colors[2]
+    assert Tag.objects.with_key(key).get(label='urgent').color == 'red'
+
+
+@pytest.mark.django_db
+def test_deterministic_save_and_retrieve_cycles(key):
+    Tag.objects.create(label='urgent', _key=key)
+    t = Tag.objects.with_key(key).get()
+    assert t.label == 'urgent'
+    assert t.color is None
+    t.label = 'important'
+    t.save()
+    assert Tag.objects.with_key(key).get().label == 'important'
+
+
+@pytest.mark.django_db
+def test_deterministic_lookup_compares_ciphertext(key):
+    Tag.objects.create(label='urgent', _key=key)
+    Tag.objects.create(label='important', _key=key)
+    with CaptureQueriesContext(connection) as ctx:
+        assert Tag.objects.with_key(key).filter(label='urgent').count() == 1
+    assert 'WHERE "testapp_tag"."label" = (SELECT' in ctx.captured_queries[0]['sql']
+    assert Tag.objects.with_key(key).filter(label__in=['urgent', 'important', 'later']).count() == 2
+    assert Tag.objects.with_key(key).filter(label='later').count() == 0
+    assert Tag.objects.with_key('other').filter(label='urgent').count() == 0
+
+
+@pytest.mark.django_db
+def test_deterministic_compare_columns(key):
+    Tag.objects.create(label='urgent', alias='urgent', _key=key)
+    Tag.objects.create(label='important', alias='crucial', _key=key)
+    assert [t.label for t in Tag.objects.with_key(key).filter(label=F('alias'))] == ['urgent']
+
+
+@pytest.mark.django_db
+def test_deterministic_group_by(key):
+    Tag.objects.create(label='urgent', color='red', _key=key)
+    Tag.objects.create(label='important', color='red', _key=key)
+    Tag.objects.create(label='later', color='blue', _key=key)
+    with CaptureQueriesContext(connection) as ctx:
+        counts = dict(Tag.objects.with_key(key).values('color').annotate(n=Count('id')).values_list('color', 'n'))
+    assert counts == {'red': 2, 'blue': 1}
+    assert 'GROUP BY "testapp_tag"."color"' in ctx.captured_queries[0]['sql']
+
+
+@pytest.mark.django_db
+def test_deterministic_group_by_annotation(key):
+    Tag.objects.create(label='urgent', color='red', _key=key)
+    Tag.objects.create(label='important', color='red', _key=key)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        qs = Tag.objects.with_key(key).annotate(c=F('color')).values('c').annotate(n=Count('id'))
+        assert list(qs.values_list('c', 'n')) == [('red', 2)]
+    assert 'GROUP BY "testapp_tag"."color"' in str(qs.query)
+
+
+@pytest.mark.django_db
+def test_deterministic_unique(key):
+    Tag.objects.create(label='urgent', _key=key)
+    Tag.objects.create(label='urgent', _key='other')
+    with pytest.raises(IntegrityError):
+        with transaction.atomic():
+            Tag.objects.create(label='urgent', _key=key)
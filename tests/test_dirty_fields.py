@@ -0,0 +1,108 @@
+import pytest
+from django.db import connection
+from django.db.models.signals import post_save
+from django.test.utils import CaptureQueriesContext
+
+from .testapp.models import Author, Book, Customer
+
+
+@pytest.mark.django_db
+def test_unchanged_fields_not_encrypted(key, ciphertexts):
+    a = Author.objects.create(name='J. R. R. Tolkien', _key=key)
+    b = Book.objects.create(title='The Hobbit', _key=key)
+    stored, = ciphertexts(Book, 'title')
+    b = Book.objects.with_key(key).get(pk=b.pk)
+    b.author = a
+    with CaptureQueriesContext(connection) as ctx:
+        b.save()
+    sql = ctx.captured_queries[-1]['sql']
+    assert 'pgp_sym_encrypt' not in sql and '"title"' not in sql
+    assert ciphertexts(Book, 'title') == [stored]
+    assert Book.objects.with_key(key).get(author=a).title == 'The Hobbit'
+
+    b.title = 'The Lord of the Rings'
+    b.save()
+    assert ciphertexts(Book, 'title') != [stored]
+    stored, = ciphertexts(Book, 'title')
+    # Saving again does not encrypt the new value once more
+    b.save()
+    assert ciphertexts(Book, 'title') == [stored]
+    assert Book.objects.with_key(key).get(pk=b.pk).title == 'The Lord of the Rings'
+
+
+@pytest.mark.django_db
+def test_nothing_changed(key):
+    a = Author.objects.create(name='J. R. R. Tolkien', _key=key)
+    saved = []
+
+    def receiver(sender, instance, **kwargs):
+        saved.append(instance.pk)
+
+    post_save.connect(receiver, sender=Author)
+    try:
+        with CaptureQueriesContext(connection) as ctx:
+            a.save()
+            Author.objects.with_key(key).get(pk=a.pk).save()
+    finally:
+        post_save.disconnect(receiver, sender=Author)
+    # Django still checks that the row exists and sends the signals
+    assert not any('pgp_sym_encrypt' in q['sql'] for q in ctx.captured_queries)
+    assert saved == [a.pk, a.pk]
+
+
+@pytest.mark.django_db
+def test_deleted_row_inserted_again(key):
+    b = Book.objects.create(title='The Hobbit', _key=key)
+    b = Book.objects.with_key(key).get(pk=b.pk)
+    Book.objects.with_key(key).delete()
+    b.save()
+    assert Book.objects.with_key(key).get(pk=b.pk).title == 'The Hobbit'
+
+
+@pytest.mark.django_db
+def test_new_key_encrypts_all_fields():
+    b = Book.objects.create(title='The Hobbit', _key='old')
+    b = Book.objects.with_key('old').get(pk=b.pk)
+    b.save(_key='new')
+    assert Book.objects.with_key('new').get(pk=b.pk).title == 'The Hobbit'
+
+
+@pytest.mark.django_db
+def test_lazy_values(key, ciphertexts):
+    b = Book.objects.create(title='The Hobbit', _key=key)
+    stored, = ciphertexts(Book, 'title')
+    b = Book.objects.with_key(key).lazy_decrypt().get(pk=b.pk)
+    b.save()
+    assert b.title == 'The Hobbit'
+    b.save()
+    assert ciphertexts(Book, 'title') == [stored]
+    b.title = 'The Silmarillion'
+    b.save()
+    assert Book.objects.with_key(key).get(pk=b.pk).title == 'The Silmarillion'
+
+
+@pytest.mark.django_db
+def test_changed_field_with_index(key):
+    c = Customer.objects.create(email='alice@example.org', _key=key)
+    c = Customer.objects.with_key(key).get(pk=c.pk)
+    c.email = 'alice@example.com'
+    c.save()
+    assert Customer.objects.with_key(key).get(email='alice@example.com').pk == c.pk
+
+
+@pytest.mark.django_db
+def test_explicit_update_fields(key):
+    a = Author.objects.create(name='J. R. R. Tolkien', _key=key)
+    b = Book.objects.create(title='The Hobbit', _key=key)
+    b.title = 'The Lord of the Rings'
+    b.author = a
+    b.save(update_fields=['author'])
+    assert Book.objects.with_key(key).get(pk=b.pk).title == 'The Hobbit'
+    # The title is still pending
+    b.save()
+    assert Book.objects.with_key(key).get(pk=b.pk).title == 'The Lord of the Rings'
+
+
+def test_encrypted_fields():
+    assert [f.name for f in Customer.get_encrypted_fields()] == ['email']
+    assert Customer.get_encrypted_fields() is Customer.get_encrypted_fields()
@@ -0,0 +1,132 @@
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+from django.db import InternalError, connection
+from django.db.models.functions import Lower
+from django.test.utils import CaptureQueriesContext
+
+from pgrowcrypt import engine, pgp
+
+from .testapp.models import Author, Book, Customer, Tag
+
+
+@pytest.fixture
+def python_engine(settings):
+    settings.PGROWCRYPT_ENGINE = 'python'
+    yield settings
+    if engine._pool is not None:
+        engine._pool.shutdown()
+        engine._pool = None
+
+
+def test_pgp_roundtrip(key):
+    ciphertext = pgp.pgp_sym_encrypt('The Lord of the Rings', key)
+    assert ciphertext != pgp.pgp_sym_encrypt('The Lord of the Rings', key)
+    assert pgp.pgp_sym_decrypt(ciphertext, key) == 'The Lord of the Rings'
+    with pytest.raises(pgp.PGPError):
+        pgp.pgp_sym_decrypt(ciphertext, key + 'x')
+
+
+def test_pgp_binary_data_is_not_text(key):
+    ciphertext = pgp.encrypt(b'\x00\xff', key, text=False)
+    assert pgp.decrypt(ciphertext, key, text=False) == b'\x00\xff'
+    with pytest.raises(pgp.PGPError):
+        pgp.decrypt(ciphertext, key)
+
+
+@pytest.mark.django_db
+def test_python_engine_save_and_retrieve(key, python_engine):
+    with CaptureQueriesContext(connection) as ctx:
+        b = Book.objects.create(title='The Lord of the Rings', _key=key)
+        b = Book.objects.with_key(key).get(pk=b.pk)
+    assert b.title == 'The Lord of the Rings'
+    assert not any('pgp_sym_' in q['sql'] for q in ctx.captured_queries)
+    b.title = 'Harry Potter'
+    b.save()
+    assert Book.objects.with_key(key).get().title == 'Harry Potter'
+
+
+@pytest.mark.django_db
+def test_python_engine_filters_in_database(key, python_engine):
+    Book.objects.create(title='The Lord of the Rings', _key=key)
+    Book.objects.create(title='Harry Potter', _key=key)
+    assert list(Book.objects.with_key(key).filter(title__icontains='rings').values_list('title', flat=True)) == [
+        'The Lord of the Rings'
+    ]
+    assert list(Book.objects.with_key(key).annotate(l=Lower('title')).order_by('title').values_list('l', flat=True)) == [
+        'harry potter', 'the lord of the rings'
+    ]
+
+
+@pytest.mark.django_db
+def test_python_engine_select_related(key, python_engine):
+    a = Author.objects.create(name='J. R. R. Tolkien', _key=key)
+    Book.objects.create(title='The Lord of the Rings', author=a, _key=key)
+    b = Book.objects.with_key(key).select_related('author').get()
+    assert b.author.name == 'J. R. R. Tolkien'
+
+
+@pytest.mark.django_db
+def test_python_engine_update(key, python_engine):
+    Customer.objects.create(email='alice@example.org', _key=key)
+    Customer.objects.with_key(key).update(email='alice@example.com')
+    assert Customer.objects.with_key(key).get(email='alice@example.com').email == 'alice@example.com'
+
+
+@pytest.mark.django_db
+def test_python_engine_missing_key(python_engine):
+    Book.objects.create(title='The Lord of the Rings', _key='a')
+    with pytest.raises(InternalError):
+        Book.objects.first()
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('pool', ['thread', 'process'])
+def test_python_engine_pool(python_engine, pool):
+    python_engine.PGROWCRYPT_POOL = pool
+    python_engine.PGROWCRYPT_POOL_SIZE = 2
+    Book.objects.bulk_create([Book(title='Volume {}'.format(i), _key='key') for i in range(40)])
+    assert sorted(Book.objects.with_key('key').values_list('title', flat=True)) == sorted(
+        'Volume {}'.format(i) for i in range(40)
+    )
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='ProcessPoolExecutor(mp_context=...) needs Python 3.7')
+def test_python_engine_spawned_pool(python_engine):
+    # Spawned processes have no Django settings, so they must not derive any keys
+    python_engine.PGROWCRYPT_POOL_SIZE = 2
+    engine._pool = ProcessPoolExecutor(
+        max_workers=2, mp_context=multiprocessing.get_context('spawn'),
+        initializer=exec, initargs=("import os; os.environ.pop('DJANGO_SETTINGS_MODULE', None)",),
+    )
+    jobs = [
+        ('Value {}'.format(i), 'key', format, {'s2k_count': 1024})
+        for i in range(10) for format in (engine.FORMAT_DETERMINISTIC, engine.FORMAT_AES, engine.FORMAT_PGP)
+    ]
+    ciphertexts = engine.encrypt_values(jobs)
+    assert engine.decrypt_values([(c, k, f) for c, (v, k, f, o) in zip(ciphertexts, jobs)]) == [v for v, k, f, o in jobs]
+
+
+def test_pgp_random_s2k_count(monkeypatch):
+    # pgcrypto picks one of 32 counts from 65536 to 253952
+    monkeypatch.setattr(pgp.os, 'urandom', lambda n: b'\xff' * n)
+    assert pgp._s2k_iterations(None) == (127, 253952)
+    monkeypatch.setattr(pgp.os, 'urandom', lambda n: b'\x00' * n)
+    assert pgp._s2k_iterations(None) == (96, 65536)
+
+
+@pytest.mark.django_db
+def test_engines_are_compatible(key, settings):
+    settings.PGROWCRYPT_ENGINE = 'python'
+    Book.objects.create(title='The Lord of the Rings', _key=key)
+    Tag.objects.create(label='urgent', _key=key)
+    settings.PGROWCRYPT_ENGINE = 'database'
+    Book.objects.create(title='Harry Potter', _key=key)
+    assert Book.objects.with_key(key).filter(title='The Lord of the Rings').count() == 1
+    assert Tag.objects.with_key(key).get(label='urgent').label == 'urgent'
+    Tag.objects.create(label='important', _key=key)
+    settings.PGROWCRYPT_ENGINE = 'python'
+    assert sorted(Book.objects.with_key(key).values_list('title', flat=True)) == ['Harry Potter', 'The Lord of the Rings']
+    assert sorted(Tag.objects.with_key(key).values_list('label', flat=True)) == ['important', 'urgent']
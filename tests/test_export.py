@@ -0,0 +1,54 @@
+import csv
+import gzip
+import io
+import json
+
+import pytest
+from django.core.management import call_command
+
+from pgrowcrypt.export import export_rows
+
+from .testapp.models import Author, Book, Customer
+
+
+@pytest.mark.django_db
+def test_export_csv(key):
+    author = Author.objects.create(name='J. R. R. Tolkien', _key=key)
+    for i in range(5):
+        Book.objects.create(title='Volume, "{}"'.format(i), author=author if i % 2 else None, _key=key)
+    out = io.BytesIO()
+    assert export_rows(Book.objects.with_key(key).order_by('pk'), out, chunk_size=2) == 5
+    rows = list(csv.reader(io.StringIO(out.getvalue().decode())))
+    assert rows[0] == ['id', 'title', 'author_id']
+    assert [r[1:] for r in rows[1:]] == [
+        ['Volume, "{}"'.format(i), str(author.pk) if i % 2 else ''] for i in range(5)
+    ]
+
+
+@pytest.mark.django_db
+def test_export_jsonl_gzip(key):
+    Customer.objects.create(email='alice@example.org', _key=key)
+    Customer.objects.create(email='bøb@example.org', _key=key)
+    out = io.BytesIO()
+    qs = Customer.objects.with_key(key).order_by('pk')
+    assert export_rows(qs, out, format='jsonl', fields=['email'], compress=True) == 2
+    lines = gzip.decompress(out.getvalue()).decode().splitlines()
+    assert [json.loads(line) for line in lines] == [{'email': 'alice@example.org'}, {'email': 'bøb@example.org'}]
+    assert not out.closed
+
+
+@pytest.mark.django_db
+def test_export_unknown_format(key):
+    with pytest.raises(ValueError):
+        export_rows(Book.objects.with_key(key), io.BytesIO(), format='xml')
+
+
+@pytest.mark.django_db
+def test_export_command(tmp_path, capsys):
+    Author.objects.create(name='J. R. R. Tolkien', _key='a')
+    Author.objects.create(name='J. K. Rowling', _key='a')
+    output = tmp_path / 'authors.jsonl'
+    call_command('export_rows', 'testapp.Author', '--key', 'a', '--format', 'jsonl', '--output', str(output),
+                 '--filter', 'name__startswith=J. K.')
+    assert 'Exported 1 rows.' in capsys.readouterr().err
+    assert [json.loads(line)['name'] for line in output.read_text().splitlines()] == ['J. K. Rowling']
@@ -0,0 +1,186 @@
+import hashlib
+import hmac
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, isolate_apps
+
+from pgrowcrypt.crypto import BLIND_INDEX_KEY, SEARCH_INDEX_KEY, derive_key
+from pgrowcrypt.models import EncryptedModel, EncryptedTextField, search_index
+from pgrowcrypt.rotation import rotate_key
+
+from .testapp.models import Customer, Ticket
+
+
+@pytest.mark.django_db
+def test_blind_index_exact(key):
+    Customer.objects.create(email='alice@example.org', _key=key)
+    Customer.objects.create(email='bob@example.org', _key=key)
+    assert Customer.objects.with_key(key).get(email='alice@example.org').email == 'alice@example.org'
+    assert Customer.objects.with_key(key).filter(email='carol@example.org').count() == 0
+
+
+@pytest.mark.django_db
+def test_blind_index_in(key):
+    Customer.objects.create(email='alice@example.org', _key=key)
+    Customer.objects.create(email='bob@example.org', _key=key)
+    Customer.objects.create(email='carol@example.org', _key=key)
+    qs = Customer.objects.with_key(key).filter(email__in=['alice@example.org', 'carol@example.org', None])
+    assert sorted(c.email for c in qs) == ['alice@example.org', 'carol@example.org']
+
+
+@pytest.mark.django_db
+def test_blind_index_used_in_sql(key):
+    Customer.objects.create(email='alice@example.org', _key=key)
+    with CaptureQueriesContext(connection) as ctx:
+        Customer.objects.with_key(key).filter(email='alice@example.org').count()
+    assert '"testapp_customer"."email_bidx" = hmac(' in ctx.captured_queries[0]['sql']
+
+
+@pytest.mark.django_db
+def test_blind_index_normalized(key):
+    a = Customer.objects.create(email='Alice@Example.org', _key=key)
+    b = Customer.objects.create(email='  alice@example.ORG ', _key=key)
+    indexes = dict(Customer._base_manager.values_list('pk', 'email_bidx'))
+    assert bytes(indexes[a.pk]) == bytes(indexes[b.pk])
+    # The index only narrows down the rows, the decrypted values are still compared exactly
+    assert [c.pk for c in Customer.objects.with_key(key).filter(email='Alice@Example.org')] == [a.pk]
+    with CaptureQueriesContext(connection) as ctx:
+        assert Customer.objects.with_key(key).filter(email__iexact='alice@example.org').count() == 1
+    assert '"testapp_customer"."email_bidx" = hmac(' in ctx.captured_queries[0]['sql']
+
+
+@pytest.mark.django_db
+def test_blind_index_other_key():
+    Customer.objects.create(email='alice@example.org', _key='a')
+    Customer.objects.create(email='alice@example.org', _key='b')
+    # Rows written with another key do not match the index and are never decrypted
+    assert Customer.objects.with_key('a').filter(email='alice@example.org').count() == 1
+
+
+@pytest.mark.django_db
+def test_blind_index_maintained_on_save(key):
+    c = Customer.objects.create(email='alice@example.org', _key=key)
+    c = Customer.objects.with_key(key).get(pk=c.pk)
+    c.email = 'alice@example.com'
+    c.save()
+    assert Customer.objects.with_key(key).filter(email='alice@example.org').count() == 0
+    assert Customer.objects.with_key(key).filter(email='alice@example.com').count() == 1
+
+
+@pytest.mark.django_db
+def test_blind_index_maintained_on_update(key):
+    Customer.objects.create(email='alice@example.org', _key=key)
+    Customer.objects.with_key(key).update(email='alice@example.com')
+    assert Customer.objects.with_key(key).filter(email='alice@example.org').count() == 0
+    assert Customer.objects.with_key(key).filter(email='alice@example.com').count() == 1
+
+
+@pytest.mark.django_db
+def test_blind_index_maintained_on_bulk_create(key):
+    Customer.objects.bulk_create([
+        Customer(email='alice@example.org', _key=key),
+        Customer(email='bob@example.org', _key=key),
+    ])
+    assert Customer.objects.with_key(key).filter(email='bob@example.org').count() == 1
+
+
+@pytest.mark.django_db
+def test_index_keys(key):
+    # A blind index of three characters must not equal the HMAC of its only trigram
+    c = Customer.objects.create(email='Bob', _key=key)
+    t = Ticket.objects.create(subject='bob', _key=key)
+    bidx = bytes(Customer._base_manager.values_list('email_bidx', flat=True).get(pk=c.pk))
+    sidx = [bytes(v) for v in Ticket._base_manager.values_list('subject_sidx', flat=True).get(pk=t.pk)]
+    assert bidx == hmac.new(derive_key(key, BLIND_INDEX_KEY), b'bob', hashlib.sha256).digest()
+    assert sidx == [hmac.new(derive_key(key, SEARCH_INDEX_KEY), b'bob', hashlib.sha256).digest()]
+    assert bidx not in sidx
+
+
+@pytest.mark.django_db
+def test_rows_without_index_values(key):
+    # Rows from before the indexes have been enabled
+    alice = Customer.objects.create(email='alice@example.org', _key=key)
+    Customer.objects.create(email='bob@example.org', _key=key)
+    ticket = Ticket.objects.create(subject='Printer on fire', _key=key)
+    with connection.cursor() as cursor:
+        cursor.execute('UPDATE testapp_customer SET email_bidx = NULL')
+        cursor.execute('UPDATE testapp_ticket SET subject_sidx = NULL')
+
+    assert Customer.objects.with_key(key).get(email='alice@example.org').pk == alice.pk
+    assert Customer.objects.with_key(key).filter(email__iexact='BOB@example.org').count() == 1
+    assert Customer.objects.with_key(key).filter(email__in=['alice@example.org', 'carol@example.org']).count() == 1
+    assert Ticket.objects.with_key(key).get(subject__icontains='fire').pk == ticket.pk
+
+    rotate_key(Customer, key, key)
+    rotate_key(Ticket, key, key)
+    assert not Customer._base_manager.filter(email_bidx__isnull=True).exists()
+    assert not Ticket._base_manager.filter(subject_sidx__isnull=True).exists()
+    assert Customer.objects.with_key(key).get(email='alice@example.org').pk == alice.pk
+    assert Ticket.objects.with_key(key).get(subject__icontains='fire').pk == ticket.pk
+
+
+@pytest.mark.django_db
+def test_search_index_icontains(key):
+    Ticket.objects.create(subject='Printer on fire', _key=key)
+    Ticket.objects.create(subject='Password reset', _key=key)
+    assert Ticket.objects.with_key(key).get(subject__icontains='FIRE').subject == 'Printer on fire'
+    assert Ticket.objects.with_key(key).filter(subject__icontains='ire').count() == 1
+    assert Ticket.objects.with_key(key).filter(subject__icontains='water').count() == 0
+
+
+@pytest.mark.django_db
+def test_search_index_contains_rechecks_case(key):
+    Ticket.objects.create(subject='Printer on fire', _key=key)
+    assert Ticket.objects.with_key(key).filter(subject__contains='fire').count() == 1
+    assert Ticket.objects.with_key(key).filter(subject__contains='FIRE').count() == 0
+
+
+@pytest.mark.django_db
+def test_search_index_istartswith(key):
+    Ticket.objects.create(subject='Printer on fire', _key=key)
+    assert Ticket.objects.with_key(key).filter(subject__istartswith='printer').count() == 1
+    assert Ticket.objects.with_key(key).filter(subject__istartswith='fire').count() == 0
+
+
+@pytest.mark.django_db
+def test_search_index_short_value(key):
+    Ticket.objects.create(subject='Printer on fire', _key=key)
+    with CaptureQueriesContext(connection) as ctx:
+        assert Ticket.objects.with_key(key).filter(subject__icontains='on').count() == 1
+    assert 'subject_sidx' not in ctx.captured_queries[0]['sql']
+
+
+@pytest.mark.django_db
+def test_search_index_used_in_sql(key):
+    Ticket.objects.create(subject='Printer on fire', _key=key)
+    with CaptureQueriesContext(connection) as ctx:
+        Ticket.objects.with_key(key).filter(subject__icontains='fire').count()
+    assert '"testapp_ticket"."subject_sidx" @> ARRAY(' in ctx.captured_queries[0]['sql']
+
+
+@pytest.mark.django_db
+def test_search_index_maintained_on_update(key):
+    Ticket.objects.create(subject='Printer on fire', _key=key)
+    Ticket.objects.with_key(key).update(subject='Printer fixed')
+    assert Ticket.objects.with_key(key).filter(subject__icontains='fire').count() == 0
+    assert Ticket.objects.with_key(key).filter(subject__icontains='fixed').count() == 1
+
+
+@isolate_apps('pgrowcrypt')
+def test_search_index_check():
+    class Message(EncryptedModel):
+        body = EncryptedTextField(search_index=True)
+
+        class Meta:
+            app_label = 'pgrowcrypt'
+
+    class IndexedMessage(EncryptedModel):
+        body = EncryptedTextField(search_index=True)
+
+        class Meta:
+            app_label = 'pgrowcrypt'
+            indexes = [search_index('body')]
+
+    assert [e.id for e in Message._meta.get_field('body').check()] == ['pgrowcrypt.W001']
+    assert IndexedMessage._meta.get_field('body').check() == []
@@ -0,0 +1,99 @@
+import pytest
+from django.db import connection
+
+from pgrowcrypt.instrumentation import DecryptingScanWarning
+from pgrowcrypt.models.keys import query_key
+from pgrowcrypt.testing import CaptureCryptoContext
+
+from .testapp.models import Book, Customer
+
+
+@pytest.mark.django_db
+def test_query_stats(key):
+    Book.objects.create(title='The Hobbit', _key=key)
+    Book.objects.create(title='The Lord of the Rings', _key=key)
+    with CaptureCryptoContext() as ctx:
+        assert [b.title for b in Book.objects.with_key(key).filter(title__contains='Hobbit').order_by('title')] == [
+            'The Hobbit'
+        ]
+    stats, = ctx.captured_stats
+    assert stats.model is Book
+    assert dict(stats.references) == {'select': 1, 'where': 1, 'order_by': 1}
+    # Decrypted once in the LATERAL subselect
+    assert stats.decryptions == 1
+    assert stats.rows == 1
+    assert stats.duration > 0
+    assert 'pgp_sym_decrypt' in stats.sql
+
+
+@pytest.mark.django_db
+def test_query_stats_writes(key):
+    with CaptureCryptoContext() as ctx:
+        Customer.objects.create(email='alice@example.org', _key=key)
+        Customer.objects.with_key(key).filter(email='alice@example.org').update(email='alice@example.com')
+    create, update = ctx.captured_stats
+    assert (create.encryptions, create.decryptions) == (1, 0)
+    assert (update.encryptions, update.decryptions) == (1, 1)
+    # Only the clauses of SELECT queries are told apart
+    assert dict(update.references) == {'other': 1}
+
+
+@pytest.mark.django_db
+def test_query_stats_python_engine(key, settings):
+    settings.PGROWCRYPT_ENGINE = 'python'
+    with CaptureCryptoContext() as ctx:
+        Book.objects.create(title='The Hobbit', _key=key)
+        assert Book.objects.with_key(key).get().title == 'The Hobbit'
+    create, select = ctx.captured_stats
+    assert (create.encryptions, create.client_encryptions) == (0, 1)
+    assert (select.decryptions, select.client_decryptions) == (0, 1)
+
+
+@pytest.mark.django_db
+def test_no_instrumentation_without_listeners(key):
+    with query_key(connection, key):
+        assert not connection.execute_wrappers
+
+
+@pytest.mark.django_db
+def test_assert_num_decryptions(key, django_assert_num_decryptions):
+    Book.objects.create(title='The Hobbit', _key=key)
+    with django_assert_num_decryptions(1):
+        assert Book.objects.with_key(key).get().title == 'The Hobbit'
+    with django_assert_num_decryptions(0):
+        assert Book.objects.with_key(key).count() == 1
+    with pytest.raises(AssertionError):
+        with django_assert_num_decryptions(0):
+            list(Book.objects.with_key(key).all())
+
+
+@pytest.fixture
+def inspect(settings):
+    settings.DEBUG = True
+    settings.PGROWCRYPT_INSPECT = 'warn'
+    return settings
+
+
+@pytest.mark.django_db
+def test_inspector_warns(key, inspect):
+    Book.objects.create(title='The Hobbit', _key=key)
+    with pytest.warns(DecryptingScanWarning):
+        assert Book.objects.with_key(key).filter(title='The Hobbit').count() == 1
+    with pytest.warns(DecryptingScanWarning):
+        list(Book.objects.with_key(key).order_by('title'))
+    with pytest.warns(DecryptingScanWarning):
+        # On a server-side cursor
+        assert [b.title for b in Book.objects.with_key(key).filter(title='The Hobbit').iterator()] == ['The Hobbit']
+    inspect.PGROWCRYPT_INSPECT = 'raise'
+    with pytest.raises(DecryptingScanWarning):
+        list(Book.objects.with_key(key).filter(title='The Hobbit'))
+
+
+@pytest.mark.django_db
+def test_inspector_index(key, inspect, recwarn):
+    c = Customer.objects.create(email='alice@example.org', _key=key)
+    assert Customer.objects.with_key(key).get(pk=c.pk).email == 'alice@example.org'
+    with connection.cursor() as cursor:
+        cursor.execute('SET LOCAL enable_seqscan = off')
+    assert Customer.objects.with_key(key).get(email='alice@example.org').pk == c.pk
+    assert not [w for w in recwarn if issubclass(w.category, DecryptingScanWarning)]
@@ -0,0 +1,123 @@
+import pytest
+from django.db import connection
+
+from pgrowcrypt.crypto import key_cache, key_fingerprint
+from pgrowcrypt.models import encryption_key
+from pgrowcrypt.rotation import rotate_key
+
+from .testapp.models import Document
+
+
+def fingerprints(**kwargs):
+    return {fp and bytes(fp) for fp in Document._base_manager.filter(**kwargs).values_list('key_fp', flat=True)}
+
+
+@pytest.mark.django_db
+def test_fingerprint_written():
+    d = Document.objects.create(title='Contract', _key='a')
+    Document.objects.bulk_create([Document(title='Invoice', _key='a')])
+    Document.objects.bulk_load([Document(title='Receipt')], key='a')
+    assert fingerprints() == {key_fingerprint('a')}
+
+    d.save(_key='b')
+    assert fingerprints(pk=d.pk) == {key_fingerprint('b')}
+    d.title = 'Lease'
+    d.save(_key='c', update_fields=['title', 'body'])
+    assert fingerprints(pk=d.pk) == {key_fingerprint('c')}
+
+    d._EncryptedModel__key = 'd'
+    Document.objects.bulk_update([d], ['title', 'body'])
+    assert fingerprints(pk=d.pk) == {key_fingerprint('d')}
+
+
+@pytest.mark.django_db
+def test_scoped_queries():
+    a = Document.objects.create(title='Contract', _key='a')
+    b = Document.objects.create(title='Invoice', _key='b')
+    assert [d.title for d in Document.objects.with_key('a')] == ['Contract']
+    assert Document.objects.with_key('b').filter(title__startswith='Inv').count() == 1
+    assert Document.objects.with_key('b').filter(title='Contract').exists() is False
+    with pytest.raises(Document.DoesNotExist):
+        Document.objects.with_key('a').get(pk=b.pk)
+    with encryption_key('b'):
+        assert list(Document.objects.values_list('title', flat=True)) == ['Invoice']
+    # Without a key, nothing is decrypted and all rows are visible
+    assert sorted(Document.objects.values_list('pk', flat=True)) == [a.pk, b.pk]
+
+
+@pytest.mark.django_db
+def test_scoped_prepared():
+    Document.objects.create(title='Contract', _key='a')
+    Document.objects.create(title='Invoice', _key='b')
+    for key, title in (('a', 'Contract'), ('b', 'Invoice'), ('a', 'Contract')):
+        assert [d.title for d in Document.objects.with_key(key).prepared('all')] == [title]
+
+
+@pytest.mark.django_db
+def test_scoped_update_delete():
+    a = Document.objects.create(title='Contract', _key='a')
+    b = Document.objects.create(title='Invoice', _key='b')
+    assert Document.objects.with_key('a').update(title='Lease') == 1
+    assert Document.objects.with_key('b').get(pk=b.pk).title == 'Invoice'
+    assert Document.objects.with_key('a').get(pk=a.pk).title == 'Lease'
+    assert Document.objects.with_key('b').delete()[0] == 1
+    assert list(Document._base_manager.values_list('pk', flat=True)) == [a.pk]
+
+
+@pytest.mark.django_db
+def test_rotate_key():
+    a = Document.objects.create(title='Contract', _key='a')
+    Document.objects.create(title='Invoice', _key='b')
+    legacy = Document.objects.create(title='Receipt', _key='a')
+    Document._base_manager.filter(pk=legacy.pk).update(key_fp=None)
+    assert rotate_key(Document, 'a', 'c') == 2
+    assert sorted(d.pk for d in Document.objects.with_key('c')) == [a.pk, legacy.pk]
+    assert Document.objects.with_key('b').get().title == 'Invoice'
+    assert fingerprints() == {key_fingerprint('b'), key_fingerprint('c')}
+
+
+@pytest.mark.django_db
+def test_rows_without_fingerprint():
+    # Rows written before the field was added to a populated table
+    with connection.cursor() as cursor:
+        for title in ('Contract', 'Invoice', 'Receipt'):
+            cursor.execute("INSERT INTO testapp_document (title) VALUES (pgp_sym_encrypt(%s, 'a'))", [title])
+    assert fingerprints() == {None}
+    assert sorted(Document.objects.with_key('a').values_list('title', flat=True)) == ['Contract', 'Invoice', 'Receipt']
+    assert Document.objects.with_key('a').filter(title='Invoice').update(title='Bill') == 1
+    assert Document.objects.with_key('a').filter(title='Receipt').delete()[0] == 1
+    assert sorted(Document.objects.with_key('a').values_list('title', flat=True)) == ['Bill', 'Contract']
+    assert Document.objects.with_key('a').get(title='Contract').title == 'Contract'
+
+    assert rotate_key(Document, 'a', 'a') == 2
+    assert fingerprints() == {key_fingerprint('a')}
+    assert sorted(Document.objects.with_key('a').values_list('title', flat=True)) == ['Bill', 'Contract']
+
+
+@pytest.mark.django_db
+def test_partial_save_with_new_key():
+    d = Document.objects.create(title='Contract', body='Terms', _key='a')
+    d.title = 'Lease'
+    d.save(update_fields=['title'])
+    with pytest.raises(ValueError):
+        d.save(_key='b', update_fields=['title'])
+    d = Document.objects.with_key('a').only('title').get(pk=d.pk)
+    with pytest.raises(ValueError):
+        d.save(_key='b')
+    d = Document.objects.with_key('a').get(pk=d.pk)
+    d._EncryptedModel__key = 'b'
+    with pytest.raises(ValueError):
+        Document.objects.bulk_update([d], ['title'])
+    Document.objects.bulk_update([d], ['title', 'body'])
+    assert fingerprints(pk=d.pk) == {key_fingerprint('b')}
+    assert Document.objects.with_key('b').values_list('title', 'body').get() == ('Lease', 'Terms')
+
+
+def test_fingerprint_salted(settings):
+    key_cache.clear()
+    fingerprint = key_fingerprint('a')
+    settings.PGROWCRYPT_FINGERPRINT_SALT = 'deployment secret'
+    assert key_fingerprint('a') != fingerprint
+    settings.PGROWCRYPT_FINGERPRINT_ITERATIONS = 1
+    assert key_fingerprint('a') != fingerprint
+    key_cache.clear()
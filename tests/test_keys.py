@@ -0,0 +1,71 @@
+import pytest
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from .testapp.models import Author, Book, Customer, Tag, Ticket
+
+
+@pytest.fixture
+def setting_mode(settings):
+    settings.PGROWCRYPT_KEY_MODE = 'setting'
+    yield settings
+
+
+def current_key():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT current_setting('pgrowcrypt.key', true)")
+        return cursor.fetchone()[0]
+
+
+@pytest.mark.django_db
+def test_key_sent_once(key, setting_mode):
+    Book.objects.create(title='The Lord of the Rings', _key=key)
+    with CaptureQueriesContext(connection) as ctx:
+        assert Book.objects.with_key(key).get(title='The Lord of the Rings').title == 'The Lord of the Rings'
+    assert len(ctx.captured_queries) == 3
+    assert 'set_config' in ctx.captured_queries[0]['sql']
+    assert "current_setting('pgrowcrypt.key')" in ctx.captured_queries[1]['sql']
+    assert key not in ctx.captured_queries[1]['sql']
+    assert not current_key()
+
+
+@pytest.mark.django_db
+def test_key_setting_roundtrip(key, setting_mode):
+    b = Book.objects.create(title='The Lord of the Rings', _key=key)
+    b.title = 'The Hobbit'
+    b.save()
+    Book.objects.bulk_create([Book(title='Harry Potter', _key=key)])
+    Book.objects.with_key(key).filter(title='Harry Potter').update(title='Harry Potter 2')
+    assert sorted(Book.objects.with_key(key).values_list('title', flat=True)) == ['Harry Potter 2', 'The Hobbit']
+    assert not current_key()
+
+
+@pytest.mark.django_db
+def test_key_setting_indexes(key, setting_mode):
+    Customer.objects.create(email='alice@example.org', _key=key)
+    Ticket.objects.create(subject='Printer on fire', _key=key)
+    Tag.objects.create(label='urgent', color='red', _key=key)
+    assert Customer.objects.with_key(key).get(email='alice@example.org').email == 'alice@example.org'
+    assert Ticket.objects.with_key(key).get(subject__icontains='fire').subject == 'Printer on fire'
+    assert Tag.objects.with_key(key).get(label='urgent').color == 'red'
+
+
+@pytest.mark.django_db
+def test_key_setting_other_key_inside_query(setting_mode):
+    Book.objects.create(title='The Lord of the Rings', _key='a')
+    for b in Book.objects.with_key('a').iterator():
+        Author.objects.create(name=b.title, _key='b')
+    assert Author.objects.with_key('b').get(name='The Lord of the Rings').name == 'The Lord of the Rings'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_key_setting_cleared_after_session(key, setting_mode):
+    Book.objects.create(title='The Lord of the Rings', _key=key)
+    with CaptureQueriesContext(connection) as ctx:
+        assert Book.objects.with_key(key).get().title == 'The Lord of the Rings'
+    assert not any('set_config' in q['sql'] for q in ctx.captured_queries)
+    assert not current_key()
+    with transaction.atomic():
+        assert Book.objects.with_key(key).get().title == 'The Lord of the Rings'
+        assert not current_key()
+    assert not current_key()
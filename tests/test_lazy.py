@@ -0,0 +1,70 @@
+import pickle
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from .testapp.models import Author, Book, Tag
+
+
+@pytest.mark.django_db
+def test_lazy_decrypt_on_access(key, django_assert_num_queries):
+    for title in ('Harry Potter', 'The Hobbit', 'The Lord of the Rings'):
+        Book.objects.create(title=title, _key=key)
+    with CaptureQueriesContext(connection) as ctx:
+        books = list(Book.objects.with_key(key).lazy_decrypt().order_by('pk'))
+    assert 'pgp_sym_decrypt' not in ctx.captured_queries[0]['sql']
+    with django_assert_num_queries(0):
+        assert [b.pk for b in books] == sorted(b.pk for b in books)
+    with django_assert_num_queries(1):
+        assert [b.title for b in books] == ['Harry Potter', 'The Hobbit', 'The Lord of the Rings']
+
+
+@pytest.mark.django_db
+def test_lazy_decrypt_select_related(key, django_assert_num_queries):
+    a = Author.objects.create(name='J. R. R. Tolkien', _key=key)
+    Book.objects.create(title='The Lord of the Rings', author=a, _key=key)
+    Book.objects.create(title='The Hobbit', author=a, _key=key)
+    books = list(Book.objects.with_key(key).lazy_decrypt().select_related('author'))
+    with django_assert_num_queries(1):
+        assert {b.author.name for b in books} == {'J. R. R. Tolkien'}
+
+
+@pytest.mark.django_db
+def test_lazy_decrypt_values_are_decrypted(key):
+    Book.objects.create(title='The Lord of the Rings', _key=key)
+    assert list(Book.objects.with_key(key).lazy_decrypt().values_list('title', flat=True)) == ['The Lord of the Rings']
+
+
+@pytest.mark.django_db
+def test_lazy_decrypt_deterministic(key):
+    Tag.objects.create(label='urgent', color='red', _key=key)
+    t = Tag.objects.with_key(key).lazy_decrypt().get()
+    assert (t.label, t.color, t.alias) == ('urgent', 'red', None)
+
+
+@pytest.mark.django_db
+def test_lazy_decrypt_python_engine(key, settings, django_assert_num_queries):
+    settings.PGROWCRYPT_ENGINE = 'python'
+    Book.objects.create(title='The Lord of the Rings', _key=key)
+    b = Book.objects.with_key(key).lazy_decrypt().get()
+    with django_assert_num_queries(0):
+        assert b.title == 'The Lord of the Rings'
+
+
+@pytest.mark.django_db
+def test_lazy_decrypt_save(key):
+    Book.objects.create(title='The Lord of the Rings', _key=key)
+    b = Book.objects.with_key(key).lazy_decrypt().get()
+    b.save()
+    b = Book.objects.with_key(key).lazy_decrypt().get()
+    b.title = 'The Hobbit'
+    b.save()
+    assert Book.objects.with_key(key).get().title == 'The Hobbit'
+
+
+@pytest.mark.django_db
+def test_lazy_decrypt_pickle(key):
+    Book.objects.create(title='The Lord of the Rings', _key=key)
+    b = pickle.loads(pickle.dumps(Book.objects.with_key(key).lazy_decrypt().get()))
+    assert b.title == 'The Lord of the Rings'
@@ -0,0 +1,73 @@
+import pytest
+
+from .testapp.models import Author, Book, Customer, Document, Note, Tag
+
+
+@pytest.mark.django_db
+def test_with_keys_fingerprint(django_assert_num_queries):
+    for key in ('a', 'b', 'c'):
+        Document.objects.create(title='Contract {}'.format(key), _key=key)
+    with django_assert_num_queries(1):
+        documents = list(Document.objects.with_keys(['a', 'b']).order_by('title'))
+    assert [d.title for d in documents] == ['Contract a', 'Contract b']
+
+    documents[1].title = 'Invoice b'
+    documents[1].save()
+    assert Document.objects.with_key('b').get().title == 'Invoice b'
+
+
+@pytest.mark.django_db
+def test_with_keys_field(django_assert_num_queries):
+    tolkien = Author.objects.create(name='J. R. R. Tolkien', _key='a')
+    rowling = Author.objects.create(name='J. K. Rowling', _key='b')
+    for author, key in ((tolkien, 'a'), (rowling, 'b')):
+        for i in range(3):
+            Book.objects.create(title='{} {}'.format(author.pk, i), author=author, _key=key)
+    Book.objects.create(title='Anonymous', _key='c')
+
+    keys = {tolkien.pk: 'a', rowling.pk: 'b'}
+    with django_assert_num_queries(1):
+        books = list(Book.objects.with_keys(keys, 'author').iterator())
+    assert sorted(b.title for b in books) == sorted('{} {}'.format(a.pk, i) for a in (tolkien, rowling) for i in range(3))
+    assert {b._EncryptedModel__key for b in books if b.author_id == rowling.pk} == {'b'}
+
+    qs = Book.objects.with_keys(keys, 'author')
+    assert list(qs.filter(title__endswith='1').order_by('title').values_list('title', flat=True)) == [
+        '{} 1'.format(tolkien.pk), '{} 1'.format(rowling.pk)
+    ]
+    assert qs.count() == 6
+    assert [b.author.name for b in qs.filter(title='{} 2'.format(rowling.pk)).select_related('author')] == [
+        'J. K. Rowling'
+    ]
+
+
+@pytest.mark.django_db
+def test_with_keys_indexes():
+    alice = Customer.objects.create(email='alice@example.org', _key='a')
+    bob = Customer.objects.create(email='bob@example.org', _key='b')
+    customers = Customer.objects.with_keys({alice.pk: 'a', bob.pk: 'b'}, 'id')
+    assert customers.get(email='bob@example.org').pk == bob.pk
+
+    red = Tag.objects.create(label='urgent', color='red', _key='a')
+    blue = Tag.objects.create(label='urgent', color='blue', _key='b')
+    tags = Tag.objects.with_keys({red.pk: 'a', blue.pk: 'b'}, 'id')
+    assert sorted(tags.filter(label='urgent').values_list('color', flat=True)) == ['blue', 'red']
+
+    notes = [Note.objects.create(body='Note {}'.format(key), _key=key) for key in ('a', 'b')]
+    assert sorted(Note.objects.with_keys({n.pk: k for n, k in zip(notes, 'ab')}, 'id').values_list('body', flat=True)) == [
+        'Note a', 'Note b'
+    ]
+
+
+@pytest.mark.django_db
+def test_with_keys_errors():
+    with pytest.raises(TypeError):
+        Book.objects.with_keys(['a'])
+    with pytest.raises(TypeError):
+        Book.objects.with_keys({1: 'a'}, 'title')
+    with pytest.raises(TypeError):
+        Book.objects.with_keys({1: None}, 'author')
+    with pytest.raises(TypeError):
+        Book.objects.with_keys({1: 'a'}, 'author').update(title='Untitled')
+    with pytest.raises(TypeError):
+        Book.objects.with_keys({1: 'a'}, 'author').delete()
@@ -0,0 +1,119 @@
+import pytest
+from django.db import connection, migrations, models
+from django.db.migrations.state import ProjectState
+
+from pgrowcrypt.models.fields import EncryptedTextField
+from pgrowcrypt.operations import DecryptColumn, EncryptColumn
+
+
+def apply(operation, state):
+    new_state = state.clone()
+    operation.state_forwards('testapp', new_state)
+    with connection.schema_editor() as editor:
+        operation.database_forwards('testapp', editor, state, new_state)
+    return new_state
+
+
+def unapply(operation, state, new_state):
+    with connection.schema_editor() as editor:
+        operation.database_backwards('testapp', editor, new_state, state)
+
+
+def query(sql, params=()):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall() if cursor.description else None
+
+
+@pytest.fixture
+def state():
+    state = apply(migrations.CreateModel('Secret', fields=[
+        ('id', models.AutoField(primary_key=True)),
+        ('body', models.TextField(null=True)),
+        ('owner', models.TextField()),
+    ]), ProjectState())
+    for i in range(7):
+        query('INSERT INTO testapp_secret (body, owner) VALUES (%s, %s)', ['Secret {}'.format(i), 'key {}'.format(i % 3)])
+    query('INSERT INTO testapp_secret (body, owner) VALUES (NULL, %s)', ['key 0'])
+    return state
+
+
+@pytest.mark.django_db
+def test_encrypt_column_key_source(state):
+    progress = []
+    operation = EncryptColumn('secret', 'body', EncryptedTextField(null=True), key_source='owner', batch_size=3,
+                              progress=lambda *args: progress.append(args))
+    new_state = apply(operation, state)
+    assert query('SELECT pgp_sym_decrypt(body, owner) FROM testapp_secret WHERE body IS NOT NULL ORDER BY id') == [
+        ('Secret {}'.format(i),) for i in range(7)
+    ]
+    assert query('SELECT count(*) FROM testapp_secret WHERE body IS NULL') == [(1,)]
+    assert progress == [('testapp.Secret', 'body', 3), ('testapp.Secret', 'body', 6), ('testapp.Secret', 'body', 7)]
+    assert isinstance(new_state.apps.get_model('testapp', 'Secret')._meta.get_field('body'), EncryptedTextField)
+
+    unapply(operation, state, new_state)
+    assert query('SELECT body FROM testapp_secret WHERE body IS NOT NULL ORDER BY id') == [
+        ('Secret {}'.format(i),) for i in range(7)
+    ]
+
+
+@pytest.mark.django_db
+def test_encrypt_column_callable(state):
+    operation = EncryptColumn('secret', 'body', EncryptedTextField(null=True, format='aes'),
+                              key_source=lambda obj: 'secret {}'.format(obj.owner))
+    new_state = apply(operation, state)
+    assert query('SELECT DISTINCT get_byte(body, 0) FROM testapp_secret WHERE body IS NOT NULL') == [(2,)]
+    unapply(operation, state, new_state)
+    assert query('SELECT body FROM testapp_secret WHERE body IS NOT NULL ORDER BY id') == [
+        ('Secret {}'.format(i),) for i in range(7)
+    ]
+
+
+@pytest.mark.django_db
+def test_encrypt_column_resume(state):
+    # An interrupted run has converted the first row already
+    query('ALTER TABLE testapp_secret ADD COLUMN body_pgrowcrypt bytea')
+    query("UPDATE testapp_secret SET body_pgrowcrypt = pgp_sym_encrypt('Converted', 'other') WHERE id = "
+          "(SELECT min(id) FROM testapp_secret)")
+    apply(EncryptColumn('secret', 'body', EncryptedTextField(null=True), key='k', batch_size=2), state)
+    rows = query("SELECT CASE WHEN id = (SELECT min(id) FROM testapp_secret) THEN pgp_sym_decrypt(body, 'other') "
+                 "ELSE pgp_sym_decrypt(body, 'k') END FROM testapp_secret WHERE body IS NOT NULL ORDER BY id")
+    assert rows == [('Converted',)] + [('Secret {}'.format(i),) for i in range(1, 7)]
+
+
+@pytest.mark.django_db
+def test_encrypt_column_updated_during_backfill(state):
+    def update(label, name, rows):
+        # Change rows that have been converted already
+        if rows == 3:
+            first = query('SELECT min(id) FROM testapp_secret')[0][0]
+            query("UPDATE testapp_secret SET body = 'Changed' WHERE id = %s", [first])
+            query("UPDATE testapp_secret SET owner = 'key 9' WHERE id = %s", [first + 1])
+            query("UPDATE testapp_secret SET owner = owner WHERE id = %s", [first + 2])
+
+    apply(EncryptColumn('secret', 'body', EncryptedTextField(null=True), key_source='owner', batch_size=3,
+                        progress=update), state)
+    assert query('SELECT pgp_sym_decrypt(body, owner), owner FROM testapp_secret WHERE body IS NOT NULL ORDER BY id') == [
+        ('Changed', 'key 0'), ('Secret 1', 'key 9'),
+    ] + [('Secret {}'.format(i), 'key {}'.format(i % 3)) for i in range(2, 7)]
+    assert query("SELECT count(*) FROM pg_trigger WHERE tgname = 'testapp_secret_body_pgrowcrypt'") == [(0,)]
+
+
+@pytest.mark.django_db
+def test_decrypt_column(state):
+    new_state = apply(EncryptColumn('secret', 'body', EncryptedTextField(null=True), key='k'), state)
+    apply(DecryptColumn('secret', 'body', models.TextField(null=True), key='k'), new_state)
+    assert query('SELECT body FROM testapp_secret WHERE body IS NOT NULL ORDER BY id') == [
+        ('Secret {}'.format(i),) for i in range(7)
+    ]
+
+
+def test_operation_arguments():
+    with pytest.raises(TypeError):
+        EncryptColumn('secret', 'body', EncryptedTextField())
+    with pytest.raises(TypeError):
+        EncryptColumn('secret', 'body', models.TextField(), key='k')
+    with pytest.raises(TypeError):
+        EncryptColumn('secret', 'body', EncryptedTextField(blind_index=True), key='k')
+    with pytest.raises(TypeError):
+        DecryptColumn('secret', 'body', EncryptedTextField(), key='k')
@@ -0,0 +1,63 @@
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from pgrowcrypt import pgp
+from pgrowcrypt.models import EncryptedTextField
+
+from .testapp.models import Book, Customer
+
+
+def test_field_options():
+    f = EncryptedTextField(cipher='aes256', s2k_mode=1, compress='zlib', compress_level=9)
+    assert f.deconstruct()[3] == {'cipher': 'aes256', 's2k_mode': 1, 'compress': 'zlib', 'compress_level': 9}
+    assert pgp.options_string(f.get_pgp_options()) == (
+        'cipher-algo=aes256, compress-algo=2, compress-level=9, s2k-mode=1'
+    )
+    with pytest.raises(ImproperlyConfigured):
+        EncryptedTextField(cipher='rot13')
+    with pytest.raises(ImproperlyConfigured):
+        EncryptedTextField(s2k_count=10)
+    with pytest.raises(ImproperlyConfigured):
+        EncryptedTextField(deterministic=True, cipher='aes256')
+
+
+def test_field_options_override_setting(settings):
+    settings.PGROWCRYPT_PGP_OPTIONS = {'cipher': 'aes256', 's2k_mode': 1}
+    f = EncryptedTextField(s2k_mode=3, s2k_count=1024)
+    assert f.get_pgp_options() == {'cipher': 'aes256', 's2k_mode': 3, 's2k_count': 1024}
+
+
+def test_options_setting_check(settings):
+    field = Book._meta.get_field('title')
+    assert field.check() == []
+    settings.PGROWCRYPT_PGP_OPTIONS = {'cipher': 'rot13'}
+    assert [e.id for e in field.check()] == ['pgrowcrypt.E003']
+    settings.PGROWCRYPT_PGP_OPTIONS = {'s2k_count': 10}
+    assert [e.id for e in field.check()] == ['pgrowcrypt.E003']
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('engine', ['database', 'python'])
+def test_options_roundtrip(key, settings, engine):
+    Book.objects.create(title='Written with the defaults', _key=key)
+    settings.PGROWCRYPT_ENGINE = engine
+    settings.PGROWCRYPT_PGP_OPTIONS = {'cipher': 'aes256', 's2k_mode': 1, 'compress': 'zip'}
+    with CaptureQueriesContext(connection) as ctx:
+        Book.objects.create(title='Written with options ' * 10, _key=key)
+    if engine == 'database':
+        assert 'cipher-algo=aes256, compress-algo=1, s2k-mode=1' in str(ctx.captured_queries[0]['sql'])
+    Customer.objects.create(email='alice@example.org', _key=key)
+    Customer.objects.with_key(key).update(email='alice@example.com')
+    settings.PGROWCRYPT_ENGINE = 'python' if engine == 'database' else 'database'
+    assert sorted(Book.objects.with_key(key).values_list('title', flat=True)) == [
+        'Written with options ' * 10, 'Written with the defaults'
+    ]
+    assert Customer.objects.with_key(key).get(email='alice@example.com').email == 'alice@example.com'
+
+
+def test_pgp_options(key):
+    for options in ({'cipher': 'bf', 's2k_mode': 0}, {'cipher': '3des', 's2k_digest': 'md5', 's2k_count': 2048},
+                    {'cipher': 'cast5', 'compress': 'zlib', 'compress_level': 1}):
+        assert pgp.pgp_sym_decrypt(pgp.pgp_sym_encrypt('The Hobbit', key, **options), key) == 'The Hobbit'
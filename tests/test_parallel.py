@@ -0,0 +1,60 @@
+import pytest
+from django.db.backends.signals import connection_created
+
+from pgrowcrypt.models import encryption_key
+
+from .testapp.models import Book
+
+
+@pytest.fixture
+def books(key):
+    Book.objects.bulk_create([Book(title='Book {:02d}'.format(i), _key=key) for i in range(25)])
+
+
+@pytest.mark.django_db(transaction=True)
+def test_parallel_iterator(key, books):
+    titles = [b.title for b in Book.objects.with_key(key).parallel_iterator(workers=3, chunk_size=4, ordered=True)]
+    assert titles == ['Book {:02d}'.format(i) for i in range(25)]
+
+    titles = [b.title for b in Book.objects.with_key(key).parallel_iterator(workers=3, chunk_size=4)]
+    assert sorted(titles) == ['Book {:02d}'.format(i) for i in range(25)]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_parallel_iterator_filtered_values(key, books):
+    with encryption_key(key):
+        qs = Book.objects.filter(title__endswith='5').values_list('title', flat=True)
+        assert list(qs.parallel_iterator(workers=2, chunk_size=1, ordered=True)) == ['Book 05', 'Book 15']
+    qs = Book.objects.with_key(key).filter(title__startswith='Book 1').values('title')
+    assert len(list(qs.parallel_iterator(workers=2, chunk_size=3))) == 10
+
+
+@pytest.mark.django_db(transaction=True)
+def test_parallel_iterator_closed_early(key, books):
+    it = Book.objects.with_key(key).parallel_iterator(workers=2, chunk_size=2, ordered=True)
+    assert next(it).title == 'Book 00'
+    it.close()
+    assert Book.objects.count() == 25
+
+
+@pytest.mark.django_db(transaction=True)
+def test_parallel_iterator_connections(key, books):
+    created = []
+
+    def receiver(connection, **kwargs):
+        created.append(connection)
+
+    connection_created.connect(receiver)
+    try:
+        assert len(list(Book.objects.with_key(key).parallel_iterator(workers=3, chunk_size=2))) == 25
+    finally:
+        connection_created.disconnect(receiver)
+    # One connection per worker instead of one per range, closed at the end
+    assert 1 <= len(created) <= 3
+    assert all(c.connection is None for c in created)
+
+
+@pytest.mark.django_db
+def test_parallel_iterator_sliced(key):
+    with pytest.raises(TypeError):
+        Book.objects.with_key(key)[:10].parallel_iterator()
@@ -0,0 +1,180 @@
+import pytest
+from django.apps import apps
+from django.db import NotSupportedError, connection, transaction
+from django.db.models.signals import post_migrate
+from django.test.utils import CaptureQueriesContext
+
+from pgrowcrypt.models.prepared import deallocate_statements
+
+from .testapp.models import Author, Book, Customer, Document, Tag
+
+
+@pytest.fixture(autouse=True)
+def fresh_statements():
+    yield
+    deallocate_statements(sender=None)
+
+
+def by_title(key, title):
+    return Book.objects.with_key(key).prepared('books_by_title', title=title)
+
+
+@pytest.mark.django_db
+def test_prepared_once(key):
+    Book.objects.create(title='The Lord of the Rings', _key=key)
+    Book.objects.create(title='The Hobbit', _key=key)
+    with CaptureQueriesContext(connection) as ctx:
+        assert [b.title for b in by_title(key, 'The Hobbit')] == ['The Hobbit']
+    assert [q['sql'].split()[0] for q in ctx.captured_queries] == ['PREPARE', 'EXECUTE']
+    assert key not in ctx.captured_queries[0]['sql']
+    with CaptureQueriesContext(connection) as ctx:
+        assert [b.title for b in by_title(key, 'The Lord of the Rings')] == ['The Lord of the Rings']
+        assert not by_title(key, 'Harry Potter').exists()
+    assert ctx.captured_queries[0]['sql'].startswith('EXECUTE')
+
+
+@pytest.mark.django_db
+def test_prepared_other_key():
+    Book.objects.create(title='The Hobbit', _key='a')
+    assert by_title('a', 'The Hobbit').get().title == 'The Hobbit'
+    Book.objects.all().delete()
+    Book.objects.create(title='The Hobbit', _key='b')
+    assert by_title('b', 'The Hobbit').get().title == 'The Hobbit'
+
+
+@pytest.mark.django_db
+def test_prepared_derived_queries(key):
+    Book.objects.create(title='The Hobbit', _key=key)
+    assert by_title(key, 'The Hobbit').first().title == 'The Hobbit'
+    assert list(by_title(key, 'The Hobbit').values_list('title', flat=True)) == ['The Hobbit']
+    assert by_title(key, 'The Hobbit').count() == 1
+    assert [b.title for b in by_title(key, 'The Hobbit')] == ['The Hobbit']
+
+
+@pytest.mark.django_db
+def test_prepared_indexes(key):
+    Customer.objects.create(email='alice@example.org', _key=key)
+    Tag.objects.create(label='urgent', _key=key)
+    with CaptureQueriesContext(connection) as ctx:
+        for i in range(2):
+            assert Customer.objects.with_key(key).prepared('customer', email='alice@example.org').get().email == (
+                'alice@example.org'
+            )
+            assert Tag.objects.with_key(key).prepared('tag', label='urgent').get().label == 'urgent'
+    prepares = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('PREPARE')]
+    assert len(prepares) == 2
+    assert '"testapp_customer"."email_bidx" = hmac(' in prepares[0]
+    assert 'WHERE "testapp_tag"."label" = (SELECT' in prepares[1]
+
+
+@pytest.mark.django_db
+def test_prepared_key_setting(key, settings):
+    settings.PGROWCRYPT_KEY_MODE = 'setting'
+    Book.objects.create(title='The Hobbit', _key=key)
+    assert by_title(key, 'The Hobbit').get().title == 'The Hobbit'
+    assert by_title(key, 'The Hobbit').get().title == 'The Hobbit'
+
+
+@pytest.mark.django_db
+def test_prepared_python_engine(key, settings):
+    settings.PGROWCRYPT_ENGINE = 'python'
+    Book.objects.create(title='The Hobbit', _key=key)
+    assert by_title(key, 'The Hobbit').get().title == 'The Hobbit'
+    assert by_title(key, 'The Hobbit').lazy_decrypt().get().title == 'The Hobbit'
+
+
+@pytest.mark.django_db
+def test_prepared_after_migrate(key):
+    Book.objects.create(title='The Hobbit', _key=key)
+    assert by_title(key, 'The Hobbit').get().title == 'The Hobbit'
+    post_migrate.send(sender=apps.get_app_config('testapp'), app_config=apps.get_app_config('testapp'),
+                      verbosity=0, interactive=False, using='default', apps=apps, plan=[])
+    assert not connection._pgrowcrypt_statements
+    with CaptureQueriesContext(connection) as ctx:
+        assert by_title(key, 'The Hobbit').get().title == 'The Hobbit'
+    assert ctx.captured_queries[0]['sql'].startswith('PREPARE')
+
+
+@pytest.mark.django_db(transaction=True)
+def test_prepared_after_reconnect(key):
+    Book.objects.create(title='The Hobbit', _key=key)
+    assert by_title(key, 'The Hobbit').get().title == 'The Hobbit'
+    connection.close()
+    assert by_title(key, 'The Hobbit').get().title == 'The Hobbit'
+
+
+@pytest.mark.django_db
+def test_prepared_chained(key):
+    tolkien = Author.objects.create(name='Tolkien', _key=key)
+    rowling = Author.objects.create(name='Rowling', _key=key)
+    Book.objects.create(title='The Hobbit', author=tolkien, _key=key)
+    assert by_title(key, 'The Hobbit').count() == 1
+    assert by_title(key, 'The Hobbit').filter(author=rowling).count() == 0
+    assert by_title(key, 'The Hobbit').filter(author=tolkien).count() == 1
+    assert by_title(key, 'The Hobbit').exclude(author=tolkien).count() == 0
+    assert [b.author.name for b in by_title(key, 'The Hobbit').select_related('author')] == ['Tolkien']
+
+
+@pytest.mark.django_db
+def test_prepared_value_equal_to_key():
+    Document.objects.create(title='a', _key='a')
+    Document.objects.create(title='a', _key='b')
+
+    def by_title(key, title):
+        return Document.objects.with_key(key).prepared('documents_by_title', title=title)
+
+    assert by_title('a', 'a').get().title == 'a'
+    # The title is not mistaken for the key of the first query
+    assert by_title('b', 'a').get().title == 'a'
+    assert not by_title('b', 'b').exists()
+
+
+@pytest.mark.django_db
+def test_prepared_iterator(key):
+    Book.objects.create(title='The Hobbit', _key=key)
+    with CaptureQueriesContext(connection) as ctx:
+        assert [b.title for b in by_title(key, 'The Hobbit').iterator()] == ['The Hobbit']
+    assert not any(q['sql'].startswith(('PREPARE', 'EXECUTE')) for q in ctx.captured_queries)
+
+
+def prepared_statements():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM pg_prepared_statements WHERE name LIKE 'pgrowcrypt%%'")
+        return cursor.fetchone()[0]
+
+
+@pytest.mark.django_db
+def test_prepared_statements_limited(key, settings):
+    settings.PGROWCRYPT_PREPARED_STATEMENTS = 2
+    Book.objects.create(title='The Hobbit', _key=key)
+    before = prepared_statements()
+    for n in range(1, 5):
+        # Every length of the list is a statement of its own
+        titles = ['The Hobbit'] + ['Volume {}'.format(i) for i in range(n)]
+        assert len(Book.objects.with_key(key).prepared('books_by_titles', title__in=titles)) == 1
+    assert len(connection._pgrowcrypt_statements) == 2
+    assert prepared_statements() - before <= 2
+    assert len(Book.objects.with_key(key).prepared('books_by_titles', title__in=titles)) == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_prepared_after_schema_change(key):
+    Book.objects.create(title='The Hobbit', _key=key)
+    qs = Book.objects.with_key(key).prepared('book_authors', title='The Hobbit').values_list('author_id', flat=True)
+    assert list(qs.all()) == [None]
+    with connection.cursor() as cursor:
+        cursor.execute('ALTER TABLE testapp_book ALTER COLUMN author_id TYPE bigint')
+    try:
+        # Inside a transaction, the failed query can't be repeated
+        with pytest.raises(NotSupportedError):
+            with transaction.atomic():
+                list(qs.all())
+        assert list(qs.all()) == [None]
+
+        with connection.cursor() as cursor:
+            cursor.execute('ALTER TABLE testapp_book ALTER COLUMN author_id TYPE integer')
+        # Outside of one, it is prepared again right away
+        assert list(qs.all()) == [None]
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute('ALTER TABLE testapp_book ALTER COLUMN author_id TYPE integer')
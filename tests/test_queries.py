@@ -1,6 +1,8 @@
 import pytest
-from django.db.models import F, Max, Value
+from django.db import connection
+from django.db.models import Count, F, Max, Value
 from django.db.models.functions import Concat, Lower
+from django.test.utils import CaptureQueriesContext
 
 from .testapp.models import Author, Book
 
@@ -131,3 +133,45 @@ def test_queryset_prefetch_related(key, django_assert_num_queries):
         authors = list(Author.objects.with_key(key).prefetch_related('book_set').order_by('name'))
         assert list(authors[0].book_set.all()) == [b1]
         assert list(authors[1].book_set.all()) == [b2]
+
+
+@pytest.mark.django_db
+def test_query_decrypts_each_column_once(key):
+    Book.objects.create(title='The Lord of the Rings', _key=key)
+    Book.objects.create(title='The Hobbit', _key=key)
+    Book.objects.create(title='Harry Potter', _key=key)
+    qs = Book.objects.with_key(key).filter(title__icontains='the').annotate(l=Lower('title')).order_by('title')
+    with CaptureQueriesContext(connection) as ctx:
+        assert [(b.title, b.l) for b in qs] == [
+            ('The Hobbit', 'the hobbit'),
+            ('The Lord of the Rings', 'the lord of the rings'),
+        ]
+    assert ctx.captured_queries[0]['sql'].count('pgp_sym_decrypt') == 1
+    assert 'LATERAL' in ctx.captured_queries[0]['sql']
+
+
+@pytest.mark.django_db
+def test_query_decrypts_joined_columns_once(key):
+    a = Author.objects.create(name='J. R. R. Tolkien', _key=key)
+    Book.objects.create(title='The Lord of the Rings', author=a, _key=key)
+    Book.objects.create(title='Harry Potter', _key=key)
+    qs = Book.objects.with_key(key).select_related('author').filter(author__name__startswith='J.').order_by('author__name')
+    with CaptureQueriesContext(connection) as ctx:
+        assert [(b.title, b.author.name) for b in qs] == [('The Lord of the Rings', 'J. R. R. Tolkien')]
+    assert ctx.captured_queries[0]['sql'].count('pgp_sym_decrypt') == 2
+
+
+@pytest.mark.django_db
+def test_query_single_reference_not_hoisted(key):
+    Book.objects.create(title='The Lord of the Rings', _key=key)
+    with CaptureQueriesContext(connection) as ctx:
+        assert Book.objects.with_key(key).get().title == 'The Lord of the Rings'
+    assert 'LATERAL' not in ctx.captured_queries[0]['sql']
+
+
+@pytest.mark.django_db
+def test_query_group_by_not_hoisted(key):
+    Book.objects.create(title='The Lord of the Rings', _key=key)
+    Book.objects.create(title='The Lord of the Rings', _key=key)
+    qs = Book.objects.with_key(key).values('title').annotate(c=Count('id')).order_by('title')
+    assert list(qs.values_list('title', 'c')) == [('The Lord of the Rings', 2)]
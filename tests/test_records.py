@@ -0,0 +1,91 @@
+import pytest
+from django.db import connection
+
+from pgrowcrypt.models import encryption_key
+from pgrowcrypt.models.keys import query_key
+
+from .testapp.models import Author, Book, Document
+
+
+@pytest.mark.django_db
+def test_records(key):
+    author = Author.objects.create(name='Tolkien', _key=key)
+    book = Book.objects.create(title='The Hobbit', author=author, _key=key)
+    records = list(Book.objects.with_key(key).records())
+    assert len(records) == 1
+    r = records[0]
+    assert r.title == 'The Hobbit'
+    assert r.author_id == author.pk
+    assert r.pk == book.pk
+    assert r == (book.pk, 'The Hobbit', author.pk)
+    assert r._key == key
+    assert r._db == 'default'
+    assert type(r).__name__ == 'BookRecord'
+    assert not hasattr(r, '__dict__')
+
+    with encryption_key(key):
+        assert [tuple(r) for r in Book.objects.filter(title='The Hobbit').records('title')] == [('The Hobbit',)]
+        with pytest.raises(AttributeError):
+            Book.objects.records('title')[0].pk
+        r = Book.objects.records('pk', 'title')[0]
+        assert r.pk == r.id == book.pk
+        assert r._fields == ('id', 'title')
+        assert r._to_instance().pk == book.pk
+
+
+@pytest.mark.django_db
+def test_record_to_instance(key):
+    Book.objects.create(title='The Hobbit', _key=key)
+    r = Book.objects.with_key(key).records('id', 'title')[0]
+    book = r._to_instance()
+    assert isinstance(book, Book)
+    assert book.title == 'The Hobbit'
+    assert book.get_deferred_fields() == {'author_id'}
+    assert book.get_unchanged_fields() == [Book._meta.get_field('title')]
+
+    book.title = 'The Lord of the Rings'
+    book.save()
+    assert Book.objects.with_key(key).get().title == 'The Lord of the Rings'
+
+
+@pytest.mark.django_db
+def test_records_with_keys():
+    Document.objects.create(title='Contract', _key='a')
+    Document.objects.create(title='Invoice', _key='b')
+    records = sorted(Document.objects.with_keys(['a', 'b']).records(), key=lambda r: r.title)
+    assert [(r.title, r._key) for r in records] == [('Contract', 'a'), ('Invoice', 'b')]
+    assert records[1]._to_instance()._EncryptedModel__key == 'b'
+    assert [r._key for r in Document.objects.with_keys(['a']).records('title')] == [None]
+
+
+@pytest.mark.django_db
+def test_interleaved_iterators():
+    for i in range(3):
+        Document.objects.create(title='A {}'.format(i), _key='a')
+        Document.objects.create(title='B {}'.format(i), _key='b')
+    a = Document.objects.with_key('a').order_by('pk').iterator(chunk_size=2)
+    b = Document.objects.with_key('b').order_by('pk').iterator(chunk_size=2)
+    docs = [next(it) for i in range(3) for it in (a, b)]
+    assert [(d.title, d._EncryptedModel__key) for d in docs] == [
+        ('A 0', 'a'), ('B 0', 'b'), ('A 1', 'a'), ('B 1', 'b'), ('A 2', 'a'), ('B 2', 'b'),
+    ]
+    assert list(a) == list(b) == []
+
+    a = Document.objects.with_key('a').order_by('pk').values_list('title', flat=True).iterator(chunk_size=1)
+    b = Document.objects.with_key('b').order_by('pk').records('title').iterator(chunk_size=1)
+    assert next(a) == 'A 0'
+    assert next(b)._key == 'b'
+    assert next(a) == 'A 1'
+    assert [r._key for r in b] == ['b', 'b']
+
+
+@pytest.mark.django_db
+def test_from_db_key_inside_iteration():
+    hobbit = Book.objects.create(title='The Hobbit', _key='a')
+    other = Book.objects.create(title='Silmarillion', _key='b')
+    for book in Book.objects.with_key('a').filter(pk=hobbit.pk).iterator():
+        with query_key(connection, 'b'):
+            loaded = Book._base_manager.get(pk=other.pk)
+        assert loaded.title == 'Silmarillion'
+        assert loaded._EncryptedModel__key == 'b'
+        assert book._EncryptedModel__key == 'a'
@@ -0,0 +1,158 @@
+import json
+
+import pytest
+from django.core.management import call_command
+from django.db import NotSupportedError, connection
+
+from pgrowcrypt.rotation import Checkpoint, KeyRotation, rotate_key
+
+from .testapp.models import Author, Book, Customer, Tag, Ticket
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    if connection.pg_version < 100000:
+        pytest.skip('Checkpoints require PostgreSQL 10 or newer')
+    return tmp_path / 'rotation.json'
+
+
+@pytest.mark.django_db
+def test_rotate_key():
+    for i in range(5):
+        Book.objects.create(title='Volume {}'.format(i), _key='old')
+    assert rotate_key(Book, 'old', 'new', batch_size=2) == 5
+    assert sorted(Book.objects.with_key('new').values_list('title', flat=True)) == [
+        'Volume {}'.format(i) for i in range(5)
+    ]
+
+
+@pytest.mark.django_db
+def test_rotate_key_indexes():
+    Customer.objects.create(email='alice@example.org', _key='old')
+    Ticket.objects.create(subject='Printer on fire', _key='old')
+    Tag.objects.create(label='urgent', color='red', _key='old')
+    for model in (Customer, Ticket, Tag):
+        rotate_key(model, 'old', 'new')
+    assert Customer.objects.with_key('new').get(email='alice@example.org').email == 'alice@example.org'
+    assert Ticket.objects.with_key('new').get(subject__icontains='fire').subject == 'Printer on fire'
+    assert Tag.objects.with_key('new').get(label='urgent').color == 'red'
+
+
+@pytest.mark.django_db
+def test_rotate_key_filter():
+    a = Author.objects.create(name='J. R. R. Tolkien', _key='old')
+    b = Author.objects.create(name='J. K. Rowling', _key='other')
+    assert rotate_key(Author, 'old', 'new', filter={'pk': a.pk}) == 1
+    assert Author.objects.with_key('new').get(pk=a.pk).name == 'J. R. R. Tolkien'
+    assert Author.objects.with_key('other').get(pk=b.pk).name == 'J. K. Rowling'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_rotate_key_resume(checkpoint):
+    books = [Book.objects.create(title='Volume {}'.format(i), _key='old') for i in range(6)]
+    # The first batch is done, the second was committed but not recorded as done and the third was aborted
+    rotate_key(Book, 'old', 'new', filter={'pk__lte': books[3].pk})
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT txid_current()')
+        txid = cursor.fetchone()[0]
+    checkpoint.write_text(json.dumps({
+        'model': 'testapp.Book',
+        'last': books[1].pk,
+        'pending': [[books[1].pk, books[3].pk, txid], [books[3].pk, books[5].pk, None]],
+    }))
+    assert rotate_key(Book, 'old', 'new', batch_size=2, checkpoint=str(checkpoint)) == 2
+    assert sorted(Book.objects.with_key('new').values_list('title', flat=True)) == [
+        'Volume {}'.format(i) for i in range(6)
+    ]
+    assert not checkpoint.exists()
+
+
+@pytest.mark.django_db
+def test_rotate_key_checkpoint_other_model(checkpoint):
+    checkpoint.write_text(json.dumps({'model': 'testapp.Author', 'last': None, 'pending': []}))
+    with pytest.raises(ValueError):
+        rotate_key(Book, 'old', 'new', checkpoint=str(checkpoint))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_rotate_key_workers(checkpoint):
+    for i in range(20):
+        Book.objects.create(title='Volume {}'.format(i), _key='old')
+    assert rotate_key(Book, 'old', 'new', batch_size=3, workers=3, checkpoint=str(checkpoint)) == 20
+    assert sorted(Book.objects.with_key('new').values_list('title', flat=True)) == sorted(
+        'Volume {}'.format(i) for i in range(20)
+    )
+
+
+@pytest.mark.django_db(transaction=True)
+def test_rotate_key_workers_interrupted(checkpoint, monkeypatch):
+    books = [Book.objects.create(title='Volume {}'.format(i), _key='old') for i in range(20)]
+    rotate_batch = KeyRotation.rotate_batch
+
+    def interrupted(self, lower, upper):
+        with self.checkpoint.lock:
+            # The batches are recorded in order before any of them runs
+            pending = self.checkpoint.pending
+            assert [b['lower'] for b in pending] == [self.checkpoint.last] + [b['upper'] for b in pending[:-1]]
+            assert self.checkpoint.get(lower, upper) is not None
+        if lower == books[2].pk:
+            raise RuntimeError()
+        return rotate_batch(self, lower, upper)
+
+    monkeypatch.setattr(KeyRotation, 'rotate_batch', interrupted)
+    with pytest.raises(RuntimeError):
+        rotate_key(Book, 'old', 'new', batch_size=3, workers=3, checkpoint=str(checkpoint))
+    assert checkpoint.exists()
+
+    monkeypatch.undo()
+    rotate_key(Book, 'old', 'new', batch_size=3, workers=3, checkpoint=str(checkpoint))
+    assert sorted(Book.objects.with_key('new').values_list('title', flat=True)) == sorted(
+        'Volume {}'.format(i) for i in range(20)
+    )
+    assert not checkpoint.exists()
+
+
+def test_checkpoint_out_of_order(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'rotation.json'), 'testapp.Book')
+    checkpoint.start(3, 6)
+    checkpoint.start(None, 3)
+    checkpoint.start(6, 9)
+    checkpoint.committed(3, 6)
+    assert checkpoint.last is None
+    checkpoint.committed(None, 3)
+    assert checkpoint.last == 6
+    assert [(b['lower'], b['upper']) for b in checkpoint.pending] == [(6, 9)]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_rotate_key_resume_out_of_order(checkpoint):
+    books = [Book.objects.create(title='Volume {}'.format(i), _key='old') for i in range(6)]
+    rotate_key(Book, 'old', 'new', filter={'pk__gt': books[1].pk, 'pk__lte': books[3].pk})
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT txid_current()')
+        txid = cursor.fetchone()[0]
+    # The second batch was recorded first and has been committed, the first was aborted
+    checkpoint.write_text(json.dumps({
+        'model': 'testapp.Book',
+        'last': None,
+        'pending': [[books[1].pk, books[3].pk, txid], [None, books[1].pk, None]],
+    }))
+    assert rotate_key(Book, 'old', 'new', batch_size=2, checkpoint=str(checkpoint)) == 4
+    assert sorted(Book.objects.with_key('new').values_list('title', flat=True)) == [
+        'Volume {}'.format(i) for i in range(6)
+    ]
+
+
+@pytest.mark.django_db
+def test_rotate_key_checkpoint_old_postgres(tmp_path, monkeypatch):
+    monkeypatch.setattr(connection, 'pg_version', 90600)
+    with pytest.raises(NotSupportedError):
+        rotate_key(Book, 'old', 'new', checkpoint=str(tmp_path / 'rotation.json'))
+
+
+@pytest.mark.django_db
+def test_rotate_key_command(capsys):
+    Author.objects.create(name='J. R. R. Tolkien', _key='old')
+    call_command('rotate_key', 'testapp.Author', '--old-key', 'old', '--new-key', 'new')
+    assert 'Rotated 1 rows.' in capsys.readouterr().out
+    assert Author.objects.with_key('new').get().name == 'J. R. R. Tolkien'
@@ -0,0 +1,92 @@
+import django
+import pytest
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+
+from pgrowcrypt.models import encryption_key
+from pgrowcrypt.routers import ReplicaRouter, primary_reads, read_your_writes
+
+from .testapp.models import Author, Book
+
+pytestmark = [
+    pytest.mark.skipif('replica' not in connections.databases, reason='Set PGROWCRYPT_TEST_REPLICA to a database name'),
+    # databases= replaces multi_db= in Django 2.2
+    pytest.mark.django_db(multi_db=True) if django.VERSION < (2, 2) else
+    pytest.mark.django_db(databases=['default', 'replica']),
+]
+
+
+@pytest.fixture
+def replica(settings):
+    settings.DATABASE_ROUTERS = ['pgrowcrypt.routers.ReplicaRouter']
+    settings.PGROWCRYPT_REPLICAS = ['replica']
+
+
+def titles(qs):
+    return [b.title for b in qs]
+
+
+def test_reads_go_to_replica(replica, key):
+    with encryption_key(key):
+        Book.objects.create(title='Primary')
+        Book.objects.using('replica').create(title='Replica')
+        assert titles(Book.objects.all()) == ['Replica']
+        assert Book.objects.get()._state.db == 'replica'
+        assert Book.objects.filter(title='Replica').count() == 1
+
+    book = Book.objects.with_key(key).get()
+    assert book.title == 'Replica'
+    book.refresh_from_db()
+    assert book.title == 'Replica'
+    assert Book.objects.with_key(key).filter(title__startswith='Rep').exists()
+
+
+def test_writes_go_to_primary(replica, key):
+    with encryption_key(key):
+        Book.objects.using('replica').create(title='Replica')
+        book = Book.objects.create(title='Primary')
+        assert book._state.db == 'default'
+        assert Book.objects.update(title='Updated') == 1
+        Book.objects.bulk_create([Book(title='Bulk')])
+    assert sorted(titles(Book.objects.using('default').with_key(key))) == ['Bulk', 'Updated']
+    assert titles(Book.objects.using('replica').with_key(key)) == ['Replica']
+
+    assert Book.objects.with_key(key).delete()[0] == 2
+    assert Book.objects.using('replica').count() == 1
+
+
+def test_key_follows_query(settings, key):
+    # Every query may go to a different database
+    settings.DATABASE_ROUTERS = ['pgrowcrypt.routers.ReplicaRouter']
+    settings.PGROWCRYPT_REPLICAS = ['default', 'replica']
+    for db in ('default', 'replica'):
+        author = Author.objects.using(db).create(name='Ada', _key=key)
+        Book.objects.using(db).create(title='Notes', author=author, _key=key)
+    for i in range(10):
+        books = list(Book.objects.with_key(key).select_related('author'))
+        assert [(b.title, b.author.name) for b in books] == [('Notes', 'Ada')]
+        authors = list(Author.objects.with_key(key).prefetch_related('book_set'))
+        assert [b.title for b in authors[0].book_set.all()] == ['Notes']
+        assert authors[0].book_set.all()[0]._state.db == authors[0]._state.db
+        assert list(Book.objects.with_key(key).values_list('title', flat=True).iterator()) == ['Notes']
+
+
+def test_read_your_writes(replica, key):
+    with encryption_key(key):
+        Book.objects.using('replica').create(title='Replica')
+        with read_your_writes():
+            assert titles(Book.objects.all()) == ['Replica']
+            Book.objects.create(title='Primary')
+            assert titles(Book.objects.all()) == ['Primary']
+        assert titles(Book.objects.all()) == ['Replica']
+
+        with primary_reads():
+            assert titles(Book.objects.all()) == ['Primary']
+
+
+def test_other_models(replica):
+    router = ReplicaRouter()
+    assert router.db_for_read(ContentType) is None
+    assert router.db_for_write(ContentType) is None
+    assert router.db_for_read(Book) == 'replica'
+    assert router.db_for_write(Book) == 'default'
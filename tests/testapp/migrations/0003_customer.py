@@ -0,0 +1,26 @@
+# Generated by Django 2.1.15 on 2026-10-18 09:11
+
+from django.db import migrations, models
+
+import pgrowcrypt.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testapp', '0002_auto_20181222_2319'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Customer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', pgrowcrypt.models.fields.EncryptedTextField(blind_index=True)),
+                ('email_bidx', pgrowcrypt.models.fields.BlindIndexField(db_index=True, null=True, source='email')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.1.15 on 2026-10-18 09:12
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+import pgrowcrypt.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testapp', '0003_customer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Ticket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', pgrowcrypt.models.fields.EncryptedTextField(search_index=True)),
+                ('subject_sidx', pgrowcrypt.models.fields.SearchIndexField(editable=False, null=True, source='subject')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AddIndex(
+            model_name='ticket',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['subject_sidx'], name='testapp_tic_subject_9f32a8_gin'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.1.15 on 2026-10-18 09:15
+
+from django.db import migrations, models
+
+import pgrowcrypt.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testapp', '0004_ticket'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tag',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('label', pgrowcrypt.models.fields.EncryptedTextField(deterministic=True, unique=True)),
+                ('alias', pgrowcrypt.models.fields.EncryptedTextField(deterministic=True, null=True)),
+                ('color', pgrowcrypt.models.fields.EncryptedTextField(deterministic=True, null=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
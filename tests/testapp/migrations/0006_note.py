@@ -0,0 +1,25 @@
+# Generated by Django 2.1.15 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+import pgrowcrypt.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testapp', '0005_tag'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Note',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('body', pgrowcrypt.models.fields.EncryptedTextField(format='aes')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.1.15 on 2026-10-18 10:54
+
+from django.db import migrations, models
+
+import pgrowcrypt.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testapp', '0006_note'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Document',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', pgrowcrypt.models.fields.EncryptedTextField()),
+                ('key_fp', pgrowcrypt.models.fields.KeyFingerprintField(db_index=True, null=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.1.15 on 2026-10-18 11:18
+
+from django.db import migrations, models
+
+import pgrowcrypt.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testapp', '0007_document'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Attachment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', pgrowcrypt.models.fields.EncryptedTextField()),
+                ('content', pgrowcrypt.models.fields.EncryptedBinaryField(null=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
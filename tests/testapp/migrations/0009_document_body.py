@@ -0,0 +1,20 @@
+# Generated by Django 2.1.15 on 2026-10-18 12:11
+
+from django.db import migrations
+
+import pgrowcrypt.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testapp', '0008_attachment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='body',
+            field=pgrowcrypt.models.fields.EncryptedTextField(null=True),
+        ),
+    ]
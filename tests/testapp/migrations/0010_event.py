@@ -0,0 +1,35 @@
+# Generated by Django 2.1.15 on 2026-10-18 13:30
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.fields.jsonb
+import django.contrib.postgres.fields.ranges
+from django.db import migrations, models
+
+import pgrowcrypt.models.aio
+import pgrowcrypt.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testapp', '0009_document_body'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Event',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', pgrowcrypt.models.fields.EncryptedTextField()),
+                ('tags', django.contrib.postgres.fields.ArrayField(base_field=models.TextField(null=True), default=list, size=None)),
+                ('data', django.contrib.postgres.fields.jsonb.JSONField(null=True)),
+                ('period', django.contrib.postgres.fields.ranges.DateRangeField(null=True)),
+                ('duration', models.DurationField(null=True)),
+                ('cancelled', models.BooleanField(default=False)),
+            ],
+            options={
+                'abstract': False,
+            },
+            bases=(pgrowcrypt.models.aio.AsyncModelMixin, models.Model),
+        ),
+    ]
@@ -1,5 +1,14 @@
-from django.db.models import CASCADE, ForeignKey
-from pgrowcrypt.models import EncryptedModel, EncryptedTextField
+from django.contrib.postgres.fields import (
+    ArrayField, DateRangeField, JSONField,
+)
+from django.db.models import (
+    CASCADE, BooleanField, DurationField, ForeignKey, TextField,
+)
+
+from pgrowcrypt.models import (
+    EncryptedBinaryField, EncryptedModel, EncryptedTextField,
+    KeyFingerprintField, search_index,
+)
 
 
 class Book(EncryptedModel):
@@ -15,3 +24,65 @@ class Author(EncryptedModel):
 
     def __str__(self):
         return self.name
+
+
+class Customer(EncryptedModel):
+    email = EncryptedTextField(blind_index=True)
+
+    def __str__(self):
+        return self.email
+
+
+class Ticket(EncryptedModel):
+    subject = EncryptedTextField(search_index=True)
+
+    class Meta:
+        indexes = [search_index('subject')]
+
+    def __str__(self):
+        return self.subject
+
+
+class Tag(EncryptedModel):
+    label = EncryptedTextField(deterministic=True, unique=True)
+    alias = EncryptedTextField(deterministic=True, null=True)
+    color = EncryptedTextField(deterministic=True, null=True)
+
+    def __str__(self):
+        return self.label
+
+
+class Note(EncryptedModel):
+    body = EncryptedTextField(format='aes')
+
+    def __str__(self):
+        return self.body
+
+
+class Document(EncryptedModel):
+    title = EncryptedTextField()
+    body = EncryptedTextField(null=True)
+    key_fp = KeyFingerprintField()
+
+    def __str__(self):
+        return self.title
+
+
+class Attachment(EncryptedModel):
+    name = EncryptedTextField()
+    content = EncryptedBinaryField(null=True)
+
+    def __str__(self):
+        return self.name
+
+
+class Event(EncryptedModel):
+    name = EncryptedTextField()
+    tags = ArrayField(TextField(null=True), default=list)
+    data = JSONField(null=True)
+    period = DateRangeField(null=True)
+    duration = DurationField(null=True)
+    cancelled = BooleanField(default=False)
+
+    def __str__(self):
+        return self.name